@@ -0,0 +1,356 @@
+# coding=utf-8
+# Copyright (c) 2013-2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Batch execution of many flash and test jobs ('aft --jobs <file>').
+
+The job file lists (machine, image, test plan) tuples:
+
+    [
+        {"name": "nightly-qa", "machine": "MinnowboardMAX",
+         "image": "/home/tester/images/nightly.hddimg",
+         "test_plan": "iot_qatest"},
+        {"machine": "MinnowboardMAX", "test_plan": "iot_gtest"}
+    ]
+
+The file is read as YAML if PyYAML is installed, otherwise as JSON (which is
+also valid YAML). "image" may be omitted to run a test plan on whatever image
+the device has, and "test_plan" may be omitted to use the test plan
+configured for the device. "name" names the results file of the job, so it
+must be unique and must not contain path separators.
+
+Before execution, the jobs are packed greedily to minimize flashing and mode
+transitions, each of which costs a power cycle and a boot:
+    - One device is reserved per model and kept for all the jobs of the model
+    - Jobs sharing a model and an image are grouped, so that the image is
+      flashed once and the test plans are run back-to-back in test mode
+    - Jobs without an image are run last, while the device is still in test
+      mode after the last group
+"""
+
+import os
+import copy
+from collections import OrderedDict
+import json
+try:
+    import yaml
+    _PARSE_ERRORS = (ValueError, yaml.YAMLError)
+except ImportError:
+    yaml = None
+    _PARSE_ERRORS = (ValueError,)
+
+import aft.errors as errors
+import aft.devices.common as common
+from aft.tester import Tester
+from aft.logger import Logger as logger
+
+
+def load_jobs(file_name, directory=None):
+    """
+    Read and validate the jobs from a job file
+
+    Args:
+        file_name (str): Path to the job file
+        directory (str): Directory relative image paths are resolved against.
+            Defaults to the working directory.
+
+    Returns:
+        List of job dictionaries with the keys "index", "name", "machine",
+        "image" and "test_plan". Missing image and test plan are None.
+
+    Raises:
+        aft.errors.AFTConfigurationError if the file is malformed
+    """
+    with open(file_name) as job_file:
+        try:
+            if yaml:
+                entries = yaml.safe_load(job_file)
+            else:
+                entries = json.load(job_file)
+        except _PARSE_ERRORS as err:
+            msg = "Failed to parse job file " + file_name + ": " + str(err)
+            if not yaml:
+                msg += (". Only JSON job files can be read, PyYAML is " +
+                        "required for YAML job files")
+            raise errors.AFTConfigurationError(msg)
+
+    if isinstance(entries, dict) and "jobs" in entries:
+        entries = entries["jobs"]
+
+    if not isinstance(entries, list) or len(entries) == 0:
+        raise errors.AFTConfigurationError(
+            "Job file " + file_name + " must contain a list of jobs")
+
+    jobs = []
+    names = set()
+    for index, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict) or not entry.get("machine"):
+            raise errors.AFTConfigurationError(
+                "Job " + str(index) + " in " + file_name +
+                " does not specify a machine")
+
+        image = entry.get("image")
+        if image and not os.path.isfile(os.path.join(directory or "",
+                                                     str(image))):
+            raise errors.AFTConfigurationError(
+                "Didn't find image " + str(image) + " of job " + str(index))
+
+        name = str(entry.get("name", "job" + str(index)))
+        if (name in ("", ".", "..") or os.sep in name or
+                (os.altsep and os.altsep in name)):
+            raise errors.AFTConfigurationError(
+                "Invalid name '" + name + "' of job " + str(index) +
+                ": the name is used as a file name")
+
+        if name in names:
+            raise errors.AFTConfigurationError(
+                "Invalid name '" + name + "' of job " + str(index) +
+                ": another job has the same name")
+        names.add(name)
+
+        jobs.append({
+            "index": index,
+            "name": name,
+            "machine": str(entry["machine"]),
+            "image": image,
+            "test_plan": entry.get("test_plan")})
+
+    return jobs
+
+
+def plan_jobs(jobs):
+    """
+    Pack the jobs into per-model batches of image groups
+
+    Args:
+        jobs (list(dictionary)): Jobs, as returned by load_jobs()
+
+    Returns:
+        List of model batches in the order the models first appear in the job
+        list. Each batch is a dictionary:
+        {
+            "model": "device_model",
+            "groups": [
+                {
+                    "image": "image file or None",
+                    "jobs": [job, ...]
+                },
+                ...
+            ]
+        }
+        Groups with an image are in the order the image first appears, and
+        the group without an image, if any, is last.
+    """
+    batches = OrderedDict()
+
+    for job in jobs:
+        model = job["machine"].lower()
+        if model not in batches:
+            batches[model] = {
+                "model": job["machine"],
+                "groups": OrderedDict()}
+
+        groups = batches[model]["groups"]
+        if job["image"] not in groups:
+            groups[job["image"]] = {"image": job["image"], "jobs": []}
+        groups[job["image"]]["jobs"].append(job)
+
+    plan = []
+    for batch in batches.values():
+        groups = [group for group in batch["groups"].values()
+                  if group["image"] is not None]
+        if None in batch["groups"]:
+            groups.append(batch["groups"][None])
+
+        plan.append({"model": batch["model"], "groups": groups})
+
+    return plan
+
+
+def run_jobs(args, device_manager):
+    """
+    Execute the jobs listed in the job file args.jobs
+
+    Args:
+        args (argparse namespace argument object):
+            Command line arguments, as parsed by argparse
+        device_manager (aft.DevicesManager): Device manager
+
+    Returns:
+        0 if every job was flashed and tested, 1 otherwise
+    """
+    jobs = load_jobs(args.jobs)
+    plan = plan_jobs(jobs)
+
+    flash_count = len([group for batch in plan for group in batch["groups"]
+                       if group["image"] is not None])
+    print("Running " + str(len(jobs)) + " jobs on " + str(len(plan)) +
+          " models with " + str(flash_count) + " flashes.")
+
+    status = {}
+    for batch in plan:
+        try:
+            _run_model_batch(args, device_manager, batch, status)
+        except (errors.AFTConfigurationError, errors.AFTTimeoutError,
+                errors.AFTDeviceError, errors.AFTConnectionError) as err:
+            # The jobs of the other models can still be run
+            msg = "Jobs of " + batch["model"] + " failed: " + str(err)
+            logger.error(msg)
+            print(msg)
+            for group in batch["groups"]:
+                for job in group["jobs"]:
+                    status.setdefault(job["index"], "failed: " + str(err))
+
+    failed = 0
+    for job in jobs:
+        print(job["name"] + ": " + status.get(job["index"], "not run"))
+        if status.get(job["index"]) != "done":
+            failed += 1
+
+    if failed:
+        print(str(failed) + " of " + str(len(jobs)) + " jobs failed")
+        return 1
+
+    return 0
+
+
+def _run_model_batch(args, device_manager, batch, status):
+    """
+    Execute the jobs of a single model on one device.
+
+    Args:
+        args (argparse namespace argument object): Command line arguments
+        device_manager (aft.DevicesManager): Device manager
+        batch (dictionary): Model batch, as returned by plan_jobs()
+        status (dictionary): Job index -> job status string. Updated with the
+            status of the executed jobs.
+    """
+    device = None
+
+    try:
+        for group in batch["groups"]:
+            if group["image"] is not None:
+                device = _flash_group(args, device_manager, batch["model"],
+                                      group, device)
+                if device is None:
+                    for job in group["jobs"]:
+                        status[job["index"]] = "flashing failed"
+                    continue
+
+            elif device is None:
+                device = _reserve(args, device_manager, batch["model"])
+
+            for job in group["jobs"]:
+                status[job["index"]] = _test_job(args, device, job)
+
+    finally:
+        if device is not None:
+            if not args.nopoweroff:
+                device.detach()
+            device_manager.release(device)
+
+
+def _reserve(args, device_manager, model):
+    """
+    Reserve a device of the model and start serial recording if requested
+    """
+    device = device_manager.reserve(model=model)
+
+    if args.record:
+        device.record_serial()
+
+    return device
+
+
+def _flash_group(args, device_manager, model, group, device):
+    """
+    Flash the image of the group, retrying on other devices of the model up to
+    args.machine_retries times. Devices that fail flashing are blacklisted and
+    released.
+
+    Args:
+        args (argparse namespace argument object): Command line arguments
+        device_manager (aft.DevicesManager): Device manager
+        model (str): Device model
+        group (dictionary): Image group, as returned in plan_jobs()
+        device (aft.Device): Currently reserved device, or None
+
+    Returns:
+        The flashed device, or None if flashing failed
+    """
+    # Local import to avoid circular import, as aft.main imports this module
+    import aft.main
+
+    flash_args = copy.copy(args)
+    flash_args.machine = model
+    flash_args.file_name = group["image"]
+
+    for machine_attempt in range(1, args.machine_retries + 1):
+        if device is None:
+            device = _reserve(args, device_manager, model)
+
+        try:
+            aft.main.flash_device(flash_args, device)
+            return device
+
+        except KeyboardInterrupt:
+            raise
+
+        except:
+            msg = "Flashing failed " + str(args.flash_retries) + " times"
+            print(msg + ", blacklisting " + str(device.name))
+            logger.info(msg + ", blacklisting " + str(device.name))
+            common.blacklist_device(device.dev_id, device.name, msg)
+
+            if not args.nopoweroff:
+                device.detach()
+            device_manager.release(device)
+            device = None
+
+            if machine_attempt < args.machine_retries:
+                print("Attempting flashing another machine")
+
+    return None
+
+
+def _test_job(args, device, job):
+    """
+    Run the test plan of a single job
+
+    Args:
+        args (argparse namespace argument object): Command line arguments
+        device (aft.Device): The device
+        job (dictionary): The job
+
+    Returns:
+        Job status string
+    """
+    if args.notest:
+        return "done"
+
+    try:
+        tester = Tester(
+            device,
+            results_file_name=job["name"] + "_results.xml",
+            test_plan=job["test_plan"])
+
+        print("Testing " + str(device.name) + " for job " + job["name"] + ".")
+        tester.execute()
+        return "done"
+
+    except KeyboardInterrupt:
+        raise
+
+    except Exception as err:
+        logger.error("Job " + job["name"] + " failed: " + str(err))
+        print("Job " + job["name"] + " failed: " + str(err))
+        return "testing failed"
@@ -20,8 +20,41 @@ LOCK_FILE = "/var/lock/"
 SERIAL_LOG_NAME = "serial.log"
 AFT_LOG_NAME = "aft.log"
 NFS_FOLDER = "/home/tester/"
+# Old text blacklist file. Its entries are imported to the state database
+# once, when the database is created. The blacklist is then only changed with
+# --blacklist and --unblacklist.
 DEVICE_BLACKLIST="/etc/aft/blacklist"
+# Seconds after which automatically blacklisted devices return to the pool,
+# doubled for each consecutive blacklisting. 0 disables the expiry.
+BLACKLIST_TTL = "0"
+# Seconds a reservation stays valid without a heartbeat from its job. Devices
+# of jobs that stop renewing their lease are power cycled and released by the
+# lease supervisor. Jobs renew their lease between stages and test cases, so
+# the time must exceed the longest flash, boot or test case. 0 disables the
+# reclamation.
+LEASE_TIME = "0"
+# Maximum number of idle devices per model kept booted into service mode by
+# the warm pool, so that jobs can start flashing right away. The number of
+# devices kept warm follows the recent demand. 0 disables the warm pool.
+WARM_POOL_SIZE = "0"
+STATE_DATABASE = "/var/lib/aft/state.db"
+CONFIG_CACHE_FOLDER = "/var/cache/aft/"
 KNOWN_GOOD_IMAGE_FOLDER = "/home/tester/good_test_images"
+JOB_SERVER_SOCKET = "/var/run/aft/aft.sock"
+STAGE_LIMITS = ""
+# Address ("host:port") the job server accepts jobs on over TCP. Without a
+# host, only connections from localhost are accepted.
+JOB_SERVER_ADDRESS = ""
+# Address ("host:port") of the farm coordinator
+COORDINATOR = ""
+# Secret shared by the job servers, the coordinator and the clients of a farm.
+# TCP requests are authenticated with it. Required for listening on any
+# address, including localhost.
+FARM_SECRET = ""
+# Directory the working directory and the configuration files of jobs
+# received over TCP must be in, in addition to /etc/aft for the
+# configuration files
+JOB_ROOT = "/home/tester/"
 
 import sys
 try:
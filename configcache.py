@@ -0,0 +1,129 @@
+# coding=utf-8
+# Copyright (c) 2013-2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Cache of compiled configuration snapshots.
+
+Parsing and merging the configuration files takes a noticeable time on large
+farms, and is done by every invocation. The parsed result is stored as a JSON
+snapshot in config.CONFIG_CACHE_FOLDER, together with the modification times
+and sizes of the source files. The snapshot is used as long as none of the
+source files has changed; otherwise the files are parsed again and the
+snapshot is replaced.
+
+Caching is disabled if config.CONFIG_CACHE_FOLDER is empty. Failing to read
+or write a snapshot is never an error, the files are simply parsed.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+import aft.config as config
+from aft.logger import Logger as logger
+
+# Incremented whenever the format of the cached data changes
+_SNAPSHOT_VERSION = 1
+
+
+def get_files_signature(file_names):
+    """
+    Return a value that changes when any of the given files is modified
+
+    Args:
+        file_names (list(str)): Files to check
+
+    Returns:
+        List of [file name, modification time, size] lists. Missing files
+        have None as their modification time and size.
+    """
+    signature = []
+    for file_name in file_names:
+        try:
+            stat = os.stat(file_name)
+            signature.append([file_name, stat.st_mtime, stat.st_size])
+        except OSError:
+            signature.append([file_name, None, None])
+    return signature
+
+
+def load(kind, source_files, build):
+    """
+    Return the data built from the source files, from the cached snapshot if
+    the files have not changed since the snapshot was made
+
+    Args:
+        kind (str): Kind of the data, used in the snapshot file name
+        source_files (list(str)): The files the data is built from
+        build (function): Function that parses the files and returns the data.
+            The data must be serializable to JSON.
+
+    Returns:
+        The data
+    """
+    signature = get_files_signature(
+        [os.path.abspath(file_name) for file_name in source_files])
+
+    if not config.CONFIG_CACHE_FOLDER:
+        return build()
+
+    snapshot_file = _get_snapshot_file(kind, signature)
+
+    try:
+        with open(snapshot_file, "r") as snapshot:
+            cached = json.load(snapshot)
+        if cached["version"] == _SNAPSHOT_VERSION and \
+                cached["signature"] == signature:
+            return cached["data"]
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    data = build()
+    _save(snapshot_file, {"version": _SNAPSHOT_VERSION,
+                          "signature": signature,
+                          "data": data})
+    return data
+
+
+def _get_snapshot_file(kind, signature):
+    """
+    Return the path of the snapshot of the given source files
+    """
+    names = "\n".join([entry[0] for entry in signature])
+    digest = hashlib.sha1(names.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(config.CONFIG_CACHE_FOLDER,
+                        kind + "_" + digest + ".json")
+
+
+def _save(snapshot_file, snapshot):
+    """
+    Write the snapshot file atomically, so that concurrent readers never see
+    a partially written snapshot
+    """
+    directory = os.path.dirname(snapshot_file)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        handle, temp_file = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "w") as snapshot_output:
+                json.dump(snapshot, snapshot_output)
+            os.chmod(temp_file, 0o644)
+            os.rename(temp_file, snapshot_file)
+        except:
+            os.unlink(temp_file)
+            raise
+    except (IOError, OSError) as err:
+        logger.info("Could not save configuration snapshot " +
+                    snapshot_file + ": " + str(err))
@@ -0,0 +1,307 @@
+# coding=utf-8
+# Copyright (c) 2013-2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Farm coordinator ('aft --coordinate').
+
+The coordinator keeps a view of the devices of all the harness PCs of the
+farm. Each harness runs a job server with --listen and --coordinator, which
+acts as an agent: it reports the state of its devices (reserved, blacklisted,
+flashing success rate) to the coordinator periodically and whenever a job
+finishes. Clients submitting jobs with 'aft --submit --coordinator ...' ask
+the coordinator where to run the job, and submit it to the job server of the
+chosen harness.
+
+A job is placed on the harness with the most free, non-blacklisted devices
+of the requested model, preferring the harness whose best free device has the
+best flashing success rate. A placed device is claimed for a while, so that
+concurrent jobs are spread before the harness reports the device reserved. If
+no harness has a free device, the job is placed on the harness with the
+shortest queue relative to its number of devices.
+
+The protocol consists of one JSON request and one JSON reply per connection:
+
+    {"register": {"host": "harness1", "address": "harness1:7091",
+                  "devices": [device state, ...]}}
+        -> {"ok": true}
+    {"place": {"model": "minnowboardmax", "device": null}}
+        -> {"host": "harness1", "address": "harness1:7091"}
+        or {"error": "reason"}
+
+Image files and the client's working directory must be reachable through the
+same paths on all the harnesses, e.g. through a shared nfs mount, under the
+job root (aft.config.JOB_ROOT) of the job servers.
+
+Every request is signed with the farm secret (aft.config.FARM_SECRET, see
+aft.tools.json_socket), which must be configured even if the coordinator only
+listens on localhost.
+"""
+
+import socket
+import threading
+import time
+
+import aft.errors as errors
+import aft.tools.json_socket as json_socket
+from aft.logger import Logger as logger
+
+# Seconds between the device state reports of the agents
+HEARTBEAT_INTERVAL = 10
+# Harnesses that have not reported for this long (seconds) are ignored
+_HOST_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+# Seconds a placed job is expected to take to reserve its device
+_CLAIM_TIME = 60
+
+
+class _FarmView(object):
+    """
+    The devices of all the harnesses, as last reported by the agents
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # host -> {"address": address, "devices": [device state],
+        #          "last_seen": time}
+        self._hosts = {}
+        # (host, device id) -> claim expiry time
+        self._claims = {}
+        # (host, model or device name) -> expiry times of the placed jobs
+        # that found no free device
+        self._queued = {}
+
+    def update_host(self, host, address, devices):
+        """
+        Store the device states reported by an agent
+
+        Args:
+            host (str): Host name of the harness
+            address (str): Address of the job server of the harness
+            devices (list(dictionary)): Device states, as returned by
+                aft.DevicesManager.get_inventory()
+        """
+        with self._lock:
+            if host not in self._hosts:
+                logger.info("Harness " + host + " registered with " +
+                            str(len(devices)) + " devices")
+
+            self._hosts[host] = {
+                "address": address,
+                "devices": devices,
+                "last_seen": time.time()}
+
+            # Claimed devices that are now reserved have been taken by the job
+            for device in devices:
+                if device["reserved"]:
+                    self._claims.pop((host, device["id"]), None)
+
+    def place(self, model=None, device_name=None):
+        """
+        Choose the harness for a job
+
+        Args:
+            model (str): Model of the device the job needs
+            device_name (str): Name of the specific device the job needs.
+                Overrides model.
+
+        Returns:
+            (host, address) tuple of the chosen harness
+
+        Raises:
+            aft.errors.AFTConfigurationError if no harness has a suitable
+            device
+        """
+        now = time.time()
+        if device_name:
+            key = device_name.lower()
+        else:
+            key = str(model).lower()
+
+        with self._lock:
+            best = None
+            for host, state in self._hosts.items():
+                if now - state["last_seen"] > _HOST_TIMEOUT:
+                    continue
+
+                healthy = [device for device in state["devices"]
+                           if not device["blacklisted"] and
+                           (device["name"] if device_name
+                            else device["model"]) == key]
+                if len(healthy) == 0:
+                    continue
+
+                free = [device for device in healthy
+                        if not device["reserved"] and
+                        self._claims.get((host, device["id"]), 0) < now]
+                free.sort(key=_get_success_rate, reverse=True)
+
+                if free:
+                    score = (1, _get_success_rate(free[0]), len(free))
+                else:
+                    queued = [expiry for expiry in
+                              self._queued.get((host, key), [])
+                              if expiry > now]
+                    self._queued[(host, key)] = queued
+                    busy = len([device for device in healthy
+                                if device["reserved"]]) + len(queued)
+                    score = (0, -float(busy) / len(healthy), len(healthy))
+
+                if best is None or score > best[0]:
+                    best = (score, host, state["address"], free)
+
+            if best is None:
+                raise errors.AFTConfigurationError(
+                    "No harness has a working " + key)
+
+            _, host, address, free = best
+            if free:
+                self._claims[(host, free[0]["id"])] = now + _CLAIM_TIME
+            else:
+                self._queued.setdefault((host, key), []).append(
+                    now + _CLAIM_TIME)
+
+            return (host, address)
+
+
+def _get_success_rate(device):
+    """
+    Return the flashing success rate of a device state, 1.0 if unknown
+    """
+    if device.get("flash_success_rate") is None:
+        return 1.0
+    return device["flash_success_rate"]
+
+
+def serve(args):
+    """
+    Run the coordinator until interrupted.
+
+    Args:
+        args (argparse namespace argument object):
+            Command line arguments, as parsed by argparse
+
+    Returns:
+        Process exit code (integer)
+    """
+    view = _FarmView()
+    server = json_socket.listen(args.coordinator)
+
+    logger.info("Coordinator listening on " + args.coordinator)
+    print("Coordinator listening on " + args.coordinator)
+
+    try:
+        while True:
+            connection, _ = server.accept()
+            handler = threading.Thread(
+                target=_handle_connection,
+                args=(connection, view))
+            handler.daemon = True
+            handler.start()
+    finally:
+        server.close()
+
+
+def _handle_connection(connection, view):
+    """
+    Answer a single request
+
+    Args:
+        connection (socket.socket): The connection
+        view (_FarmView): The farm state
+    """
+    try:
+        request = json_socket.read_message(connection.makefile("rb"))
+        if not request:
+            return
+
+        try:
+            request = json_socket.authenticate(request)
+        except errors.AFTConnectionError as err:
+            logger.warning("Rejected coordinator request: " + str(err))
+            json_socket.send_message(connection, {"error": str(err)})
+            return
+
+        if "register" in request:
+            registration = request["register"]
+            view.update_host(registration["host"], registration["address"],
+                             registration["devices"])
+            reply = {"ok": True}
+
+        elif "place" in request:
+            try:
+                host, address = view.place(request["place"].get("model"),
+                                           request["place"].get("device"))
+                logger.info("Placed job for " +
+                            str(request["place"]) + " on " + host)
+                reply = {"host": host, "address": address}
+            except errors.AFTConfigurationError as err:
+                reply = {"error": str(err)}
+
+        else:
+            reply = {"error": "Unknown request"}
+
+        json_socket.send_message(connection, reply)
+
+    except (IOError, OSError, ValueError, KeyError, TypeError) as err:
+        logger.warning("Coordinator request failed: " + str(err))
+
+    finally:
+        connection.close()
+
+
+def place(coordinator, model=None, device_name=None):
+    """
+    Ask the coordinator which harness should run a job
+
+    Args:
+        coordinator (str): Address of the coordinator, as "host:port"
+        model (str): Model of the device the job needs
+        device_name (str): Name of the specific device the job needs
+
+    Returns:
+        (host, address) tuple of the chosen harness
+
+    Raises:
+        aft.errors.AFTConfigurationError if no harness can run the job
+        aft.errors.AFTConnectionError if the coordinator cannot be reached
+    """
+    reply = json_socket.request(
+        coordinator,
+        {"place": {"model": model, "device": device_name}})
+
+    if "error" in reply:
+        raise errors.AFTConfigurationError(reply["error"])
+
+    return (reply["host"], reply["address"])
+
+
+def register(coordinator, address, devices):
+    """
+    Report the device states of this harness to the coordinator
+
+    Args:
+        coordinator (str): Address of the coordinator, as "host:port"
+        address (str): Address of the job server of this harness
+        devices (list(dictionary)): Device states, as returned by
+            aft.DevicesManager.get_inventory()
+
+    Raises:
+        aft.errors.AFTConnectionError if the coordinator cannot be reached or
+        rejects the report
+    """
+    reply = json_socket.request(
+        coordinator,
+        {"register": {"host": socket.gethostname(),
+                      "address": address,
+                      "devices": devices}})
+
+    if "error" in reply:
+        raise errors.AFTConnectionError(reply["error"])
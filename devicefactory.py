@@ -16,37 +16,44 @@
 Factory module for creation of AFT device instances and their cutter objects
 """
 
-import aft.devices.beagleboneblackdevice
-import aft.devices.edisondevice
-import aft.devices.pcdevice
-import aft.devices.virtualboxdevice
-import aft.cutters.clewarecutter
-import aft.cutters.usbrelay
-import aft.cutters.mockcutter
-
-_DEVICE_CLASSES = {
-    "beagleboneblack" : aft.devices.beagleboneblackdevice.BeagleBoneBlackDevice,
-    "edison" : aft.devices.edisondevice.EdisonDevice,
-    "pc" : aft.devices.pcdevice.PCDevice,
-    "virtualbox" : aft.devices.virtualboxdevice.VirtualBoxDevice
-}
-_CUTTER_CLASSES = {
-    "clewarecutter" : aft.cutters.clewarecutter.ClewareCutter,
-    "usbrelay" : aft.cutters.usbrelay.Usbrelay,
-    "mockcutter" : aft.cutters.mockcutter.Mockcutter
-}
+import aft.plugins as plugins
+
+_DEVICE_CLASSES = plugins.Registry("platform", "aft.devices", {
+    "beagleboneblack" :
+        "aft.devices.beagleboneblackdevice:BeagleBoneBlackDevice",
+    "edison" : "aft.devices.edisondevice:EdisonDevice",
+    "pc" : "aft.devices.pcdevice:PCDevice",
+    "virtualbox" : "aft.devices.virtualboxdevice:VirtualBoxDevice"
+})
+_CUTTER_CLASSES = plugins.Registry("cutter type", "aft.cutters", {
+    "clewarecutter" : "aft.cutters.clewarecutter:ClewareCutter",
+    "usbrelay" : "aft.cutters.usbrelay:Usbrelay",
+    "mockcutter" : "aft.cutters.mockcutter:Mockcutter"
+})
 
 
 def build_cutter(config):
     """
     Construct a (power) cutter instance of type config["cutter_type"].
     """
-    cutter_class = _CUTTER_CLASSES[config["cutter_type"].lower()]
+    cutter_class = get_cutter_class(config)
     return cutter_class(config)
 
+def get_cutter_class(config):
+    """
+    Return the cutter class of type config["cutter_type"]
+    """
+    return _CUTTER_CLASSES.get(config["cutter_type"])
+
+def get_device_class(config):
+    """
+    Return the device class of type config["platform"]
+    """
+    return _DEVICE_CLASSES.get(config["platform"])
+
 def build_device(config, cutter):
     """
     Construct a device instance of type config["platform"]
     """
-    device_class = _DEVICE_CLASSES[config["platform"].lower()]
+    device_class = get_device_class(config)
     return device_class(config, cutter)
@@ -20,6 +20,7 @@ writing new code or modifying old one (avoid writes outside SD card mount
 points)
 """
 
+import time
 from time import sleep
 import os
 import shutil
@@ -128,6 +129,8 @@ class BeagleBoneBlackDevice(Device):
     _BOOT_TIMEOUT = 240
     _POLLING_INTERVAL = 10
     _ROOTFS_WRITING_TIMEOUT = 1800
+    # Characters of the verbose tar output that are kept for error reporting
+    _ROOTFS_WRITING_OUTPUT_LIMIT = 65536
     _SERVICE_MODE_RETRY_ATTEMPTS = 4
     _TEST_MODE_RETRY_ATTEMPTS = 4
 
@@ -215,11 +218,60 @@ class BeagleBoneBlackDevice(Device):
             None
         """
 
+        self.prepare_image(root_tarball)
+        self.enter_service_mode()
+        self.flash(root_tarball)
+
+    def prepare_image(self, root_tarball):
+        """
+        Copy the image files to the support fs working directory
+
+        Args:
+            root_tarball (str):
+                The name of the root tarball file
+        Returns:
+            None
+        """
         self._prepare_support_fs(root_tarball)
+
+    def enter_service_mode(self):
+        """
+        Boot the support image over nfs
+
+        Returns:
+            None
+        """
         self._enter_service_mode()
-        self._flash_image()
+
+    def flash(self, root_tarball):
+        """
+        Write the prepared image files from the support fs working directory
+        to the SD card
+
+        Args:
+            root_tarball (str):
+                The name of the root tarball file
+        Returns:
+            None
+        """
+        try:
+            self._flash_image()
+        except:
+            # the device state is unknown, so force a reboot on retry
+            self._active_mode = None
+            self._force_reboot = True
+            raise
         self._remove_temp_dir()
 
+    def enter_test_mode(self):
+        """
+        Boot the device from the SD card
+
+        Returns:
+            None
+        """
+        self._enter_test_mode()
+
     def _prepare_support_fs(self, root_tarball):
         """
         Create directories and copy all the necessary files to the support fs
@@ -309,6 +361,9 @@ class BeagleBoneBlackDevice(Device):
             mode
         """
 
+        if self._is_in_mode(self.parameters["service_mode"]):
+            return
+
         logger.info(
             "Trying to enter service mode up to " +
             str(self._SERVICE_MODE_RETRY_ATTEMPTS) + " times.")
@@ -376,6 +431,7 @@ class BeagleBoneBlackDevice(Device):
 
             if (self.dev_ip and
                     self._verify_mode(self.parameters["service_mode"])):
+                self._active_mode = self.parameters["service_mode"]
                 return
             else:
                 logger.warning("Failed to enter service mode")
@@ -394,21 +450,60 @@ class BeagleBoneBlackDevice(Device):
             aft.errors.AFTDeviceError if the device failed to enter the test
             mode
         """
+        if self._active_mode == self.parameters["test_mode"]:
+            logger.info("Device already in test mode")
+            return
+
+        if self._is_in_mode(self.parameters["test_mode"]):
+            common.renew_lease(self.dev_id, "test_mode")
+            return
+
         # device by default boots from sd card, so if everything has gone well,
-        # we can just power cycle to boot the testable image
+        # we can just reboot to boot the testable image
         logger.info("Entering test mode")
-        for _ in range(self._TEST_MODE_RETRY_ATTEMPTS):
-            self._power_cycle()
+        start_time = time.time()
+        for attempt in range(self._TEST_MODE_RETRY_ATTEMPTS):
+            self._reboot(allow_soft_reboot=attempt == 0)
             self.dev_ip = self._wait_for_responsive_ip()
 
 
             if self.dev_ip and self._verify_mode(self.parameters["test_mode"]):
+                self._active_mode = self.parameters["test_mode"]
+                self._record_boot(True, start_time)
                 return
             else:
                 logger.warning("Failed to enter test mode")
 
+        self._record_boot(False, start_time)
         raise errors.AFTDeviceError("Could not set the device in test mode")
 
+    def _is_in_mode(self, mode):
+        """
+        Check whether the device is already running in the specified mode, so
+        that power cycling it can be skipped
+
+        Args:
+            mode (str): The mode we want to check for
+
+        Returns:
+            True if the device is in the desired mode, False otherwise
+        """
+        if self._force_reboot:
+            return False
+
+        ip_address = common.get_ip_in_mode(
+            self.dev_id,
+            self.parameters["leases_file_name"],
+            mode)
+        if not ip_address:
+            return False
+
+        logger.info("Device is already running in " + mode +
+                    " mode, skipping the power cycle.")
+        self.dev_ip = ip_address
+        self._active_mode = mode
+        return True
+
     def _verify_mode(self, mode):
         """
         Check that the device with given ip is responsive to ssh and is in the
@@ -535,7 +630,8 @@ class BeagleBoneBlackDevice(Device):
                     self.root_tarball,
                     "-C",
                     self.mount_dir],
-                timeout=self._ROOTFS_WRITING_TIMEOUT)
+                timeout=self._ROOTFS_WRITING_TIMEOUT,
+                max_output=self._ROOTFS_WRITING_OUTPUT_LIMIT)
 
         except subprocess32.CalledProcessError as err:
             common.log_subprocess32_error_and_abort(err)
@@ -565,14 +661,20 @@ class BeagleBoneBlackDevice(Device):
         ssh_directory = os.path.join(self.mount_dir, "home", "root", ".ssh")
         ssh_target = os.path.join(ssh_directory, "authorized_keys")
 
-        self._make_directory_over_ssh(ssh_directory)
-        self._copy_file_over_ssh(self.ssh_file, ssh_target)
+        batch = ssh.RemoteBatch(self.dev_ip)
+        batch.add(["mkdir", "-p", ssh_directory])
+        batch.add(["cp", self.ssh_file, ssh_target])
 
-        self._change_ownership_over_ssh(ssh_directory, 0, 0)
-        self._change_ownership_over_ssh(ssh_target, 0, 0)
+        batch.add(["chown", "0:0", ssh_directory])
+        batch.add(["chown", "0:0", ssh_target])
 
-        self._change_permissions_over_ssh(ssh_directory, "700")
-        self._change_permissions_over_ssh(ssh_target, "600")
+        batch.add(["chmod", "700", ssh_directory])
+        batch.add(["chmod", "600", ssh_target])
+
+        try:
+            batch.execute()
+        except subprocess32.CalledProcessError as err:
+            common.log_subprocess32_error_and_abort(err)
 
     def _wait_for_responsive_ip(self):
         """
@@ -653,23 +755,6 @@ class BeagleBoneBlackDevice(Device):
     # NOTE: SSH related methods might be better suited for the ssh.py module
     # Consider moving these
 
-    def _make_directory_over_ssh(self, directory):
-        """
-        Make directory safely over ssh or abort on failure
-
-        Args:
-            directory (str): The directory that will be created
-
-        Returns:
-            None
-
-        """
-        try:
-            ssh.remote_execute(self.dev_ip, ["mkdir", "-p", directory])
-        except subprocess32.CalledProcessError as err:
-            common.log_subprocess32_error_and_abort(err)
-
-
     def _copy_file_over_ssh(self, src, dst):
         """
         Copy file safely over ssh or abort on failure
@@ -686,34 +771,6 @@ class BeagleBoneBlackDevice(Device):
         except subprocess32.CalledProcessError as err:
             common.log_subprocess32_error_and_abort(err)
 
-    def _change_ownership_over_ssh(self, file_name, uid, gid):
-        """
-        Change file/directory ownership safely over ssh or abort on failure
-
-        Args:
-            file_name (str): The file which ownership is changed
-            uid (integer): owner id
-            gid (integer): group id
-
-        Returns:
-            None
-        """
-        try:
-            ssh.remote_execute(
-                self.dev_ip,
-                ["chown", str(uid) + ":" + str(gid), file_name])
-        except subprocess32.CalledProcessError as err:
-            common.log_subprocess32_error_and_abort(err)
-
-    def _change_permissions_over_ssh(self, file_name, permission):
-        """
-        Change file/directory permissions safely over ssh
-        """
-        try:
-            ssh.remote_execute(self.dev_ip, ["chmod", permission, file_name])
-        except subprocess32.CalledProcessError as err:
-            common.log_subprocess32_error_and_abort(err)
-
     def _mount(self, device_file):
         """
         Mounts a directory over ssh into self.mount_dir
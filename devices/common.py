@@ -22,6 +22,7 @@ the Device base class.
 import os
 import time
 import sys
+import sqlite3
 try:
     import subprocess32
 except ImportError:
@@ -29,7 +30,22 @@ except ImportError:
 
 from aft.logger import Logger as logger
 import aft.config as config
+import aft.errors as errors
+import aft.statestore as statestore
 import aft.tools.ssh as ssh
+import aft.tools.lease_watcher as lease_watcher
+
+# Seconds the ssh connection may take when checking whether a device is already
+# running in a mode. Devices that are powered off should not delay the boot.
+_MODE_CHECK_CONNECT_TIMEOUT = 3
+# Seconds the /proc/version read when the device became responsive is used for
+# verifying the mode of the device
+_KERNEL_VERSION_MAX_AGE = 10
+# Seconds between connection attempts after a device has got a new lease
+_SSH_START_POLLING_INTERVAL = 2
+
+# ip address -> (time, /proc/version contents) of the last readiness checks
+_kernel_versions = {}
 
 
 def wait_for_responsive_ip_for_pc_device(
@@ -55,15 +71,25 @@ def wait_for_responsive_ip_for_pc_device(
     logger.debug("Timeout: " + str(timeout))
     logger.debug("Polling interval: " + str(polling_interval))
 
-    for _ in range(timeout // polling_interval):
+    watcher = lease_watcher.get_lease_watcher(leases_file_path)
+    deadline = time.time() + timeout
+    while True:
         responsive_ip = get_ip_for_pc_device(mac_address, leases_file_path)
 
-        if not responsive_ip:
-            time.sleep(polling_interval)
-            continue
+        if responsive_ip:
+            logger.info("Got a response from " + responsive_ip)
+            return responsive_ip
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
 
-        logger.info("Got a response from " + responsive_ip)
-        return responsive_ip
+        # Retry as soon as the device gets a new lease. Once it has one, ssh
+        # is polled more often, as it starts soon after dhcp.
+        if watcher.wait_for_change(mac_address,
+                                   min(polling_interval, remaining)):
+            polling_interval = min(polling_interval,
+                                   _SSH_START_POLLING_INTERVAL)
 
     logger.info("No responsive ip was found")
 
@@ -72,7 +98,8 @@ def get_ip_for_pc_device(mac_address, leases_file_path):
     Return active ip address for PC like device that leases it through dnsmasq.
 
     Address is considered to be active if ssh connection can be made
-    successfully
+    successfully. The ssh ports of the leased addresses are probed first, and
+    the addresses that respond are connected to with ssh.
 
     Args:
         mac_address (str): Device mac address
@@ -85,13 +112,68 @@ def get_ip_for_pc_device(mac_address, leases_file_path):
     ip_addresses = get_leased_ip_addresses_for_mac(
         mac_address, leases_file_path)
 
-    for ip_address in ip_addresses:
-        if ssh.test_ssh_connectivity(ip_address):
+    for ip_address in ssh.probe_ssh_ports(ip_addresses):
+        if _read_kernel_version(ip_address) is not None:
+            return ip_address
+
+    return None
+
+
+def get_ip_in_mode(mac_address, leases_file_path, mode):
+    """
+    Return the ip address of a PC like device if it is already running in the
+    specified mode, for example because the previous job left it booted.
+
+    Args:
+        mac_address (str): Device mac address
+        leases_file_path (str): Path to dnsmasq leases file
+        mode (str): The mode the device should be in
+
+    Returns:
+        Device ip address as string or None if the device is not responsive
+        or is in another mode
+    """
+    ip_addresses = get_leased_ip_addresses_for_mac(
+        mac_address, leases_file_path)
+
+    for ip_address in ssh.probe_ssh_ports(ip_addresses):
+        kernel_version = _read_kernel_version(
+            ip_address, _MODE_CHECK_CONNECT_TIMEOUT)
+        if kernel_version is not None and mode in kernel_version:
+            logger.info("Found device in " + mode + " mode.")
             return ip_address
 
     return None
 
 
+def _read_kernel_version(ip_address, connect_timeout=10):
+    """
+    Read /proc/version of a device, which both checks that the device is
+    responsive to ssh and tells the mode it is in. The result is remembered
+    for verify_device_mode.
+
+    Args:
+        ip_address (str): The device ip address
+        connect_timeout (integer): Timeout of the ssh connection in seconds
+
+    Returns:
+        Contents of /proc/version, or None if the device is not responsive
+    """
+    try:
+        kernel_version = ssh.remote_execute(
+            ip_address,
+            ["cat", "/proc/version"],
+            connect_timeout=connect_timeout)
+    except (subprocess32.CalledProcessError,
+            subprocess32.TimeoutExpired) as err:
+        logger.warning("Could not establish ssh-connection to " + ip_address +
+                       ": " + str(err))
+        return None
+
+    _kernel_versions[ip_address] = (time.time(), kernel_version)
+    return kernel_version
+
+
 def get_leased_ip_addresses_for_mac(mac_address, leases_file_path):
     """
     Return list of ip addresses that have been leased for the device with the
@@ -105,8 +187,8 @@ def get_leased_ip_addresses_for_mac(mac_address, leases_file_path):
         List of ip addresses. Each ip address is a string.
     """
 
-    leases = get_mac_leases_from_dnsmasq(leases_file_path)
-    return [lease["ip"] for lease in leases if lease["mac"].lower() == mac_address.lower()]
+    return lease_watcher.get_lease_watcher(
+        leases_file_path).get_ip_addresses(mac_address)
 
 
 def get_mac_leases_from_dnsmasq(leases_file_path):
@@ -125,29 +207,12 @@ def get_mac_leases_from_dnsmasq(leases_file_path):
             "mac": "device_mac_address",
             "ip": "device_ip_address",
             "hostname": "device_host_name",
-            "client_id": "client_id_or_*_if_unset"
+            "client_id": "client_id_or_*_if_unset",
+            "expiry": lease_expiry_time_as_epoch_or_0_if_infinite
         }
 
     """
-
-    with open(leases_file_path) as lease_file:
-        leases = lease_file.readlines()
-
-    leases_list = []
-    # dnsmasq.leases contains rows with the following format:
-    # <lease_expiry_time_as_epoch_format> <mac> <ip> <hostname> <domain>
-    # See:
-    #http://lists.thekelleys.org.uk/pipermail/dnsmasq-discuss/2005q1/000143.html
-
-    for lease in leases:
-        lease = lease.split()
-        leases_list.append({
-            "mac": lease[1],
-            "ip": lease[2],
-            "hostname": lease[3],
-            "client_id": lease[4],
-        })
-    return leases_list
+    return lease_watcher.get_lease_watcher(leases_file_path).get_leases()
 
 def log_subprocess32_error_and_abort(err):
     """
@@ -190,50 +255,166 @@ def verify_device_mode(ip, mode):
     Returns:
         True if the device is in the desired mode, False otherwise
     """
-    try:
-        sshout = ssh.remote_execute(ip, ["cat", "/proc/version"])
-        if mode in sshout:
-            logger.info("Found device in " + mode + " mode.")
-            return True
-        logger.info("Device is not in " + mode + " mode")
-        logger.debug("/cat/proc/version: " + str(sshout))
-        return False
-    except subprocess32.CalledProcessError as err:
-        logger.warning(
-            "Failed verifying the device mode with command: '" +
-            str(err.cmd) + "' failed with error code: '" +
-            str(err.returncode) + "' and output: '" +
-            str(err.output) + "'.")
+    # The device was typically found responsive just before, and the
+    # /proc/version read then can be used instead of connecting again
+    checked_at, sshout = _kernel_versions.pop(ip, (0, None))
+    if (sshout is None or
+            time.time() - checked_at >= _KERNEL_VERSION_MAX_AGE):
+        try:
+            sshout = ssh.remote_execute(ip, ["cat", "/proc/version"])
+        except subprocess32.CalledProcessError as err:
+            logger.warning(
+                "Failed verifying the device mode with command: '" +
+                str(err.cmd) + "' failed with error code: '" +
+                str(err.returncode) + "' and output: '" +
+                str(err.output) + "'.")
+
+            return False
+
+    if mode in sshout:
+        logger.info("Found device in " + mode + " mode.")
+        return True
+    logger.info("Device is not in " + mode + " mode")
+    logger.debug("/cat/proc/version: " + str(sshout))
+    return False
+
+
+
+def blacklist_device(dev_id, name, reason, ttl=None):
+    """
+    Blacklist the device with given id
+
+    Args:
+        dev_id (str): The device id
+        name (str): The human readable device name
+        reason (str): Reason for blacklisting
+        ttl (integer): Seconds after which the device returns to the pool. If
+            None, config.BLACKLIST_TTL is used. 0 blacklists the device
+            until it is unblacklisted.
+
+    Returns:
+        None
+    """
+    if ttl is None:
+        ttl = get_blacklist_ttl()
 
-        return False
+    failures = statestore.get_store().blacklist(dev_id, name, reason, ttl)
+    if failures > 1:
+        logger.info("Device " + name + " has been blacklisted " +
+                    str(failures) + " times in a row")
 
+def record_device_event(dev_id, event, success, duration=None):
+    """
+    Add an event to the history of the device with given id. The history is
+    used to prefer the devices that produce results fastest.
 
+    Args:
+        dev_id (str): The device id
+        event (str): Kind of the event, e.g. "flash", "boot" or "check"
+        success (boolean): Whether the operation succeeded
+        duration (float): Duration of the operation in seconds
 
-def blacklist_device(dev_id, name, reason):
+    Returns:
+        None
     """
-    Blacklist the device with given id
+    statestore.get_store().record_event(dev_id, event, success, duration)
+
+def renew_lease(dev_id, phase=None):
+    """
+    Renew the lease of the reservation of the device with given id. Jobs
+    call this as they make progress, so that their reservation is not
+    reclaimed as hung. Failing to renew the lease is logged, but is not an
+    error.
 
     Args:
         dev_id (str): The device id
-        name (str): The human readable device name
-        reason (str): Reason for blacklisting
+        phase (str): The phase the job has entered, as shown by
+            'aft --status', or None if unchanged
 
     Returns:
         None
     """
+    try:
+        if not statestore.get_store().renew(dev_id, phase):
+            logger.warning("Device " + dev_id + " is no longer reserved by " +
+                           "this process")
+    except (errors.AFTConfigurationError, sqlite3.Error) as err:
+        logger.warning("Failed to renew the lease of device " + dev_id +
+                       ": " + str(err))
+
+def get_lease_time():
+    """
+    Return the configured lease time of reservations
+
+    Returns:
+        The time in seconds (float), 0 if leases do not expire
+
+    Raises:
+        aft.errors.AFTConfigurationError if the value is invalid
+    """
+    try:
+        lease_time = float(config.LEASE_TIME or 0)
+    except ValueError:
+        raise errors.AFTConfigurationError(
+            "Invalid lease_time '" + str(config.LEASE_TIME) + "'")
+
+    if lease_time < 0:
+        raise errors.AFTConfigurationError("lease_time must not be negative")
+
+    return lease_time
+
+def get_warm_pool_size():
+    """
+    Return the configured maximum number of warm idle devices per model
+
+    Returns:
+        The number of devices (integer), 0 if the warm pool is disabled
+
+    Raises:
+        aft.errors.AFTConfigurationError if the value is invalid
+    """
+    try:
+        pool_size = int(config.WARM_POOL_SIZE or 0)
+    except ValueError:
+        raise errors.AFTConfigurationError(
+            "Invalid warm_pool_size '" + str(config.WARM_POOL_SIZE) + "'")
+
+    if pool_size < 0:
+        raise errors.AFTConfigurationError(
+            "warm_pool_size must not be negative")
+
+    return pool_size
+
+def get_blacklist_ttl():
+    """
+    Return the configured expiry time of automatic blacklisting
+
+    Returns:
+        The time in seconds (float), 0 if blacklisting does not expire
+
+    Raises:
+        aft.errors.AFTConfigurationError if the value is invalid
+    """
+    try:
+        ttl = float(config.BLACKLIST_TTL or 0)
+    except ValueError:
+        raise errors.AFTConfigurationError(
+            "Invalid blacklist_ttl '" + str(config.BLACKLIST_TTL) + "'")
+
+    if ttl < 0:
+        raise errors.AFTConfigurationError(
+            "blacklist_ttl must not be negative")
 
-    with open(config.DEVICE_BLACKLIST, "a") as blacklist_file:
-        blacklist_file.write(dev_id + " " + name + " " + reason + "\n")
+    return ttl
 
 def unblacklist_device(dev_id):
-    lines = []
-    with open(config.DEVICE_BLACKLIST, "r") as device_blacklist:
-        for line in device_blacklist:
-            if line.split()[0] == dev_id:
-                continue
-            lines.append(line)
+    """
+    Remove the device with given id from the blacklist
 
+    Args:
+        dev_id (str): The device id
 
-    with open(config.DEVICE_BLACKLIST, "w") as device_blacklist:
-        for line in lines:
-            device_blacklist.write(line)
+    Returns:
+        None
+    """
+    statestore.get_store().unblacklist(dev_id)
@@ -20,14 +20,21 @@ Class representing a DUT.
 
 import threading
 import abc
+import time
 
 from time import sleep
 import os
 from six import with_metaclass
+try:
+    import subprocess32
+except ImportError:
+    import subprocess as subprocess32
 
 from aft.tools.thread_handler import Thread_handler as thread_handler
 import aft.tools.serialrecorder as serialrecorder
 import aft.errors as errors
+import aft.devices.common as common
+import aft.tools.ssh as ssh
 from aft.logger import Logger as logger
 
 class Device(with_metaclass(abc.ABCMeta, object)):
@@ -36,6 +43,14 @@ class Device(with_metaclass(abc.ABCMeta, object)):
     """
 
     _POWER_CYCLE_DELAY = 10
+    # Seconds a device rebooted over ssh may take to stop answering
+    _SOFT_REBOOT_TIMEOUT = 60
+    # Connect timeout of the ssh probes while waiting for the device to go down
+    _SOFT_REBOOT_POLLING_INTERVAL = 3
+
+    # Whether the device can be booted into service mode before the image is
+    # known, and left there for the next job by the warm pool
+    WARM_BOOT = False
 
     def __init__(self, device_descriptor, channel):
         self.name = device_descriptor["name"]
@@ -44,6 +59,19 @@ class Device(with_metaclass(abc.ABCMeta, object)):
         self.test_plan = device_descriptor["test_plan"]
         self.parameters = device_descriptor
         self.channel = channel
+        # Name of the mode (service/test) the device has been booted into by
+        # this process, or None if unknown
+        self._active_mode = None
+        # Whether the device must be rebooted before it is used, even if it
+        # seems to be in the right mode, e.g. after a failed flash
+        self._force_reboot = False
+        # Address the device was last reached at, or None
+        self.dev_ip = None
+        # Devices reserved together with this device by
+        # DevicesManager.reserve_many() ('aft --devices'), including this
+        # device. Test cases that need several devices find the other devices
+        # here.
+        self.group = [self]
 
     @abc.abstractmethod
     def write_image(self, file_name):
@@ -51,6 +79,49 @@ class Device(with_metaclass(abc.ABCMeta, object)):
         Writes the specified image to the device.
         """
 
+    # The following methods split write_image and test mode entry into steps
+    # that can be scheduled separately. Devices that cannot be split only
+    # override write_image, which is then executed as the flash step.
+
+    def prepare_image(self, file_name):
+        """
+        Prepare the image files on the testing harness before the device is
+        booted for flashing.
+
+        Args:
+            file_name (str): The image file name
+        """
+        pass
+
+    def enter_service_mode(self):
+        """
+        Boot the device into the mode used for flashing.
+        """
+        pass
+
+    def flash(self, file_name):
+        """
+        Write the prepared image to the device, which has been booted into
+        service mode.
+
+        Args:
+            file_name (str): The image file name
+        """
+        self.write_image(file_name)
+
+    def enter_test_mode(self):
+        """
+        Boot the device into the flashed image before running the tests.
+        """
+        pass
+
+    def get_active_mode(self):
+        """
+        Return the name of the mode the device has been booted into, or None
+        if unknown
+        """
+        return self._active_mode
+
     def record_serial(self):
         """
         Start a serialrecorder.py subprocess and add its killer
@@ -163,6 +234,9 @@ class Device(with_metaclass(abc.ABCMeta, object)):
         """
         Open the associated cutter channel.
         """
+        self._active_mode = None
+        if self.dev_ip:
+            ssh.close_session(self.dev_ip)
         self.channel.disconnect()
 
     def attach(self):
@@ -193,10 +267,77 @@ class Device(with_metaclass(abc.ABCMeta, object)):
         Reboot the device.
         """
         logger.info("Rebooting the device.")
+        self._active_mode = None
+        self._force_reboot = False
         self.detach()
         sleep(self._POWER_CYCLE_DELAY)
         self.attach()
 
+    def _reboot(self, allow_soft_reboot=True):
+        """
+        Reboot the device over ssh if it is responsive, and through the cutter
+        if it is not or if the soft reboot fails. Soft reboots avoid wearing
+        the relays and the storage of the device.
+
+        Args:
+            allow_soft_reboot (boolean): False to power cycle the device
+                unconditionally, e.g. when a soft reboot did not bring the
+                device up in the expected mode
+        """
+        if allow_soft_reboot and self._soft_reboot():
+            return
+        self._power_cycle()
+
+    def _soft_reboot(self):
+        """
+        Run the reboot command over ssh and wait for the device to go down.
+
+        Returns:
+            True if the device went down, False if it was not responsive or
+            did not go down in time
+        """
+        ip_address = self.get_ip()
+        if not ip_address:
+            return False
+
+        logger.info("Rebooting the device over ssh.")
+        self._active_mode = None
+        self._force_reboot = False
+        try:
+            # ssh fails with 255 if the connection drops before the command
+            # returns
+            ssh.remote_execute(ip_address, ["reboot"],
+                               ignore_return_codes=[255])
+        except (subprocess32.CalledProcessError,
+                subprocess32.TimeoutExpired) as err:
+            logger.warning("Soft reboot failed: " + str(err))
+            return False
+        finally:
+            ssh.close_session(ip_address)
+
+        deadline = time.time() + self._SOFT_REBOOT_TIMEOUT
+        while time.time() < deadline:
+            if not ssh.test_ssh_connectivity(
+                    ip_address, self._SOFT_REBOOT_POLLING_INTERVAL):
+                return True
+            sleep(self._SOFT_REBOOT_POLLING_INTERVAL)
+
+        logger.warning("Device did not go down after the soft reboot.")
+        return False
+
+    def _record_boot(self, success, start_time):
+        """
+        Record a boot to test mode in the device history, and renew the lease
+        of the reservation
+
+        Args:
+            success (boolean): Whether the device booted
+            start_time (float): Time the boot was started at
+        """
+        common.record_device_event(self.dev_id, "boot", success,
+                                   time.time() - start_time)
+        common.renew_lease(self.dev_id, "test_mode" if success else None)
+
 
     def __eq__(self, comp):
         return self.dev_id == comp.dev_id
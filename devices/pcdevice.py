@@ -19,6 +19,7 @@ Class representing a PC-like Device with an IP.
 
 import os
 import json
+import time
 from multiprocessing import Process, Queue
 
 from aft.logger import Logger as logger
@@ -74,6 +75,7 @@ class PCDevice(Device):
     _IMG_NFS_MOUNT_POINT = "/mnt/img_data_nfs"
     _ROOT_PARTITION_MOUNT_POINT = "/mnt/target_root/"
     _SUPER_ROOT_MOUNT_POINT = "/mnt/super_target_root/"
+    WARM_BOOT = True
 
 
     def __init__(self, parameters, channel):
@@ -135,16 +137,44 @@ class PCDevice(Device):
         # The config.NFS_FOLDER path is exported as nfs and mounted remotely as
         # _IMG_NFS_MOUNT_POINT
 
+        self.enter_service_mode()
+        self.flash(file_name)
+
+    def enter_service_mode(self):
+        """
+        Boot the device into the service OS.
+
+        Returns:
+            None
+        """
+        self._enter_mode(self._service_mode)
+
+    def flash(self, file_name):
+        """
+        Write the image to the device, which has been booted into service mode
+
+        Args:
+            file_name (str):
+                The file name of the image that will be flashed on the device
+
+        Returns:
+            None
+        """
         # Bubblegum fix to support both .hddimg and .hdddirect at the same time
         self._uses_hddimg = os.path.splitext(file_name)[-1] == ".hddimg"
 
-        self._enter_mode(self._service_mode)
         file_on_nfs = os.path.abspath(file_name).replace(
             config.NFS_FOLDER,
             self._IMG_NFS_MOUNT_POINT)
 
-        self._flash_image(nfs_file_name=file_on_nfs, filename=file_name)
-        self._install_tester_public_key(file_name)
+        try:
+            self._flash_image(nfs_file_name=file_on_nfs, filename=file_name)
+            self._install_tester_public_key(file_name)
+        except:
+            # the device state is unknown, so force a reboot on retry
+            self._active_mode = None
+            self._force_reboot = True
+            raise
 
     def _run_tests(self, test_case):
         """
@@ -157,9 +187,18 @@ class PCDevice(Device):
             The return value of the test_case run()-method
             (implementation class specific)
         """
-        self._enter_mode(self._test_mode)
+        self.enter_test_mode()
         return test_case.run(self)
 
+    def enter_test_mode(self):
+        """
+        Boot the device into the flashed image.
+
+        Returns:
+            None
+        """
+        self._enter_mode(self._test_mode)
+
     def get_ip(self):
         """
         Returns device ip address
@@ -187,14 +226,36 @@ class PCDevice(Device):
             PEM fails to connect
 
         """
+        if self._active_mode == mode["name"]:
+            logger.info("Device already in " + mode["name"] + " mode.")
+            return
+
+        ip_address = None
+        if not self._force_reboot:
+            ip_address = common.get_ip_in_mode(
+                self.dev_id,
+                self.parameters["leases_file_name"],
+                mode["name"])
+        if ip_address:
+            logger.info("Device is already running in " + mode["name"] +
+                        " mode, skipping the power cycle.")
+            self.dev_ip = ip_address
+            self._active_mode = mode["name"]
+            if mode is self._test_mode:
+                common.renew_lease(self.dev_id, "test_mode")
+            return
+
         # Sometimes booting to a mode fails.
 
         logger.info(
             "Trying to enter " + mode["name"] + " mode up to " +
             str(self._RETRY_ATTEMPTS) + " times.")
 
-        for _ in range(self._RETRY_ATTEMPTS):
-            self._power_cycle()
+        start_time = time.time()
+        for attempt in range(self._RETRY_ATTEMPTS):
+            # Retries power cycle the device, in case the soft reboot is what
+            # failed
+            self._reboot(allow_soft_reboot=attempt == 0)
 
             logger.info(
                 "Executing PEM with keyboard sequence " + mode["sequence"])
@@ -205,6 +266,9 @@ class PCDevice(Device):
 
             if ip_address:
                 if self._verify_mode(mode["name"]):
+                    self._active_mode = mode["name"]
+                    if mode is self._test_mode:
+                        self._record_boot(True, start_time)
                     return
             else:
                 logger.warning("Failed entering " + mode["name"] + " mode.")
@@ -213,6 +277,9 @@ class PCDevice(Device):
             "Unable to get device " + self.dev_id + " in mode " +
             mode["name"])
 
+        if mode is self._test_mode:
+            self._record_boot(False, start_time)
+
         raise errors.AFTDeviceError(
             "Could not set the device in mode " + mode["name"])
 
@@ -333,11 +400,13 @@ class PCDevice(Device):
         # removal and re-creation of /dev/disk/by-partuuid/ files. This sequence
         # either delays enough or actually settles it.
         logger.info("Partprobing.")
-        ssh.remote_execute(self.dev_ip, ["partprobe", self._target_device])
-        ssh.remote_execute(self.dev_ip, ["sync"])
-        ssh.remote_execute(self.dev_ip, ["udevadm", "trigger"])
-        ssh.remote_execute(self.dev_ip, ["udevadm", "settle"])
-        ssh.remote_execute(self.dev_ip, ["udevadm", "control", "-S"])
+        batch = ssh.RemoteBatch(self.dev_ip)
+        batch.add(["partprobe", self._target_device])
+        batch.add(["sync"])
+        batch.add(["udevadm", "trigger"])
+        batch.add(["udevadm", "settle"])
+        batch.add(["udevadm", "control", "-S"])
+        batch.execute()
 
     def _mount_single_layer(self, image_file_name):
         """
@@ -442,78 +511,34 @@ class PCDevice(Device):
                 "sed", "-e",
                 '"s/:.*//"']).rstrip().lstrip("/")
 
-        # Ignore return value: directory might exist
-        logger.info("Writing ssh-key to device.")
-        ssh.remote_execute(
-            self.dev_ip,
-            [
-                "mkdir",
-                os.path.join(
-                    self._ROOT_PARTITION_MOUNT_POINT,
-                    root_user_home,
-                    ".ssh")
-            ],
-            ignore_return_codes=[1])
-
-        ssh.remote_execute(
-            self.dev_ip,
-            [
-                "chmod",
-                "700",
-                os.path.join(
-                    self._ROOT_PARTITION_MOUNT_POINT,
-                    root_user_home,
-                    ".ssh")
-            ])
-
-        ssh.remote_execute(
-            self.dev_ip,
-            [
-                "cat",
-                "~/.ssh/authorized_keys",
-                ">>",
-                os.path.join(
-                    self._ROOT_PARTITION_MOUNT_POINT,
-                    root_user_home,
-                    ".ssh/authorized_keys")])
+        ssh_directory = os.path.join(
+            self._ROOT_PARTITION_MOUNT_POINT,
+            root_user_home,
+            ".ssh")
+        authorized_keys = os.path.join(ssh_directory, "authorized_keys")
 
-        ssh.remote_execute(
-            self.dev_ip,
-            [
-                "chmod",
-                "600",
-                os.path.join(
-                    self._ROOT_PARTITION_MOUNT_POINT,
-                    root_user_home,
-                    ".ssh/authorized_keys")
-            ])
+        logger.info("Writing ssh-key to device.")
+        batch = ssh.RemoteBatch(self.dev_ip)
+        # Ignore return value: directory might exist
+        batch.add(["mkdir", ssh_directory], ignore_return_codes=[1])
+        batch.add(["chmod", "700", ssh_directory])
+        batch.add(["cat", "~/.ssh/authorized_keys", ">>", authorized_keys])
+        batch.add(["chmod", "600", authorized_keys])
 
         if not self._uses_hddimg:
-            logger.info("Adding IMA attribute to the ssh-key")
-            ssh.remote_execute(
-                self.dev_ip,
-                [
-                    "setfattr",
-                    "-n",
-                    "security.ima",
-                    "-v",
-                    "0x01`sha1sum " +
-                    os.path.join(
-                        self._ROOT_PARTITION_MOUNT_POINT,
-                        root_user_home,
-                        ".ssh/authorized_keys") + " | cut '-d ' -f1`",
-                    os.path.join(
-                        self._ROOT_PARTITION_MOUNT_POINT,
-                        root_user_home,
-                        ".ssh/authorized_keys")
-                ])
-
-        logger.info("Flushing.")
-        ssh.remote_execute(self.dev_ip, ["sync"])
-
-        logger.info("Unmounting.")
-        ssh.remote_execute(
-            self.dev_ip, ["umount", self._ROOT_PARTITION_MOUNT_POINT])
+            # Add the IMA attribute to the ssh-key
+            batch.add([
+                "setfattr",
+                "-n",
+                "security.ima",
+                "-v",
+                "0x01`sha1sum " + authorized_keys + " | cut '-d ' -f1`",
+                authorized_keys])
+
+        # Flush and unmount
+        batch.add(["sync"])
+        batch.add(["umount", self._ROOT_PARTITION_MOUNT_POINT])
+        batch.execute()
 
     def execute(self, command, timeout, user="root", verbose=False):
         """
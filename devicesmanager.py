@@ -23,16 +23,217 @@ except ImportError:
 import time
 import atexit
 import os
-import sys
 import fcntl
-import errno
+import signal
+import json
+import heapq
+import math
+import threading
 
 import aft.errors as errors
 import aft.config as config
 import aft.devicefactory as devicefactory
+import aft.configcache as configcache
 import aft.devices.common as common
+import aft.statestore as statestore
+from aft.tools.lock_watcher import LockWatcher, IN_MODIFY, IN_DELETE, \
+    IN_CLOSE_WRITE
 from aft.logger import Logger as logger
 
+# Waiters are woken up when the state database changes. As a reservation held
+# by a process that died is only removed when a reservation is attempted,
+# devices are also polled with this interval (seconds).
+_POLL_INTERVAL = 10
+
+# Devices whose flashing success rate is lower are treated as having this rate
+_MIN_SUCCESS_RATE = 0.1
+# Failures within this period (seconds) count as an extra attempt
+_RECENT_FAILURE_PERIOD = 3600
+# Minimum cost of an extra attempt (seconds)
+_MIN_RETRY_COST = 60
+# Devices whose expected time to results is within this ratio, or within
+# _SIMILAR_TIME seconds, of the best device are considered equally good, and
+# the least recently used of them is preferred to spread the wear
+_SIMILAR_RATIO = 1.1
+_SIMILAR_TIME = 30
+# Jobs that have been running for longer than usual are expected to finish
+# within this fraction of the usual job time
+_OVERRUN_FRACTION = 0.1
+
+# The warm pool keeps enough devices warm for the jobs expected within
+# _DEMAND_WINDOW seconds, at the rate of reservations over the last
+# _DEMAND_PERIOD seconds
+_DEMAND_WINDOW = 600
+_DEMAND_PERIOD = 3600
+# Seconds between the renewals of the lease of a device that is being warmed
+_WARM_RENEW_INTERVAL = 30
+
+
+class _ReservationQueue(object):
+    """
+    First come, first served queue of the processes waiting for a device of
+    the same model, or for the same specific device.
+
+    Each waiter holds a ticket file in the queue directory, named after its
+    arrival time, and keeps the ticket flocked while waiting. Only the waiter
+    with the oldest ticket tries to lock devices. Tickets of processes that
+    died are detected by their flock being free and are removed.
+    """
+
+    def __init__(self, name):
+        """
+        Constructor
+
+        Args:
+            name (str): Device model or name that is waited for
+        """
+        self.directory = os.path.join(config.LOCK_FILE,
+                                      "aft_queue_" + name.lower())
+        self._ticket = None
+        self._ticket_file = None
+
+    def enter(self, ticket=None):
+        """
+        Take a ticket at the end of the queue
+
+        Args:
+            ticket (str): Ticket taken from another queue. A process waiting
+                in several queues uses the same ticket in all of them, so
+                that the waiters are in the same order in every queue and
+                cannot wait for each other.
+
+        Returns:
+            The ticket (str)
+        """
+        common.make_directory(self.directory)
+
+        if ticket is None:
+            ticket = "{0:017.6f}_{1}".format(time.time(), os.getpid())
+        # The ticket is locked before it is visible to the other waiters, as
+        # they consider tickets without a lock stale
+        temp_path = os.path.join(self.directory, "." + ticket)
+        self._ticket_file = os.fdopen(os.open(temp_path,
+                                              os.O_WRONLY | os.O_CREAT, 0o660),
+                                      "w")
+        fcntl.flock(self._ticket_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(temp_path, os.path.join(self.directory, ticket))
+        self._ticket = ticket
+        return ticket
+
+    def leave(self):
+        """
+        Remove the ticket from the queue
+        """
+        if self._ticket is None:
+            return
+
+        try:
+            os.unlink(os.path.join(self.directory, self._ticket))
+        except OSError:
+            pass
+        self._ticket_file.close()
+        self._ticket = None
+        self._ticket_file = None
+
+    def position(self):
+        """
+        Return the number of live waiters ahead of this process, or the
+        number of all the live waiters if this process is not in the queue
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+
+        position = 0
+        for ticket in sorted(os.listdir(self.directory)):
+            if ticket == self._ticket:
+                break
+            if ticket.startswith("."):
+                continue
+            if self._is_live(ticket):
+                position += 1
+
+        return position
+
+    def _is_live(self, ticket):
+        """
+        Check if the owner of the ticket is still waiting. Stale tickets are
+        removed.
+        """
+        path = os.path.join(self.directory, ticket)
+        try:
+            ticket_file = open(path, "r")
+        except IOError:
+            return False
+
+        try:
+            fcntl.flock(ticket_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError:
+            return True
+        finally:
+            ticket_file.close()
+
+        logger.info("Removing stale reservation ticket " + path)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return False
+
+    def watch(self):
+        """
+        Return a LockWatcher that wakes up when the state database changes,
+        e.g. when a device is released, or when a waiter leaves the queue
+        """
+        return _watch_queues([self])
+
+
+def _watch_queues(queues):
+    """
+    Return a LockWatcher that wakes up when the state database changes, or
+    when a waiter leaves any of the queues
+
+    Args:
+        queues (list(_ReservationQueue)): The queues
+    """
+    database_directory = os.path.dirname(
+        os.path.abspath(statestore.get_store().path))
+    return LockWatcher([(database_directory, IN_MODIFY | IN_DELETE)] +
+                       [(queue.directory, IN_DELETE | IN_CLOSE_WRITE)
+                        for queue in queues])
+
+
+def parse_device_spec(spec):
+    """
+    Parse the specification of a group of devices
+
+    Args:
+        spec (str): Plus separated COUNTxMODEL terms, e.g.
+            "2xMinnowboardMAX + 1xEdison". The count defaults to 1. "*" and
+            the multiplication sign can be used instead of "x".
+
+    Returns:
+        List of (lowercase model, count) tuples
+
+    Raises:
+        aft.errors.AFTConfigurationError if the specification is malformed
+    """
+    groups = []
+    for term in spec.replace(u"\u00d7", "x").replace("*", "x").split("+"):
+        term = term.strip()
+        count, separator, model = term.partition("x")
+        if not separator or not count.strip().isdigit():
+            count, model = "1", term
+
+        model = model.strip().lower()
+        if model == "" or int(count) < 1:
+            raise errors.AFTConfigurationError(
+                "Invalid device specification '" + spec + "'")
+
+        groups.append((model, int(count)))
+
+    return groups
+
+
 class DevicesManager(object):
     """Class handling devices connected to the same host PC"""
 
@@ -40,7 +241,7 @@ class DevicesManager(object):
 
     # Construct all device objects of the correct machine type based on the topology config file.
     # args = parsed command line arguments
-    def __init__(self, args):
+    def __init__(self, args, device_configs=None):
         """
         Constructor
 
@@ -50,12 +251,35 @@ class DevicesManager(object):
         Args:
             args (argparse namespace argument object):
                 Command line arguments, as parsed by argparse
+            device_configs (list(dictionary)):
+                Already constructed device configurations, as returned by
+                get_configs(). If None, configurations are read from the
+                configuration files.
         """
 
         self._args = args
-        self._lockfiles = []
-        self.device_configs = self._construct_configs()
+        self._store = statestore.get_store()
+        if device_configs is None:
+            device_configs = self._construct_configs()
+        self.device_configs = device_configs
+
+        # Indexes of the device configurations by lowercase model, lowercase
+        # name and id. Every device must have an id, which the reservations,
+        # the blacklist and the device history are keyed by.
+        self._configs_by_model = {}
+        self._configs_by_name = {}
+        self._configs_by_id = {}
+        for device_config in device_configs:
+            if "id" not in device_config["settings"]:
+                raise errors.AFTConfigurationError(
+                    "Device " + device_config["name"] + " has no id")
 
+            self._configs_by_model.setdefault(
+                device_config["model"].lower(), []).append(device_config)
+            self._configs_by_name[device_config["name"].lower()] = \
+                device_config
+            self._configs_by_id[device_config["settings"]["id"]] = \
+                device_config
 
     def _construct_configs(self):
         """
@@ -78,6 +302,33 @@ class DevicesManager(object):
             catalog\platform entries are not device specific, but these are
             duplicated for each device for ease of access.
 
+            The merged configurations are cached by aft.configcache and the
+            files are only parsed again when any of them has changed.
+        """
+        configs = configcache.load("devices", self.get_config_files(),
+                                   self._parse_configs)
+
+        # Settings from aft.cfg are added after loading, as aft.cfg is not
+        # one of the files the snapshot is built from
+        for device_config in configs:
+            device_config["settings"]["serial_log_name"] = \
+                config.SERIAL_LOG_NAME
+
+        logger.info("Built configuration sets for " + str(len(configs)) +
+                     " devices")
+
+        return configs
+
+    def _parse_configs(self):
+        """
+        Parse and merge the platform, catalog and topology files
+
+        Returns:
+            List of device configurations, as returned by _construct_configs()
+
+        Raises:
+            aft.errors.AFTConfigurationError if no device configurations were
+            found
         """
         platform_config_file = self.__PLATFORM_FILE_NAME
         catalog_config_file = self._args.catalog
@@ -111,7 +362,6 @@ class DevicesManager(object):
             settings.update(device_entry)
 
             settings["name"] = device_title.lower()
-            settings["serial_log_name"] = config.SERIAL_LOG_NAME
 
             device_param = {}
             device_param["name"] = device_title.lower()
@@ -126,60 +376,158 @@ class DevicesManager(object):
                 "Check that paths for topology, catalog and platform files "
                 "are correct and that the files have some settings inside")
 
-
-        logger.info("Built configuration sets for " + str(len(configs)) +
-                     " devices")
-
         return configs
 
-    def _construct_blacklist(self):
+    def reserve(self, timeout = 3600, model=None):
         """
-        Construct device blacklisting
+        Reserve and lock a device and return it
 
         Args:
-            None
-
-        Returns:
-            List of dictionaries, where dictionaries have the following format:
-            {
-                "id": "device_id",
-                "name": "device_name",
-                "reason": "reason for blacklisting"
-            }
+            timeout (integer): Timeout in seconds
+            model (str): Device model. Defaults to the machine given in the
+                command line arguments
         """
-        blacklist = []
-        with open(config.DEVICE_BLACKLIST, "r") as blacklist_file:
-            for line in blacklist_file:
-                values = line.split()
+        if model is None:
+            model = self._args.machine
 
-                reason = ""
-                for i in range(2, len(values)):
-                    reason += values[i] + " "
-                blacklist.append(
-                    {
-                        "id": values[0],
-                        "name": values[1],
-                        "reason": reason.strip()
-                    })
+        if self._args.prefer_fastest_model:
+            model = self._choose_fastest_model(model)
 
-        return blacklist
+        device_configs = self._remove_blacklisted_configs(
+            self._configs_by_model.get(model.lower(), []))
+        device_configs = self._order_by_health(device_configs)
+        return self._do_reserve(device_configs, model, timeout)
 
-    def reserve(self, timeout = 3600):
-        """
-        Reserve and lock a device and return it
+    def _choose_fastest_model(self, model):
         """
+        Choose the model expected to have a free device first among the
+        model and the models listed in its equivalent_models catalog option
 
-        devices = []
+        Args:
+            model (str): The requested model
 
-        for device_config in self.device_configs:
-            if device_config["model"].lower() == self._args.machine.lower():
-                cutter = devicefactory.build_cutter(device_config["settings"])
-                device = devicefactory.build_device(device_config["settings"], cutter)
-                devices.append(device)
+        Returns:
+            The chosen model (str). The requested model is preferred when the
+            waits are equal or cannot be estimated.
+        """
+        models = [model.lower()]
+        for device_config in self._configs_by_model.get(model.lower(), []):
+            for equivalent in device_config["settings"].get(
+                    "equivalent_models", "").split(","):
+                equivalent = equivalent.strip().lower()
+                if equivalent and equivalent not in models:
+                    models.append(equivalent)
+
+        if len(models) == 1:
+            return model
+
+        estimates = []
+        for candidate in models:
+            device_configs = self._configs_by_model.get(candidate, [])
+            blacklisted = set([entry["id"] for entry in
+                               self._store.get_blacklist(
+                                   [device_config["settings"]["id"]
+                                    for device_config in device_configs])])
+            device_configs = [device_config for device_config in device_configs
+                              if device_config["settings"]["id"] not in
+                              blacklisted]
+            if len(device_configs) == 0:
+                continue
+
+            estimate = self._estimate_wait(
+                device_configs, _ReservationQueue(candidate).position())
+            logger.info("Estimated wait for " + candidate + ": " +
+                        (_format_duration(estimate) if estimate is not None
+                         else "unknown"))
+            estimates.append((estimate is None, estimate,
+                              candidate != models[0], candidate))
+
+        if len(estimates) == 0:
+            return model
+
+        _, estimate, _, chosen = min(estimates)
+        if chosen == models[0]:
+            return model
+
+        msg = "Rerouting the job from " + model + " to " + chosen
+        if estimate is not None:
+            msg += " (estimated wait " + _format_duration(estimate) + ")"
+        logger.info(msg)
+        print(msg)
+        return chosen
+
+    def _order_by_health(self, device_configs):
+        """
+        Order the device configurations by the expected time to results,
+        estimated from the device history.
+
+        The expected time is the median flashing time divided by the
+        flashing success rate, plus the median boot time, plus the cost of
+        one more attempt if the device has failed recently. Devices without
+        history are assumed to be as fast as the median of the devices with
+        history. Among devices with similar expected times, the least recently
+        used devices come first.
 
-        devices = self._remove_blacklisted_devices(devices)
+        Args:
+            device_configs (list(dictionary)): The device configurations
 
-        return self._do_reserve(devices, self._args.machine, timeout)
+        Returns:
+            The device configurations in the order of preference
+        """
+        if len(device_configs) < 2:
+            return device_configs
+
+        health = self._store.get_health(
+            [device_config["settings"]["id"]
+             for device_config in device_configs])
+
+        default_times = {}
+        for key in ("flash_time", "boot_time"):
+            times = sorted([entry[key] for entry in health.values()
+                            if entry[key] is not None])
+            default_times[key] = times[len(times) // 2] if times else 0
+
+        now = time.time()
+        expected_times = {}
+        for device_id, entry in health.items():
+            flash_time = entry["flash_time"]
+            if flash_time is None:
+                flash_time = default_times["flash_time"]
+            boot_time = entry["boot_time"]
+            if boot_time is None:
+                boot_time = default_times["boot_time"]
+
+            success_rate = entry["flash_success_rate"]
+            if success_rate is None:
+                success_rate = 1.0
+
+            expected_time = (flash_time / max(success_rate, _MIN_SUCCESS_RATE) +
+                             boot_time)
+            if entry["last_failure"] and \
+                    now - entry["last_failure"] < _RECENT_FAILURE_PERIOD:
+                expected_time += max(flash_time + boot_time, _MIN_RETRY_COST)
+
+            expected_times[device_id] = expected_time
+
+        def _get_expected_time(device_config):
+            return expected_times[device_config["settings"]["id"]]
+
+        def _get_last_used(device_config):
+            return health[device_config["settings"]["id"]]["last_used"] or 0
+
+        device_configs = sorted(device_configs, key=_get_expected_time)
+        limit = max(_get_expected_time(device_configs[0]) * _SIMILAR_RATIO,
+                    _get_expected_time(device_configs[0]) + _SIMILAR_TIME)
+
+        similar = [device_config for device_config in device_configs
+                   if _get_expected_time(device_config) <= limit]
+        others = device_configs[len(similar):]
+
+        # Devices kept booted by the warm pool skip booting to service mode
+        warm = self._store.get_warm(list(health.keys()))
+        return sorted(sorted(similar, key=_get_last_used) + others,
+                      key=lambda device_config:
+                      device_config["settings"]["id"] not in warm)
 
 
     def reserve_specific(self, machine_name, timeout = 3600, model=None):
@@ -189,135 +537,771 @@ class DevicesManager(object):
         """
 
         # Basically very similar to a reserve-method
-        # we just populate they devices array with a single device
-        devices = []
-        for device_config in self.device_configs:
-            if device_config["name"].lower() == machine_name.lower():
-                cutter = devicefactory.build_cutter(device_config["settings"])
-                device = devicefactory.build_device(device_config["settings"], cutter)
-                devices.append(device)
-                break
+        # we just populate they configuration array with a single device
+        device_configs = []
+        device_config = self._configs_by_name.get(machine_name.lower())
+        if device_config:
+            device_configs.append(device_config)
 
         #Check if device is a given model
-        if model and len(devices):
-            if not devices[0].model.lower() == model.lower():
+        if model and len(device_configs):
+            if not device_configs[0]["model"].lower() == model.lower():
                 raise errors.AFTConfigurationError(
                     "Device and machine doesn't match")
 
-        return self._do_reserve(devices, machine_name, timeout)
+        return self._do_reserve(device_configs, machine_name, timeout)
 
 
-    def _do_reserve(self, devices, name, timeout):
+    def _do_reserve(self, device_configs, name, timeout):
         """
-        Try to reserve and lock a device from devices list.
+        Try to reserve and lock a device from the device configurations list
+        and construct it.
         """
-        if len(devices) == 0:
+        if len(device_configs) == 0:
             raise errors.AFTConfigurationError(
                 "No device configurations when reserving " + name +
                 " - check that given machine type or name is correct")
 
-        start = time.time()
-        while time.time() - start < timeout:
-            for device in devices:
-                logger.info("Attempting to acquire " + device.name)
-                try:
-                    # This is a non-atomic operation which may cause trouble
-                    # Using a locking database system could be a viable fix.
-                    lockfile = os.fdopen(os.open(os.path.join(config.LOCK_FILE,
-                                                                    "aft_" + device.dev_id),
-                                                       os.O_WRONLY | os.O_CREAT, 0o660), "w")
-                    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
-
-                    logger.info("Device acquired.")
-
-                    self._lockfiles.append((device.dev_id, lockfile))
-
-
-                    atexit.register(self.release, device)
-                    return device
-                except IOError as err:
-                    if err.errno in {errno.EACCES, errno.EAGAIN}:
-                        logger.info("Device busy.")
-                    else:
-                        logger.critical("Cannot obtain lock file.")
-                        sys.exit(-1)
-            logger.info("All devices busy ... waiting 10 seconds and trying again.")
-            time.sleep(10)
-        raise errors.AFTTimeoutError("Could not reserve " + name +
+        return self._wait_in_queues(
+            [name], name, timeout,
+            lambda: self._try_reserve(device_configs),
+            device_configs)
+
+    def reserve_many(self, spec, timeout=3600):
+        """
+        Reserve and lock a group of devices, e.g. a client and a server,
+        atomically: either all the devices are reserved, or none.
+
+        The process waits in the queues of all the requested models, and
+        tries to reserve the group only when it is first in all of them.
+
+        Args:
+            spec (str): The devices, as "2xMinnowboardMAX + 1xEdison", see
+                parse_device_spec()
+            timeout (integer): Timeout in seconds
+
+        Returns:
+            List of the reserved devices, in the order of the specification.
+            The group attribute of each device is set to the list.
+
+        Raises:
+            aft.errors.AFTConfigurationError if the specification is invalid,
+            or there are not enough non-blacklisted devices of some model
+            aft.errors.AFTTimeoutError if the devices could not be reserved
+            within the timeout
+        """
+        spec_groups = parse_device_spec(spec)
+        groups = []
+        for model, count in spec_groups:
+            device_configs = self._remove_blacklisted_configs(
+                self._configs_by_model.get(model, []))
+            if len(device_configs) < count:
+                raise errors.AFTConfigurationError(
+                    str(count) + " " + model + " devices requested, but " +
+                    str(len(device_configs)) + " are available")
+            groups.append((count, self._order_by_health(device_configs)))
+
+        models = sorted(set([model for model, _ in spec_groups]))
+        return self._wait_in_queues(
+            models, spec, timeout,
+            lambda: self._try_reserve_group(groups))
+
+    def _wait_in_queues(self, names, description, timeout, try_reserve,
+                        device_configs=None):
+        """
+        Wait for the turn of the process in the reservation queues, and try
+        to reserve whenever it is first in all of them and devices have been
+        released.
+
+        The timeout is limited to the --max-wait argument, if given. With
+        --max-wait, waiting is also given up as soon as the estimated wait
+        exceeds the remaining time.
+
+        Args:
+            names (list(str)): Names of the queues to wait in
+            description (str): What is being reserved, for messages
+            timeout (integer): Timeout in seconds
+            try_reserve (function): Function that tries to reserve without
+                blocking, and returns None if the devices are busy
+            device_configs (list(dictionary)): The devices waited for, used
+                to estimate the wait. If None, the wait is not estimated.
+
+        Returns:
+            The return value of try_reserve
+
+        Raises:
+            aft.errors.AFTTimeoutError if the timeout expires
+        """
+        if self._args.max_wait:
+            timeout = min(timeout, self._args.max_wait)
+
+        queues = [_ReservationQueue(name) for name in names]
+        ticket = None
+        try:
+            for queue in queues:
+                ticket = queue.enter(ticket)
+            watcher = _watch_queues(queues)
+        except:
+            for queue in queues:
+                queue.leave()
+            raise
+
+        try:
+            start = time.time()
+            waiting = False
+            while True:
+                position = max([queue.position() for queue in queues])
+                if position == 0:
+                    reserved = try_reserve()
+                    if reserved:
+                        return reserved
+
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    break
+
+                if position == 0:
+                    msg = "All devices busy ... waiting for a device to be " \
+                          "released."
+                else:
+                    msg = (str(position) + " jobs ahead in the queue for " +
+                           description + " ... waiting.")
+
+                estimate = None
+                if device_configs:
+                    estimate = self._estimate_wait(device_configs, position)
+                    if estimate is not None:
+                        msg += (" Estimated wait " +
+                                _format_duration(estimate) + ".")
+
+                logger.info(msg)
+                if not waiting:
+                    print(msg)
+                    waiting = True
+
+                if (self._args.max_wait and estimate is not None and
+                        estimate > remaining):
+                    raise errors.AFTTimeoutError(
+                        "Estimated wait for " + description + " is " +
+                        _format_duration(estimate) + ", longer than the " +
+                        "maximum wait of " + str(self._args.max_wait) +
+                        " seconds.")
+
+                watcher.wait(min(remaining, _POLL_INTERVAL))
+        finally:
+            watcher.close()
+            for queue in queues:
+                queue.leave()
+
+        raise errors.AFTTimeoutError("Could not reserve " + description +
                                      " in " + str(timeout) + " seconds.")
 
+    def reserve_multiple(self, count=None, timeout=3600):
+        """
+        Reserve and lock up to count devices of the requested model.
+
+        Waits until count devices have been acquired or the timeout expires.
+        On timeout, the devices acquired so far are returned.
+
+        Args:
+            count (integer):
+                Maximum number of devices to reserve. If None, all
+                non-blacklisted devices of the model are reserved.
+            timeout (integer): Timeout in seconds
 
-    def _remove_blacklisted_devices(self, devices):
+        Returns:
+            List of reserved devices
+
+        Raises:
+            aft.errors.AFTTimeoutError if no device could be reserved
         """
-        Remove blacklisted devices from the device list
+        device_configs = self._remove_blacklisted_configs(
+            self._configs_by_model.get(self._args.machine.lower(), []))
+        device_configs = self._order_by_health(device_configs)
+
+        if len(device_configs) == 0:
+            raise errors.AFTConfigurationError(
+                "No device configurations when reserving " +
+                self._args.machine +
+                " - check that given machine type or name is correct")
+
+        if count is None or count > len(device_configs):
+            count = len(device_configs)
+
+        reserved = []
+        queue = _ReservationQueue(self._args.machine)
+        queue.enter()
+        watcher = queue.watch()
+
+        try:
+            start = time.time()
+            while True:
+                if queue.position() == 0:
+                    reserved_count = len(reserved)
+                    while True:
+                        reserved_ids = set(
+                            [device.dev_id for device in reserved])
+                        device = self._try_reserve(
+                            [device_config for device_config in device_configs
+                             if device_config["settings"]["id"] not in
+                             reserved_ids])
+                        if device is None:
+                            break
+                        reserved.append(device)
+                        if len(reserved) == count:
+                            return reserved
+
+                    # Let the other waiters have their share of the released
+                    # devices before taking more
+                    if len(reserved) > reserved_count:
+                        queue.leave()
+                        queue.enter()
+
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    break
+
+                logger.info("Reserved " + str(len(reserved)) + " of " +
+                            str(count) + " devices ... waiting.")
+                watcher.wait(min(remaining, _POLL_INTERVAL))
+        finally:
+            watcher.close()
+            queue.leave()
+
+        if len(reserved) == 0:
+            raise errors.AFTTimeoutError("Could not reserve " +
+                                         self._args.machine + " in " +
+                                         str(timeout) + " seconds.")
+
+        logger.info("Timeout expired, continuing with " + str(len(reserved)) +
+                    " of " + str(count) + " devices")
+        return reserved
+
+    def _estimate_wait(self, device_configs, position):
+        """
+        Estimate how long it takes until one of the devices is free for this
+        process, from the times the devices are usually held and how long the
+        current reservations have been held.
+
+        Args:
+            device_configs (list(dictionary)): The devices waited for
+            position (integer): Number of waiters ahead of this process
+
+        Returns:
+            The estimated wait in seconds, or None if the devices are busy
+            and have no job history
+        """
+        device_ids = [device_config["settings"]["id"]
+                      for device_config in device_configs]
+        reservations = {}
+        for reservation in self._store.get_reservations():
+            reservations[reservation["id"]] = reservation
+
+        free_count = len([device_id for device_id in device_ids
+                          if device_id not in reservations])
+        if position < free_count:
+            return 0
+
+        job_times = sorted([entry["job_time"] for entry in
+                            self._store.get_health(device_ids).values()
+                            if entry["job_time"] is not None])
+        if len(job_times) == 0:
+            return None
+        job_time = job_times[len(job_times) // 2]
+
+        # Times until each device is free, if its jobs take the usual time
+        now = time.time()
+        free_times = []
+        for device_id in device_ids:
+            if device_id in reservations:
+                free_times.append(max(
+                    reservations[device_id]["started"] + job_time - now,
+                    job_time * _OVERRUN_FRACTION))
+            else:
+                free_times.append(0)
+
+        # The waiters ahead take the devices in the order they become free
+        heapq.heapify(free_times)
+        for _ in range(position):
+            heapq.heappush(free_times, heapq.heappop(free_times) + job_time)
+
+        return free_times[0]
+
+    def _try_reserve(self, device_configs):
+        """
+        Reserve the first free device of the list without blocking, and
+        construct the reserved device. Only the reserved device is
+        constructed.
+
+        Args:
+            device_configs (list(dictionary)):
+                The device configurations, in the order of preference
+
+        Returns:
+            The reserved device, or None if all the devices are busy
+        """
+        if len(device_configs) == 0:
+            return None
+
+        logger.info("Attempting to acquire one of " +
+                    ", ".join([device_config["name"]
+                               for device_config in device_configs]))
+
+        devices = self._try_reserve_group([(1, device_configs)])
+        if devices is None:
+            return None
+        return devices[0]
+
+    def _try_reserve_group(self, groups):
+        """
+        Reserve the first free devices of each group without blocking, and
+        construct the reserved devices. Either all the devices are reserved,
+        or none.
 
         Args:
-            List of devices
+            groups (list((integer, list(dictionary)))):
+                (count, device configurations) tuples, with the
+                configurations in the order of preference
 
         Returns:
-            Filtered list of devices
+            List of the reserved devices, or None if some group does not
+            have enough free devices
         """
-        _device_blacklist = self._construct_blacklist()
+        device_ids = self._store.reserve_group(
+            [(count, [(device_config["settings"]["id"], device_config["name"],
+                       device_config["model"])
+                      for device_config in device_configs])
+             for count, device_configs in groups])
+        if device_ids is None:
+            logger.info("All devices busy.")
+            return None
 
-        filtered_devices = []
+        devices = []
+        try:
+            for device_id in device_ids:
+                devices.append(
+                    self._build_device(self._configs_by_id[device_id]))
+        except:
+            for device_id in device_ids:
+                self._store.release(device_id, record_job=False)
+            raise
 
         for device in devices:
-            for blacklisted_device in _device_blacklist:
-                if blacklisted_device["id"] == device.dev_id:
-                    msg = ("Removed blacklisted device " +
-                            blacklisted_device["name"] + " from device pool " +
-                            "(Reason: " + blacklisted_device["reason"] + ")")
+            device.group = devices
+            if self._store.take_warm(device.dev_id):
+                logger.info("Device " + device.name +
+                            " was kept booted by the warm pool.")
+            logger.info("Device " + device.name + " acquired.")
+            atexit.register(self.release, device)
+        return devices
+
+    def _build_device(self, device_config):
+        """
+        Construct the device and its cutter
 
-                    logger.info(msg)
-                    print(msg)
+        Args:
+            device_config (dictionary): The device configuration
+
+        Returns:
+            The device
+        """
+        cutter = devicefactory.build_cutter(device_config["settings"])
+        return devicefactory.build_device(device_config["settings"], cutter)
+
+    def warm_idle_devices(self):
+        """
+        Boot idle devices into service mode ahead of the jobs, so that the
+        jobs reserving them can start flashing right away.
+
+        For each model, the number of devices kept warm is the number of jobs
+        expected within _DEMAND_WINDOW seconds at the recent reservation rate,
+        plus the jobs waiting in the queue, up to the warm_pool_size option.
+        Devices are warmed in parallel, each reserved for the time it boots.
+
+        Returns:
+            Names of the devices that were warmed (list(str))
+        """
+        pool_size = common.get_warm_pool_size()
+        if not pool_size:
+            return []
+
+        now = time.time()
+        reserved = set([reservation["id"]
+                        for reservation in self._store.get_reservations()])
+
+        to_warm = []
+        for model, device_configs in self._configs_by_model.items():
+            if not devicefactory.get_device_class(
+                    device_configs[0]["settings"]).WARM_BOOT:
+                continue
+
+            device_ids = [device_config["settings"]["id"]
+                          for device_config in device_configs]
+            recent = self._store.count_reservations(device_ids,
+                                                    now - _DEMAND_PERIOD)
+            demand = (int(math.ceil(float(recent) * _DEMAND_WINDOW /
+                                    _DEMAND_PERIOD)) +
+                      _ReservationQueue(model).position())
+
+            warm = self._store.get_warm(device_ids)
+            idle_warm = len([device_id for device_id in warm
+                             if device_id not in reserved])
+            needed = min(demand, pool_size) - idle_warm
+            if needed <= 0:
+                continue
+
+            logger.info("Warming " + str(needed) + " " + model + " devices " +
+                        "for the expected demand of " + str(demand))
+            candidates = self._order_by_health(
+                [device_config for device_config in device_configs
+                 if device_config["settings"]["id"] not in warm])
+            for _ in range(needed):
+                device_id = self._store.reserve(
+                    [(device_config["settings"]["id"], device_config["name"],
+                      device_config["model"])
+                     for device_config in candidates],
+                    record_event=False)
+                if device_id is None:
                     break
-            else: # else clause for the for loop
-                filtered_devices.append(device)
+                to_warm.append(self._configs_by_id[device_id])
+                candidates = [device_config for device_config in candidates
+                              if device_config["settings"]["id"] != device_id]
+
+        warmed = []
+        threads = []
+        for device_config in to_warm:
+            thread = threading.Thread(target=self._warm_device,
+                                      args=(device_config, warmed))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        return warmed
+
+    def _warm_device(self, device_config, warmed):
+        """
+        Boot a device reserved by warm_idle_devices() into service mode,
+        record it as warm and release it without powering it off
 
-        return filtered_devices
+        Args:
+            device_config (dictionary): The device configuration
+            warmed (list(str)): List the name of the device is appended to,
+                if the device was warmed
+        """
+        device_id = device_config["settings"]["id"]
+        device = None
+        # Booting may take several boot timeouts, so the lease is renewed
+        # for as long as the device is being warmed
+        done = threading.Event()
+        renewer = threading.Thread(target=_renew_lease_until,
+                                   args=(device_id, "warming", done))
+        renewer.daemon = True
+        renewer.start()
+        try:
+            device = self._build_device(device_config)
+            device.enter_service_mode()
+            self._store.set_warm(device_id, device.get_active_mode())
+            logger.info("Device " + device_config["name"] + " is warm")
+            warmed.append(device_config["name"])
+        except Exception as err:
+            logger.warning("Failed to warm device " + device_config["name"] +
+                           ": " + str(err))
+            if device:
+                device.detach()
+        finally:
+            done.set()
+            renewer.join()
+            self._store.release(device_id, record_job=False)
+
+    def reclaim_expired_leases(self):
+        """
+        Reclaim the devices whose reservation has not been renewed within the
+        lease time. The job owning the reservation is terminated, and the
+        device is powered off and released. The next job powers the device
+        back on, completing the power cycle.
 
+        Reservations of the calling process, e.g. the devices warmed by the
+        job server, are never reclaimed. The owner is only terminated if it
+        is still the process that made the reservation, and not a later
+        process that reuses its pid.
 
-    def release(self, reserved_device):
+        Returns:
+            Names of the reclaimed devices (list(str))
         """
-        Put the reserved device back to the pool. It will happen anyway when
-        the process dies, but this removes the stale lockfile.
+        lease_time = common.get_lease_time()
+        if not lease_time:
+            return []
+
+        reclaimed = []
+        now = time.time()
+        for reservation in self._store.get_reservations():
+            device_config = self._configs_by_id.get(reservation["id"])
+            if (device_config is None or
+                    reservation["owner_pid"] == os.getpid() or
+                    now - reservation["heartbeat"] < lease_time):
+                continue
+
+            # Take the reservation over first, so that the device is not
+            # handed to another job while it is being reclaimed
+            if not self._store.take_over(reservation["id"],
+                                         reservation["owner_pid"],
+                                         reservation["heartbeat"]):
+                continue
+
+            msg = ("Reclaiming device " + device_config["name"] +
+                   " from process " + str(reservation["owner_pid"]) +
+                   ", lease expired " +
+                   str(int(now - reservation["heartbeat"] - lease_time)) +
+                   " seconds ago")
+            logger.warning(msg)
+            print(msg)
+
+            if (reservation["owner_start"] is not None and
+                    statestore.get_process_start_time(
+                        reservation["owner_pid"]) ==
+                    reservation["owner_start"]):
+                try:
+                    os.kill(reservation["owner_pid"], signal.SIGTERM)
+                except OSError as err:
+                    logger.warning("Failed to terminate process " +
+                                   str(reservation["owner_pid"]) + ": " +
+                                   str(err))
+            else:
+                logger.info("Process " + str(reservation["owner_pid"]) +
+                            " no longer owns the reservation, not " +
+                            "terminating it")
+
+            try:
+                self._build_device(device_config).detach()
+            except Exception as err:
+                logger.error("Failed to power off device " +
+                             device_config["name"] + ": " + str(err))
+
+            common.record_device_event(reservation["id"], "reclaim", False)
+            self._store.release(reservation["id"], record_job=False)
+            reclaimed.append(device_config["name"])
+
+        return reclaimed
+
+
+    def _remove_blacklisted_configs(self, device_configs):
         """
+        Remove blacklisted devices from the device configuration list
 
-        lockfile = None
-        for i in self._lockfiles:
-            if i[0] == reserved_device.dev_id:
-                i[1].close()
-                self._lockfiles.remove(i)
-                break
+        Args:
+            List of device configurations
 
-        if reserved_device:
-            path = os.path.join(
-                config.LOCK_FILE,
-                "aft_" + reserved_device.dev_id)
+        Returns:
+            Filtered list of device configurations
+        """
+        _device_blacklist = {}
+        for entry in self._store.get_blacklist(
+                [device_config["settings"]["id"]
+                 for device_config in device_configs]):
+            _device_blacklist[entry["id"]] = entry
+
+        filtered_configs = []
+
+        for device_config in device_configs:
+            blacklisted_device = _device_blacklist.get(
+                device_config["settings"]["id"])
+            if blacklisted_device:
+                msg = ("Removed blacklisted device " +
+                        blacklisted_device["name"] + " from device pool " +
+                        "(Reason: " + blacklisted_device["reason"] + ")")
+
+                logger.info(msg)
+                print(msg)
+            else:
+                filtered_configs.append(device_config)
+
+        return filtered_configs
 
-            if os.path.isfile(path):
-                os.unlink(path)
+
+    def release(self, reserved_device):
+        """
+        Put the reserved device back to the pool. The reservation is also
+        removed when the process dies, but only once somebody tries to reserve
+        the device.
+        """
+        if reserved_device:
+            self._store.release(reserved_device.dev_id)
 
 
     def get_configs(self):
         return self.device_configs
 
-    def blacklist_device(self, device, reason):
+    def get_status(self):
+        """
+        Return the reservation and blacklist state of all the configured
+        devices. Only reads the state database, without taking any locks.
+
+        Returns:
+            List of dictionaries, one per device in the topology order, with
+            the keys:
+                "name", "model", "id": The device
+                "owner_pid": Process holding the reservation, or None
+                "held_for": Seconds the reservation has been held, or None
+                "heartbeat_age": Seconds since the lease was renewed, or None
+                "phase": Phase of the job holding the reservation, or None
+                "blacklisted": The blacklist entry, as returned by
+                    aft.statestore.StateStore.get_blacklist(), or None
+                "warm": Mode the warm pool left the idle device booted
+                    into, or None
+        """
+        reservations = {}
+        for reservation in self._store.get_reservations():
+            reservations[reservation["id"]] = reservation
+        blacklist = {}
+        for entry in self._store.get_blacklist():
+            blacklist[entry["id"]] = entry
+        warm = self._store.get_warm(
+            [device_config["settings"]["id"]
+             for device_config in self.device_configs])
+
+        now = time.time()
+        status = []
+        for device_config in self.device_configs:
+            device_id = device_config["settings"]["id"]
+            reservation = reservations.get(device_id)
+            device_status = {
+                "name": device_config["name"],
+                "model": device_config["model"],
+                "id": device_id,
+                "owner_pid": None,
+                "held_for": None,
+                "heartbeat_age": None,
+                "phase": None,
+                "blacklisted": blacklist.get(device_id),
+                "warm": None}
+            if reservation:
+                device_status["owner_pid"] = reservation["owner_pid"]
+                device_status["held_for"] = now - reservation["started"]
+                device_status["heartbeat_age"] = \
+                    now - reservation["heartbeat"]
+                device_status["phase"] = reservation["phase"]
+            else:
+                device_status["warm"] = warm.get(device_id)
+            status.append(device_status)
+
+        return status
+
+    def print_status(self, as_json=False):
+        """
+        Print the state of all the configured devices
+
+        Args:
+            as_json (boolean): Print the state as a JSON list, as returned by
+                get_status(), instead of a table
+        """
+        status = self.get_status()
+        if as_json:
+            print(json.dumps(status, indent=2, sort_keys=True))
+            return
+
+        rows = [("DEVICE", "MODEL", "STATE", "PID", "HELD", "PHASE")]
+        for device_status in status:
+            if device_status["owner_pid"] is not None:
+                state = "reserved"
+                pid = str(device_status["owner_pid"])
+                held = _format_duration(device_status["held_for"])
+                phase = device_status["phase"]
+            elif device_status["warm"]:
+                state = "warm (" + device_status["warm"] + ")"
+                pid = held = phase = "-"
+            else:
+                state = "free"
+                pid = held = phase = "-"
+
+            if device_status["blacklisted"]:
+                state = ("blacklisted: " +
+                         device_status["blacklisted"]["reason"])
+
+            rows.append((device_status["name"], device_status["model"],
+                         state, pid, held, phase))
+
+        widths = [max([len(row[column]) for row in rows])
+                  for column in range(len(rows[0]) - 1)]
+        for row in rows:
+            print("  ".join([value.ljust(width)
+                             for value, width in zip(row, widths)] +
+                            [row[-1]]))
+
+    def get_inventory(self):
+        """
+        Return the state of all the configured devices, as reported to the
+        farm coordinator
+
+        Returns:
+            List of dictionaries with the keys "name", "model", "id",
+            "reserved", "blacklisted" and "flash_success_rate"
+        """
+        status = self.get_status()
+        health = self._store.get_health(
+            [device_status["id"] for device_status in status])
+
+        inventory = []
+        for device_status in status:
+            inventory.append({
+                "name": device_status["name"].lower(),
+                "model": device_status["model"].lower(),
+                "id": device_status["id"],
+                "reserved": device_status["owner_pid"] is not None,
+                "blacklisted": device_status["blacklisted"] is not None,
+                "flash_success_rate":
+                    health[device_status["id"]]["flash_success_rate"]})
+
+        return inventory
+
+    def get_config_by_name(self, name):
+        """
+        Return the configuration of the named device
+
+        Args:
+            name (str): Name of the device, case insensitive
+
+        Returns:
+            The device configuration, or None if there is no such device
+        """
+        return self._configs_by_name.get(name.lower())
+
+    def _get_device_id(self, name):
+        """
+        Return the id of the named device
+
+        Raises:
+            aft.errors.AFTConfigurationError if there is no such device
+        """
+        device_config = self.get_config_by_name(name)
+        if device_config is None or "id" not in device_config["settings"]:
+            raise errors.AFTConfigurationError(
+                "No device configuration for " + name)
+        return device_config["settings"]["id"]
+
+    def get_config_files(self):
+        """
+        Return the configuration files the device configurations are built
+        from
+
+        Returns:
+            List of file paths
+        """
+        return [self.__PLATFORM_FILE_NAME, self._args.catalog,
+                self._args.topology]
+
+    def blacklist_device(self, device, reason, ttl=0):
         """
         Blacklist a device, preventing any further testing
 
         Args:
             Device (str): Name of the device
             reason (str): Reason for blacklisting
+            ttl (integer): Seconds after which the device returns to the
+                pool. 0 blacklists the device until it is unblacklisted.
         """
-        dev_id = None
-
-        for config in self.device_configs:
-            if config["name"].lower() == device.lower():
-                dev_id = config["settings"]["id"]
-                break
-
-        common.blacklist_device(dev_id, device, reason)
+        common.blacklist_device(self._get_device_id(device), device, reason,
+                                ttl)
 
 
     def unblacklist_device(self, device):
@@ -327,22 +1311,44 @@ class DevicesManager(object):
         Args:
             Device (str): Name of the device
         """
-        dev_id = None
-
-        for config in self.device_configs:
-            if config["name"].lower() == device.lower():
-                dev_id = config["settings"]["id"]
-                break
-
-        common.unblacklist_device(dev_id)
+        common.unblacklist_device(self._get_device_id(device))
 
     def blacklist_print(self):
         """
-        Print the contents of the blacklist file
+        Print the contents of the blacklist
         """
-        with open(config.DEVICE_BLACKLIST, "r") as blacklist_file:
-            blacklist = blacklist_file.read().strip()
-            if len(blacklist) < 1:
-                print("Blacklist is empty")
-            else:
-                print(blacklist)
+        blacklist = self._store.get_blacklist()
+        if len(blacklist) < 1:
+            print("Blacklist is empty")
+        else:
+            for entry in blacklist:
+                details = "failures: " + str(entry["failures"])
+                if entry["expires"] is not None:
+                    details += ", expires " + time.strftime(
+                        "%Y-%m-%d %H:%M:%S", time.localtime(entry["expires"]))
+                print(entry["id"] + " " + entry["name"] + " " +
+                      entry["reason"] + " (" + details + ")")
+
+
+def _renew_lease_until(device_id, phase, done):
+    """
+    Renew the lease of a device every _WARM_RENEW_INTERVAL seconds until the
+    event is set
+
+    Args:
+        device_id (str): The device id
+        phase (str): The phase shown by 'aft --status'
+        done (threading.Event): Event set when the lease no longer needs to
+            be renewed
+    """
+    common.renew_lease(device_id, phase)
+    while not done.wait(_WARM_RENEW_INTERVAL):
+        common.renew_lease(device_id)
+
+def _format_duration(seconds):
+    """
+    Format a duration as h:mm:ss
+    """
+    seconds = int(seconds)
+    return "{0}:{1:02d}:{2:02d}".format(seconds // 3600, seconds // 60 % 60,
+                                         seconds % 60)
@@ -0,0 +1,725 @@
+# coding=utf-8
+# Copyright (c) 2013-2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Resident job server and the matching client.
+
+The server ('aft --serve') parses the AFT configuration, the device
+configurations and the test plans once and keeps them in memory. Jobs are
+received over a local Unix socket from clients ('aft --submit ...'), which
+only the user and the group of the server can connect to. Each job is
+executed in a forked process, which inherits the already parsed state and the
+already imported device, cutter and test case modules, so that the per-job
+startup cost is only the cost of the fork. Flashing and testing is scheduled
+through an aft.scheduler.Pipeline shared by all the jobs.
+
+The server also reclaims the devices of hung jobs, whose reservation lease
+has expired (see DevicesManager.reclaim_expired_leases), and keeps idle
+devices booted into service mode if the warm pool is enabled (see
+DevicesManager.warm_idle_devices).
+
+With --listen, the server also accepts jobs over TCP. Without a host in the
+address, only local connections are accepted. Listening requires the farm
+secret (aft.config.FARM_SECRET) on every address, including localhost, and
+every TCP request must be signed with it (see aft.tools.json_socket). The
+working directory and the files of TCP jobs, including the images of their
+job files, must be in the job root (aft.config.JOB_ROOT), and the
+configuration files may also be in /etc/aft. Jobs that would reconfigure the
+harness, run servers, change the blacklist, reclaim or warm devices are
+rejected. With --coordinator, it acts as the agent of this harness for the
+farm coordinator (aft.coordinator): it reports the state of its devices
+periodically and whenever a job finishes, and clients submitting jobs for a
+machine or a device through the coordinator are directed to the harness with
+free devices. Other jobs are submitted to the local job server.
+
+The protocol consists of JSON objects, one per line. The client sends a single
+request:
+
+    {"argv": ["<aft arguments>", ...], "cwd": "/client/working/directory"}
+
+The server replies with any number of output messages followed by the exit
+code of the job:
+
+    {"output": "text printed by the job"}
+    {"exit": 0}
+
+Requests received over TCP also contain the "auth" signature added by
+aft.tools.json_socket.sign.
+"""
+
+import os
+import sys
+import socket
+import threading
+import time
+import multiprocessing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import aft.config as config
+import aft.errors as errors
+import aft.devices.common as common
+import aft.tester as tester
+import aft.batch as batch
+import aft.devicefactory as devicefactory
+import aft.testcasefactory as testcasefactory
+import aft.configcache as configcache
+import aft.scheduler as scheduler
+import aft.coordinator as coordinator
+import aft.tools.json_socket as json_socket
+import aft.tools.ssh as ssh
+import aft.tools.lease_watcher as lease_watcher
+from aft.devicesmanager import DevicesManager
+from aft.logger import Logger as logger
+
+# Options that only concern the client and must not be forwarded to the server
+_CLIENT_OPTIONS = ["--submit", "--socket", "--coordinator"]
+
+# Seconds between the checks for expired reservation leases and idle devices
+# to warm
+_MAINTENANCE_INTERVAL = 60
+
+# Options of jobs that are not allowed over TCP, as they reconfigure the
+# harness, change the state of the whole farm or signal processes
+_REMOTE_FORBIDDEN_OPTIONS = ["configure", "serve", "submit", "coordinate",
+                             "blacklist", "unblacklist", "reclaim", "warm",
+                             "recover_edisons"]
+
+# Options of jobs that concern the local harness, and are never placed by
+# the coordinator
+_LOCAL_OPTIONS = _REMOTE_FORBIDDEN_OPTIONS + ["blacklist_print", "status",
+                                              "jobs"]
+
+# Directory the configuration files of jobs received over TCP may also be in
+_CONFIG_ROOT = "/etc/aft"
+
+# Permissions of the Unix socket: only the user and the group of the server
+# can submit jobs
+_SOCKET_MODE = 0o660
+
+# Job processes inherit the connection and the pipeline of the server, which
+# requires forking regardless of the default start method of the platform
+if hasattr(multiprocessing, "get_context"):
+    _FORK = multiprocessing.get_context("fork")
+else:
+    _FORK = multiprocessing
+
+
+class _FarmState(object):
+    """
+    The parsed farm configuration held by the job server.
+
+    Device configurations are cached per catalog and topology file pair and
+    re-read when any of the configuration files changes.
+    """
+
+    def __init__(self):
+        # Held while the configuration is read. Also held by _JobLauncher
+        # when forking.
+        self.lock = threading.Lock()
+        # (catalog, topology) -> (file signature, device configurations)
+        self._device_configs = {}
+        # Set when the state of the devices may have changed
+        self.devices_changed = threading.Event()
+
+    def get_device_configs(self, args):
+        """
+        Return up to date device configurations for the catalog and topology
+        files given in args.
+
+        Args:
+            args (argparse namespace argument object): Job arguments
+
+        Returns:
+            List of device configurations, as returned by
+            DevicesManager.get_configs()
+        """
+        key = (args.catalog, args.topology)
+
+        with self.lock:
+            cached = self._device_configs.get(key)
+            if cached:
+                manager = DevicesManager(args, device_configs=cached[1])
+                signature = configcache.get_files_signature(manager.get_config_files())
+                if signature == cached[0]:
+                    return cached[1]
+                logger.info("Configuration files changed, reloading")
+
+            manager = DevicesManager(args)
+            configs = manager.get_configs()
+            signature = configcache.get_files_signature(manager.get_config_files())
+            self._device_configs[key] = (signature, configs)
+
+            self._load_test_plans(configs)
+            self._load_classes(configs)
+            return configs
+
+    def _load_test_plans(self, configs):
+        """
+        Parse the test plans of the given devices so that they are cached
+        before jobs are forked.
+        """
+        test_plans = set([device_config["settings"]["test_plan"]
+                          for device_config in configs
+                          if "test_plan" in device_config["settings"]])
+
+        for test_plan in test_plans:
+            tester.read_test_plan(tester.get_test_plan_file(test_plan))
+
+    def _load_classes(self, configs):
+        """
+        Import the device, cutter and test case classes used by the given
+        devices, which aft.plugins otherwise imports lazily, so that jobs
+        inherit them already imported. Classes that fail to import are left
+        for the jobs to report.
+        """
+        for device_config in configs:
+            settings = device_config["settings"]
+            loaders = [lambda: devicefactory.get_device_class(settings),
+                       lambda: devicefactory.get_cutter_class(settings)]
+
+            if "test_plan" in settings:
+                test_plan_file = tester.get_test_plan_file(
+                    settings["test_plan"])
+                for test_case_config in tester.read_test_plan(test_plan_file):
+                    loaders.append(
+                        lambda config=test_case_config:
+                        testcasefactory.get_test_case_class(config))
+
+            for loader in loaders:
+                try:
+                    loader()
+                except (errors.AFTConfigurationError, ImportError,
+                        KeyError) as err:
+                    logger.warning("Failed to preload a class: " + str(err))
+
+
+class _JobLauncher(object):
+    """
+    Starts the job processes from a single thread.
+
+    A lock held by another thread when a job process is forked would stay
+    locked forever in the job process. The launcher therefore forks while
+    holding the locks shared by the threads of the server, and the job
+    process releases its copies of them. Python reinitializes the locks of
+    the logging module after forking by itself.
+    """
+
+    def __init__(self, state):
+        self._state = state
+        self._requests = queue.Queue()
+        _start_thread(self._run)
+
+    def start(self, target, args):
+        """
+        Start a process executing the function
+
+        Args:
+            target (function): The function
+            args (tuple): Arguments of the function
+
+        Returns:
+            The started process (multiprocessing.Process)
+        """
+        request = {"target": target, "args": args, "done": threading.Event()}
+        self._requests.put(request)
+        request["done"].wait()
+
+        if "error" in request:
+            raise request["error"]
+        return request["process"]
+
+    def _run(self):
+        """
+        Launcher thread entry point
+        """
+        while True:
+            request = self._requests.get()
+            locks = self._acquire_locks()
+            try:
+                process = _FORK.Process(
+                    target=_run_job_process,
+                    args=(locks, request["target"], request["args"]))
+                process.start()
+                request["process"] = process
+            except Exception as err:
+                request["error"] = err
+            finally:
+                for lock in reversed(locks):
+                    lock.release()
+                request["done"].set()
+
+    def _acquire_locks(self):
+        """
+        Acquire the locks shared by the threads of the server
+
+        Returns:
+            The acquired locks (list(threading.Lock))
+        """
+        while True:
+            locks = ([self._state.lock] + lease_watcher.fork_locks() +
+                     ssh.fork_locks())
+            for lock in locks:
+                lock.acquire()
+
+            # A lease watcher may have been added before its lock was taken
+            if locks == ([self._state.lock] + lease_watcher.fork_locks() +
+                         ssh.fork_locks()):
+                return locks
+
+            for lock in reversed(locks):
+                lock.release()
+
+
+def _run_job_process(locks, target, args):
+    """
+    Entry point of the processes started by _JobLauncher. Releases the locks
+    that were held when the process was forked and executes the function.
+    """
+    for lock in locks:
+        lock.release()
+    target(*args)
+
+
+class _SocketWriter(object):
+    """
+    File-like object that forwards written text to the client as output
+    messages. Used as the job process stdout and stderr.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def write(self, text):
+        if text:
+            json_socket.send_message(self._connection, {"output": text})
+
+    def flush(self):
+        pass
+
+
+def serve(args):
+    """
+    Run the job server until interrupted.
+
+    Args:
+        args (argparse namespace argument object):
+            Command line arguments, as parsed by argparse
+
+    Returns:
+        Process exit code (integer)
+    """
+    state = _FarmState()
+    pipeline = scheduler.Pipeline(
+        scheduler.parse_stage_limits(args.stage_limits))
+    # Parse the default configuration immediately, so that the first job does
+    # not have to wait for it
+    state.get_device_configs(args)
+
+    common.make_directory(os.path.dirname(args.socket))
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Create the socket without permissions for other users, so that they
+    # cannot connect before its mode is set
+    umask = os.umask(0o777 & ~_SOCKET_MODE)
+    try:
+        server.bind(args.socket)
+    finally:
+        os.umask(umask)
+    os.chmod(args.socket, _SOCKET_MODE)
+    server.listen(16)
+
+    logger.info("Job server listening on " + args.socket)
+    print("Job server listening on " + args.socket)
+
+    launcher = _JobLauncher(state)
+
+    tcp_server = None
+    if args.listen:
+        tcp_server = json_socket.listen(args.listen)
+        _start_thread(_accept_connections, tcp_server, state, pipeline,
+                      launcher, True)
+
+        logger.info("Job server listening on " + args.listen)
+        print("Job server listening on " + args.listen)
+
+        if args.coordinator:
+            _start_thread(_report_to_coordinator, args, state)
+
+    _start_thread(_maintain_devices, args, state)
+
+    try:
+        _accept_connections(server, state, pipeline, launcher)
+    finally:
+        server.close()
+        os.unlink(args.socket)
+        if tcp_server:
+            tcp_server.close()
+
+
+def _start_thread(target, *args):
+    """
+    Run the function in a daemon thread
+    """
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+def _accept_connections(server, state, pipeline, launcher, remote=False):
+    """
+    Accept connections and handle each in its own thread
+
+    Args:
+        server (socket.socket): The listening socket
+        state (_FarmState): The server state
+        pipeline (aft.scheduler.Pipeline): The pipeline executing the jobs
+        launcher (_JobLauncher): The launcher starting the job processes
+        remote (boolean): True for the TCP socket, whose requests are
+            authenticated and restricted to the job root
+    """
+    while True:
+        connection, _ = server.accept()
+        _start_thread(_handle_connection, connection, state, pipeline,
+                      launcher, remote)
+
+
+def _report_to_coordinator(args, state):
+    """
+    Report the state of the devices of this harness to the coordinator
+    periodically, and whenever a job has finished.
+
+    Args:
+        args (argparse namespace argument object): Server arguments
+        state (_FarmState): The server state
+    """
+    address = args.listen
+    host, port = json_socket.parse_address(address)
+    if host == "":
+        address = "localhost:" + str(port)
+    elif host in ("0.0.0.0", "::"):
+        address = socket.getfqdn() + ":" + str(port)
+
+    while True:
+        state.devices_changed.clear()
+        try:
+            manager = DevicesManager(
+                args,
+                device_configs=state.get_device_configs(args))
+            coordinator.register(args.coordinator, address,
+                                 manager.get_inventory())
+        except (errors.AFTConfigurationError,
+                errors.AFTConnectionError) as err:
+            logger.warning("Failed to report to the coordinator: " + str(err))
+
+        state.devices_changed.wait(coordinator.HEARTBEAT_INTERVAL)
+
+
+def _maintain_devices(args, state):
+    """
+    Periodically reclaim the devices of hung jobs and warm idle devices
+
+    Args:
+        args (argparse namespace argument object): Server arguments
+        state (_FarmState): The server state
+    """
+    while True:
+        time.sleep(_MAINTENANCE_INTERVAL)
+        try:
+            manager = DevicesManager(
+                args,
+                device_configs=state.get_device_configs(args))
+            if manager.reclaim_expired_leases():
+                state.devices_changed.set()
+            manager.warm_idle_devices()
+        except errors.AFTConfigurationError as err:
+            logger.warning("Device maintenance failed: " + str(err))
+
+
+def _handle_connection(connection, state, pipeline, launcher, remote=False):
+    """
+    Read a job request from the connection, execute it in a forked process and
+    send the exit code back to the client.
+
+    Args:
+        connection (socket.socket): Client connection
+        state (_FarmState): The server state
+        pipeline (aft.scheduler.Pipeline): The pipeline executing the jobs
+        launcher (_JobLauncher): The launcher starting the job processes
+        remote (boolean): True if the connection was received over TCP
+    """
+    # Local import to avoid circular import, as aft.main imports this module
+    import aft.main
+
+    try:
+        request = json_socket.read_message(connection.makefile("rb"))
+        if not request:
+            return
+
+        if remote:
+            request = json_socket.authenticate(request)
+
+        logger.info("Received job: " + " ".join(request["argv"]))
+
+        job_args = None
+        try:
+            job_args = aft.main.parse_args(request["argv"])
+        except SystemExit:
+            # Invalid arguments. Let the job process parse them again so that
+            # the error message is sent to the client
+            pass
+
+        if remote:
+            _check_remote_request(request, job_args)
+
+        device_configs = None
+        try:
+            if job_args:
+                device_configs = state.get_device_configs(job_args)
+        except errors.AFTConfigurationError as err:
+            logger.warning("Failed to load configuration: " + str(err))
+
+        process = launcher.start(
+            _execute_job, (connection, request, device_configs, pipeline))
+        process.join()
+
+        exit_code = process.exitcode
+        if exit_code is None or exit_code < 0:
+            exit_code = 1
+
+        logger.info("Job finished with exit code " + str(exit_code))
+        state.devices_changed.set()
+        json_socket.send_message(connection, {"exit": exit_code})
+
+    except (IOError, OSError, ValueError) as err:
+        logger.warning("Job connection failed: " + str(err))
+
+    except (errors.AFTConnectionError, errors.AFTConfigurationError) as err:
+        logger.warning("Rejected job: " + str(err))
+        try:
+            json_socket.send_message(connection, {"output": str(err) + "\n"})
+            json_socket.send_message(connection, {"exit": 1})
+        except (IOError, OSError):
+            pass
+
+    finally:
+        connection.close()
+
+
+def _check_remote_request(request, job_args):
+    """
+    Check that a job received over TCP stays within the job root
+
+    Args:
+        request (dictionary): The job request
+        job_args (argparse namespace argument object): The parsed job
+            arguments, or None if they are invalid
+
+    Raises:
+        aft.errors.AFTConfigurationError if the job is not allowed
+    """
+    cwd = request.get("cwd")
+    if not isinstance(cwd, str) or not os.path.isabs(cwd) or \
+            not _is_in_directory(cwd, config.JOB_ROOT):
+        raise errors.AFTConfigurationError(
+            "Working directory must be in " + config.JOB_ROOT)
+
+    if not job_args:
+        return
+
+    for option in _REMOTE_FORBIDDEN_OPTIONS:
+        if getattr(job_args, option):
+            raise errors.AFTConfigurationError(
+                "--" + option + " is not allowed over TCP")
+
+    for option in ("catalog", "topology"):
+        path = os.path.join(cwd, getattr(job_args, option))
+        if not _is_in_directory(path, config.JOB_ROOT) and \
+                not _is_in_directory(path, _CONFIG_ROOT):
+            raise errors.AFTConfigurationError(
+                "--" + option + " must be in " + config.JOB_ROOT + " or " +
+                _CONFIG_ROOT)
+
+    for option in ("file_name", "jobs"):
+        path = getattr(job_args, option)
+        if path and not _is_in_directory(os.path.join(cwd, path),
+                                         config.JOB_ROOT):
+            raise errors.AFTConfigurationError(
+                option + " must be in " + config.JOB_ROOT)
+
+    if job_args.jobs:
+        _check_remote_jobs(os.path.join(cwd, job_args.jobs), cwd)
+
+
+def _check_remote_jobs(file_name, cwd):
+    """
+    Check that the jobs of a job file received over TCP stay within the job
+    root
+
+    Args:
+        file_name (str): Path to the job file
+        cwd (str): The working directory of the job, which relative image
+            paths are resolved against
+
+    Raises:
+        aft.errors.AFTConfigurationError if a job is not allowed
+    """
+    try:
+        jobs = batch.load_jobs(file_name, cwd)
+    except (IOError, OSError) as err:
+        raise errors.AFTConfigurationError(
+            "Failed to read job file " + file_name + ": " + str(err))
+
+    for job in jobs:
+        if job["image"] and not _is_in_directory(
+                os.path.join(cwd, str(job["image"])), config.JOB_ROOT):
+            raise errors.AFTConfigurationError(
+                "Image of job " + str(job["index"]) + " must be in " +
+                config.JOB_ROOT)
+
+        if job["test_plan"] is not None:
+            # Raises for names that would escape the test plan directory
+            tester.get_test_plan_file(job["test_plan"])
+
+
+def _is_in_directory(path, directory):
+    """
+    Return True if the path, with symbolic links resolved, is in the directory
+    """
+    path = os.path.realpath(path)
+    directory = os.path.realpath(directory)
+    return path == directory or path.startswith(directory.rstrip(os.sep) +
+                                                os.sep)
+
+
+def _execute_job(connection, request, device_configs, pipeline):
+    """
+    Job process entry point. Executes the job and exits with its exit code.
+
+    Args:
+        connection (socket.socket): Client connection
+        request (dictionary): The job request
+        device_configs (list(dictionary)):
+            Device configurations, or None if they must be read from the files
+        pipeline (aft.scheduler.Pipeline): The pipeline executing the job
+    """
+    import aft.main
+
+    exit_code = 1
+    try:
+        os.chdir(request["cwd"])
+        sys.stdout = _SocketWriter(connection)
+        sys.stderr = sys.stdout
+        logger.init_process()
+
+        args = aft.main.parse_args(request["argv"])
+        device_manager = None
+        if device_configs is not None:
+            device_manager = DevicesManager(args, device_configs=device_configs)
+
+        exit_code = aft.main.run(args, device_manager, pipeline)
+
+    except SystemExit as err:
+        exit_code = err.code if isinstance(err.code, int) else 1
+
+    except KeyboardInterrupt:
+        raise
+
+    except:
+        _err = sys.exc_info()
+        _err = str(_err[0]).split("'")[1] + ": " + str(_err[1])
+        logger.error(_err)
+        print(_err)
+
+    finally:
+        aft.main.stop_threads()
+        ssh.close_all()
+
+    sys.exit(exit_code)
+
+
+def _needs_placement(args):
+    """
+    Return True if the job runs on a machine or device that the coordinator
+    has to choose the harness of
+    """
+    if not args.machine and not args.device:
+        return False
+
+    return not any([getattr(args, option) for option in _LOCAL_OPTIONS])
+
+
+def submit(args, argv):
+    """
+    Send a job to the job server and print its output. With a coordinator,
+    jobs that flash or test a machine or a device are sent to the harness
+    chosen by the coordinator, and other jobs to the local job server.
+
+    Args:
+        args (argparse namespace argument object):
+            Command line arguments, as parsed by argparse
+        argv (list(str)):
+            Command line arguments without the program name. Client only
+            options are removed before the job is sent.
+
+    Returns:
+        The exit code of the job (integer)
+    """
+    job_argv = []
+    skip_next = False
+    for arg in argv:
+        if skip_next:
+            skip_next = False
+            continue
+        if arg.split("=")[0] in _CLIENT_OPTIONS:
+            # Options other than --submit take a value, unless given as
+            # --option=value
+            skip_next = arg != "--submit" and "=" not in arg
+            continue
+        job_argv.append(arg)
+
+    request = {"argv": job_argv, "cwd": os.getcwd()}
+    if args.coordinator and _needs_placement(args):
+        host, address = coordinator.place(args.coordinator, args.machine,
+                                          args.device)
+        print("Submitting the job to " + host)
+        connection = json_socket.connect(address)
+        request = json_socket.sign(request)
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(args.socket)
+        except socket.error as err:
+            raise errors.AFTConnectionError(
+                "Could not connect to job server at " + args.socket + ": " +
+                str(err))
+
+    try:
+        json_socket.send_message(connection, request)
+
+        connection_file = connection.makefile("rb")
+        while True:
+            message = json_socket.read_message(connection_file)
+            if message is None:
+                raise errors.AFTConnectionError(
+                    "Job server closed the connection unexpectedly")
+            if "output" in message:
+                sys.stdout.write(message["output"])
+                sys.stdout.flush()
+            if "exit" in message:
+                return message["exit"]
+    finally:
+        connection.close()
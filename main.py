@@ -19,25 +19,32 @@ Main entry point for aft.
 """
 
 import sys
+import time
+
+# Start profiling as early as possible, so that the imports below are included
+from aft.tools.import_profiler import ImportProfiler
+if "--import-profile" in sys.argv:
+    ImportProfiler.start()
+
 import os.path
 import argparse
 import logging
+from multiprocessing import Process
 
 import aft.config as config
-import aft.tools.device_configuration_checker as device_config
 from aft.logger import Logger as logger
 import aft.devices.common as common
 from aft.tools.thread_handler import Thread_handler as thread_handler
-from aft.tools.topology_builder import TopologyBuilder
-from aft.tools.edison_recovery_flasher import recover_edisons
+import aft.tools.ssh as ssh
 from aft.devicesmanager import DevicesManager
-from aft.tester import Tester
+from aft.tester import Tester, merge_results
 
 
 def main(argv=None):
     """
     Entry point for library-like use.
     """
+    backup_argv = sys.argv
 
     try:
         logger.init_root_logger()
@@ -46,7 +53,6 @@ def main(argv=None):
         config.parse()
 
         if argv != None:
-            backup_argv = sys.argv
             sys.argv = argv
 
         args = parse_args()
@@ -54,104 +60,195 @@ def main(argv=None):
         if args.debug:
             logger.level(logging.DEBUG)
 
-        if args.configure:
-            builder = TopologyBuilder(args)
-            builder.build_topology()
-            return 0
+        if args.import_profile:
+            ImportProfiler.start()
 
-        if args.check:
-            results = device_config.check(args)
-            logger.info(results[1])
-            print(results[1])
+        # The job server, its client and the coordinator are imported only
+        # when used
+        if args.coordinate:
+            import aft.coordinator as coordinator
+            return coordinator.serve(args)
 
-            if results[0] == True:
-                return 0
-            else:
-                return 1
-        elif args.checkall:
-            results = device_config.check_all(args)
-            logger.info(results[1])
-            print(results[1])
-
-            if results[0] == True:
-                logger.info("All tests passed")
-                return 0
-            else:
-                logger.info("There were failures")
-                return 1
+        if args.serve:
+            import aft.jobserver as jobserver
+            return jobserver.serve(args)
 
+        if args.submit:
+            import aft.jobserver as jobserver
+            return jobserver.submit(args, sys.argv[1:])
 
-        device_manager = DevicesManager(args)
+        return run(args)
 
-        if args.blacklist:
-            if not args.device:
-                print("Device must be specified for blacklisting")
-                return 1
+    except KeyboardInterrupt:
+        print("Keyboard interrupt, stopping aft")
+        logger.error("Keyboard interrupt, stopping aft.")
+        sys.exit(0)
 
-            device_manager.blacklist_device(args.device, args.reason)
-            return 0
+    except:
+        _err = sys.exc_info()
+        logger.error(str(_err[0]).split("'")[1] + ": " + str(_err[1]))
+        raise
 
-        if args.unblacklist:
-            if not args.device:
-                print("Device must be specified for unblacklisting")
-                return 1
-            device_manager.unblacklist_device(args.device)
-            return 0
+    finally:
+        sys.argv = backup_argv
+        stop_threads()
 
-        if args.blacklist_print:
-            device_manager.blacklist_print()
-            return 0
+        if ImportProfiler.is_started():
+            ImportProfiler.stop()
+            print(ImportProfiler.report())
+
+def stop_threads():
+    """
+    Signal the serial recorder threads to stop and wait for them to finish.
+    """
+    thread_handler.set_flag(thread_handler.RECORDERS_STOP)
+    for thread in thread_handler.get_threads():
+        thread.join(5)
+
+def run(args, device_manager=None, pipeline=None):
+    """
+    Execute the operation requested by already parsed command line arguments.
+
+    Args:
+        args (argparse namespace argument object):
+            Command line arguments, as parsed by argparse
+        device_manager (aft.DevicesManager):
+            Device manager to use. If None, one is constructed from the
+            configuration files.
+        pipeline (aft.scheduler.Pipeline):
+            If given, flashing and testing is executed in the stages of this
+            pipeline
+
+    Returns:
+        Process exit code (integer)
+    """
+    # Tools with heavy dependencies are imported only when used
+    if args.configure:
+        from aft.tools.topology_builder import TopologyBuilder
+        builder = TopologyBuilder(args)
+        builder.build_topology()
+        return 0
+
+    if args.check:
+        import aft.tools.device_configuration_checker as device_config
+        results = device_config.check(args)
+        logger.info(results[1])
+        print(results[1])
 
-        if args.recover_edisons:
-            recover_edisons(device_manager, args.verbose)
+        if results[0] == True:
             return 0
+        else:
+            return 1
+    elif args.checkall:
+        import aft.tools.device_configuration_checker as device_config
+        results = device_config.check_all(args)
+        logger.info(results[1])
+        print(results[1])
+
+        if results[0] == True:
+            logger.info("All tests passed")
+            return 0
+        else:
+            logger.info("There were failures")
+            return 1
 
-        if not args.machine:
-            print("Both machine and image must be specified")
+    if device_manager is None:
+        device_manager = DevicesManager(args)
+
+    if args.blacklist:
+        if not args.device:
+            print("Device must be specified for blacklisting")
             return 1
 
-        if not args.noflash:
-            if not args.file_name:
-                print("Both machine and image must be specified")
-                return 1
+        device_manager.blacklist_device(args.device, args.reason, args.ttl)
+        return 0
 
-            if not os.path.isfile(args.file_name):
-                print("Didn't find image: " + args.file_name)
-                logger.error("Didn't find image: " + args.file_name)
-                return 1
+    if args.unblacklist:
+        if not args.device:
+            print("Device must be specified for unblacklisting")
+            return 1
+        device_manager.unblacklist_device(args.device)
+        return 0
 
-        if args.device:
-            device, tester = try_flash_specific(args, device_manager)
-        else:
-            device, tester = try_flash_model(args, device_manager)
+    if args.blacklist_print:
+        device_manager.blacklist_print()
+        return 0
 
-        if not args.notest:
-            print("Testing " + str(device.name) + ".")
-            tester.execute()
+    if args.status:
+        device_manager.print_status(args.json)
+        return 0
 
-        if not args.nopoweroff:
-            device.detach()
+    if args.warm:
+        warmed = device_manager.warm_idle_devices()
+        print("Warmed " + str(len(warmed)) + " devices")
+        return 0
 
-        device_manager.release(device)
+    if args.reclaim:
+        reclaimed = device_manager.reclaim_expired_leases()
+        if len(reclaimed) == 0:
+            print("No expired leases")
+        return 0
 
-        if "backup_argv" in locals():
-            sys.argv = backup_argv
+    if args.recover_edisons:
+        from aft.tools.edison_recovery_flasher import recover_edisons
+        recover_edisons(device_manager, args.verbose)
         return 0
 
-    except KeyboardInterrupt:
-        print("Keyboard interrupt, stopping aft")
-        logger.error("Keyboard interrupt, stopping aft.")
-        sys.exit(0)
+    if args.jobs:
+        import aft.batch as batch
+        return batch.run_jobs(args, device_manager)
 
-    except:
-        _err = sys.exc_info()
-        logger.error(str(_err[0]).split("'")[1] + ": " + str(_err[1]))
-        raise
+    # Check the image before reserving any device
+    if (not args.noflash and args.file_name and
+            not os.path.isfile(args.file_name)):
+        print("Didn't find image: " + args.file_name)
+        logger.error("Didn't find image: " + args.file_name)
+        return 1
 
-    finally:
-        thread_handler.set_flag(thread_handler.RECORDERS_STOP)
-        for thread in thread_handler.get_threads():
-            thread.join(5)
+    if args.devices:
+        if args.device or args.fanout:
+            print("A device group cannot be used with --device or --fanout")
+            return 1
+
+        if not args.noflash and not args.file_name:
+            print("Image must be specified for flashing the device group")
+            return 1
+
+        return try_flash_group(args, device_manager)
+
+    if not args.machine:
+        print("Both machine and image must be specified")
+        return 1
+
+    if not args.noflash and not args.file_name:
+        print("Both machine and image must be specified")
+        return 1
+
+    if args.fanout:
+        if args.device:
+            print("Fan-out cannot be used with a specific device")
+            return 1
+
+        return try_flash_fanout(args, device_manager)
+
+    if pipeline is not None:
+        return pipeline.run_job(args, device_manager)
+
+    if args.device:
+        device, tester = try_flash_specific(args, device_manager)
+    else:
+        device, tester = try_flash_model(args, device_manager)
+
+    if not args.notest:
+        print("Testing " + str(device.name) + ".")
+        tester.execute()
+
+    if not args.nopoweroff:
+        device.detach()
+
+    device_manager.release(device)
+
+    return 0
 
 def try_flash_specific(args, device_manager):
     '''
@@ -204,52 +301,282 @@ def try_flash_model(args, device_manager):
         if args.noflash:
             return device, tester
 
-        flash_attempt = 0
-        flash_retries = args.flash_retries
+        try:
+            flash_device(args, device)
+            return device, tester
+
+        except KeyboardInterrupt:
+            raise
 
-        while flash_attempt < flash_retries:
-            flash_attempt += 1
+        except:
+            msg = "Flashing failed " + str(args.flash_retries) + " times"
+            print(msg + ", blacklisting " + str(device.name))
+            logger.info(msg + ", blacklisting " + str(device.name))
+            common.blacklist_device(device.dev_id, device.name, msg)
+            device_manager.release(device)
 
-            try:
-                print("Flashing " + str(device.name) + ", attempt " +
-                    str(flash_attempt) + " of " + str(flash_retries) + ".")
-                device.write_image(args.file_name)
-                print("Flashing successful.")
-                return device, tester
+            if machine_attempt < machine_retries:
+                print("Attempting flashing another machine")
 
-            except KeyboardInterrupt:
+            else:
+                raise
+
+def try_flash_group(args, device_manager):
+    '''
+    Reserve the group of devices given with --devices atomically, flash the
+    image to the devices of the model given as machine, or to all of them if
+    no machine is given, and run the test plan of the first device. Test
+    cases find the other devices of the group in device.group. All the
+    devices are released when done, also on failure.
+
+    Args:
+        args: AFT arguments
+        device_manager: Device manager object
+
+    Returns:
+        Process exit code (integer)
+    '''
+    devices = device_manager.reserve_many(args.devices)
+    print("Reserved " + ", ".join([str(device.name) for device in devices]) +
+          ".")
+
+    try:
+        if args.record:
+            for device in devices:
+                device.record_serial()
+
+        if not args.noflash:
+            for device in devices:
+                if (not args.machine or
+                        device.model.lower() == args.machine.lower()):
+                    flash_device(args, device)
+
+        if not args.notest:
+            print("Testing " + str(devices[0].name) + " with the group " +
+                  ", ".join([str(device.name) for device in devices]) + ".")
+            Tester(devices[0]).execute()
+
+        if not args.nopoweroff:
+            for device in devices:
+                device.detach()
+
+    finally:
+        for device in devices:
+            device_manager.release(device)
+
+    return 0
+
+def flash_device(args, device, write_image=None):
+    '''
+    Flash the image to the device, retrying up to args.flash_retries times.
+
+    Args:
+        args: AFT arguments
+        device: Reserved device
+        write_image: Function called with the image file name to flash the
+            device. Defaults to device.write_image
+
+    Raises:
+        The exception of the last failed flashing attempt
+    '''
+    if write_image is None:
+        write_image = device.write_image
+
+    flash_attempt = 0
+    flash_retries = args.flash_retries
+
+    while flash_attempt < flash_retries:
+        flash_attempt += 1
+
+        common.renew_lease(device.dev_id, "flash")
+        start_time = time.time()
+        try:
+            print("Flashing " + str(device.name) + ", attempt " +
+                str(flash_attempt) + " of " + str(flash_retries) + ".")
+            write_image(args.file_name)
+            print("Flashing successful.")
+            common.record_device_event(device.dev_id, "flash", True,
+                                       time.time() - start_time)
+            return
+
+        except KeyboardInterrupt:
+            raise
+
+        except:
+            _err = sys.exc_info()
+            _err = str(_err[0]).split("'")[1] + ": " + str(_err[1])
+            logger.error(_err)
+            print(_err)
+            common.record_device_event(device.dev_id, "flash", False,
+                                       time.time() - start_time)
+
+            if (flash_retries - flash_attempt) == 0:
                 raise
 
+            elif (flash_retries - flash_attempt) == 1:
+                print("Flashing failed, trying again one more time")
+
+            elif (flash_retries - flash_attempt) > 1:
+                print("Flashing failed, trying again " +
+                    str(flash_retries - flash_attempt) + " more times")
+
+def try_flash_fanout(args, device_manager):
+    '''
+    Reserve up to args.fanout machines of the model, and flash and test all of
+    them in parallel. Machines that fail flashing are blacklisted. The test
+    results of all the machines are merged into a single report.
+
+    Args:
+        args: AFT arguments
+        device_manager: Device manager object
+
+    Returns:
+        0 if all machines were flashed successfully, 1 otherwise
+    '''
+    if args.fanout == "all":
+        count = None
+    else:
+        count = int(args.fanout)
+
+    devices = device_manager.reserve_multiple(count)
+    print("Reserved " + ", ".join([str(device.name) for device in devices]) +
+          ".")
+
+    processes = []
+    exit_code = 0
+    try:
+        for device in devices:
+            # remove results of a previous run so that they do not get merged
+            results_file = _fanout_results_file_name(device)
+            if os.path.isfile(results_file):
+                os.remove(results_file)
+
+            process = Process(
+                target=_fanout_worker,
+                args=(args, device),
+                name=str(device.name))
+            process.start()
+            processes.append((device, process))
+
+        results_files = []
+        for device, process in processes:
+            process.join()
+
+            if process.exitcode != 0:
+                exit_code = 1
+                print("Flashing or testing " + str(device.name) + " failed.")
+
+            results_files.append((
+                "aft." + str(device.name),
+                os.path.join(os.getcwd(), _fanout_results_file_name(device))))
+
+        if not args.notest:
+            merged_file_name = os.path.join(os.getcwd(), "results.xml")
+            merge_results(results_files, merged_file_name)
+            print("Results for " + str(len(devices)) + " devices saved to " +
+                  merged_file_name + ".")
+
+    finally:
+        # Stop the workers still running, e.g. if the join was interrupted,
+        # so that the devices are not used after they are released
+        for device, process in processes:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+        for device in devices:
+            try:
+                if not args.nopoweroff:
+                    device.detach()
+            except KeyboardInterrupt:
+                raise
             except:
+                # Power off the rest of the devices regardless
                 _err = sys.exc_info()
-                _err = str(_err[0]).split("'")[1] + ": " + str(_err[1])
-                logger.error(_err)
-                print(_err)
+                logger.error("Powering off " + str(device.name) + " failed: " +
+                             str(_err[1]))
+            finally:
+                device_manager.release(device)
+
+    return exit_code
+
+def _fanout_results_file_name(device):
+    '''
+    Return the name of the results file of a single fan-out device
+    '''
+    return str(device.name) + "_results.xml"
+
+def _fanout_worker(args, device):
+    '''
+    Process entry point for flashing and testing a single fan-out device.
+    Logs are written to files prefixed with the device name. Exits with a
+    non-zero code if flashing or testing fails.
+
+    Args:
+        args: AFT arguments
+        device: Reserved device
+    '''
+    logger.init_process(str(device.name) + "_")
+    exit_code = 0
 
-                if (flash_retries - flash_attempt) == 0:
-                    msg = "Flashing failed " + str(flash_attempt) + " times"
-                    print(msg + ", blacklisting " + str(device.name))
-                    logger.info(msg + ", blacklisting " + str(device.name))
-                    common.blacklist_device(device.dev_id, device.name, msg)
-                    device_manager.release(device)
+    try:
+        tester = Tester(
+            device,
+            results_file_name=_fanout_results_file_name(device))
+
+        if args.record:
+            device.parameters["serial_log_name"] = \
+                str(device.name) + "_" + config.SERIAL_LOG_NAME
+            device.record_serial()
+
+        if not args.noflash:
+            try:
+                flash_device(args, device)
+            except KeyboardInterrupt:
+                raise
+            except:
+                msg = "Flashing failed " + str(args.flash_retries) + " times"
+                print(msg + ", blacklisting " + str(device.name))
+                logger.info(msg + ", blacklisting " + str(device.name))
+                common.blacklist_device(device.dev_id, device.name, msg)
+                sys.exit(1)
+
+        if not args.notest:
+            print("Testing " + str(device.name) + ".")
+            tester.execute()
 
-                    if machine_attempt < machine_retries:
-                        print("Attempting flashing another machine")
+    except KeyboardInterrupt:
+        exit_code = 1
 
-                    else:
-                        raise
+    except SystemExit as err:
+        exit_code = err.code
 
-                elif (flash_retries - flash_attempt) == 1:
-                    print("Flashing failed, trying again one more time")
+    except:
+        _err = sys.exc_info()
+        _err = str(_err[0]).split("'")[1] + ": " + str(_err[1])
+        logger.error(_err)
+        print(str(device.name) + ": " + _err)
+        exit_code = 1
 
-                elif (flash_retries - flash_attempt) > 1:
-                    print("Flashing failed, trying again " +
-                        str(flash_retries - flash_attempt) + " more times")
+    finally:
+        stop_threads()
+        ssh.close_all()
 
-def parse_args():
+    sys.exit(exit_code)
+
+def parse_args(argv=None):
     """
     Argument parsing
+
+    Args:
+        argv (list(str)):
+            Arguments to parse, without the program name. Defaults to
+            sys.argv[1:]
     """
+    # Only needed for the stage names. Its dependencies are imported by this
+    # module anyway.
+    import aft.scheduler as scheduler
+
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -302,6 +629,30 @@ def parse_args():
         default="2",
         help="Specify how many time flashing one machine will be tried.")
 
+    parser.add_argument(
+        "--max-wait",
+        type=int,
+        action="store",
+        default=0,
+        help=("Maximum number of seconds to wait for a device. Waiting is "
+            "given up as soon as the estimated wait is longer."))
+
+    parser.add_argument(
+        "--devices",
+        action="store",
+        help=("Reserve a group of devices atomically, e.g. "
+            "'2xMinnowboardMAX + 1xEdison', and run the test plan of the "
+            "first device with the whole group available to the test cases. "
+            "The image is flashed to the devices of the given machine model, "
+            "or to all of them if no machine is given"))
+
+    parser.add_argument(
+        "--prefer-fastest-model",
+        action="store_true",
+        help=("Reserve a device of the model listed in the equivalent_models "
+            "catalog option of the machine that is expected to be available "
+            "first"))
+
     parser.add_argument(
         "--record",
         action="store_true",
@@ -373,6 +724,15 @@ def parse_args():
         help=("Removes device from the blacklist. The device must be specified"
             "with --device."))
 
+    parser.add_argument(
+        "--ttl",
+        type=int,
+        action="store",
+        default=0,
+        help=("Seconds after which a device blacklisted with --blacklist "
+              "returns to the pool. By default, the device stays blacklisted "
+              "until it is unblacklisted"))
+
     parser.add_argument(
         "--reason",
         action="store",
@@ -384,12 +744,119 @@ def parse_args():
         action="store_true",
         help="Print the contents of the blacklist")
 
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help=("Print the reservation, blacklist and job phase of every "
+            "device"))
+
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Print the --status output as JSON")
+
+    parser.add_argument(
+        "--reclaim",
+        action="store_true",
+        help=("Power off and release the devices of jobs that have not "
+            "renewed their reservation within the lease time"))
+
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help=("Boot idle devices into service mode for the expected demand, "
+            "up to warm_pool_size devices per model"))
+
     parser.add_argument(
         "--recover_edisons",
         action="store_true",
         help="Lock all Edisons and recover blacklisted ones")
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--fanout",
+        type=_fanout_count,
+        action="store",
+        help=("Flash and test the image on up to N devices of the model in "
+            "parallel, or on all of them with 'all'. Test results are merged "
+            "into a single report"))
+
+    parser.add_argument(
+        "--jobs",
+        action="store",
+        help=("Run the (machine, image, test plan) jobs listed in the given "
+            "YAML/JSON file. Jobs are grouped to flash each image once per "
+            "model and to minimize device mode changes"))
+
+    parser.add_argument(
+        "--import-profile",
+        action="store_true",
+        help="Print how long importing each module took")
+
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help=("Run as a resident job server that keeps the farm configuration "
+            "loaded and executes jobs received through --socket"))
+
+    parser.add_argument(
+        "--submit",
+        action="store_true",
+        help=("Send the rest of the command line to a running job server "
+            "instead of executing it in this process"))
+
+    parser.add_argument(
+        "--stage_limits",
+        action="store",
+        help=("Job server per-stage concurrency limits as comma separated "
+            "stage=limit pairs. A limit can be restricted to a platform with "
+            "stage:platform=limit, e.g. 'flash=4,flash:edison=1'. Stages: " +
+            ", ".join(scheduler.STAGES)),
+        default=config.STAGE_LIMITS)
+
+    parser.add_argument(
+        "--socket",
+        action="store",
+        help="Unix socket used by the job server",
+        default=config.JOB_SERVER_SOCKET)
+
+    parser.add_argument(
+        "--listen",
+        action="store",
+        help=("host:port the job server also accepts jobs on over TCP. "
+            "Without a host, only local connections are accepted. Requires "
+            "farm_secret. Required for reporting to a "
+            "coordinator"),
+        default=config.JOB_SERVER_ADDRESS)
+
+    parser.add_argument(
+        "--coordinator",
+        action="store",
+        help=("host:port of the farm coordinator. Job servers report their "
+            "devices to it, and --submit asks it which harness runs the job"),
+        default=config.COORDINATOR)
+
+    parser.add_argument(
+        "--coordinate",
+        action="store_true",
+        help="Run the farm coordinator, listening on --coordinator")
+
+    return parser.parse_args(argv)
+
+def _fanout_count(value):
+    """
+    Argument type for --fanout: positive integer or 'all'
+    """
+    if value == "all":
+        return value
+
+    try:
+        count = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be a number or 'all'")
+
+    if count < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return value
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,152 @@
+# coding=utf-8
+# Copyright (c) 2013-2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Lazy registry of device, cutter and test case classes.
+
+Classes are registered as "module:Class" strings and the module is imported
+only when the class is first requested. This keeps the backends and their
+dependencies (PEM, netifaces, pyserial...) out of invocations that do not use
+them.
+
+In addition to the built-in classes, other packages can provide classes
+through setuptools entry points, e.g. in their setup.py:
+
+    entry_points = {"aft.devices": ["mydevice = mypackage.mydevice:MyDevice"]}
+
+Entry points are only scanned when a name is not found among the registered
+classes, as scanning the installed packages is slow.
+"""
+
+import importlib
+
+import aft.errors as errors
+
+
+def _iter_entry_points(group):
+    """
+    Return the setuptools entry points of the given group
+
+    Args:
+        group (str): Entry point group name
+
+    Returns:
+        List of (name, "module:attribute") tuples. Empty list if neither
+        importlib.metadata nor pkg_resources is available.
+    """
+    try:
+        from importlib import metadata
+        entry_points = metadata.entry_points()
+        if hasattr(entry_points, "select"):
+            entry_points = entry_points.select(group=group)
+        else:
+            entry_points = entry_points.get(group, [])
+        return [(entry_point.name, entry_point.value)
+                for entry_point in entry_points]
+    except ImportError:
+        pass
+
+    try:
+        import pkg_resources
+    except ImportError:
+        return []
+
+    return [(entry_point.name,
+             entry_point.module_name + ":" + ".".join(entry_point.attrs))
+            for entry_point in pkg_resources.iter_entry_points(group)]
+
+
+class Registry(object):
+    """
+    Maps names to lazily imported classes.
+    """
+
+    def __init__(self, kind, entry_point_group, classes):
+        """
+        Constructor
+
+        Args:
+            kind (str): Human readable kind of the classes, used in errors
+            entry_point_group (str): setuptools entry point group name
+            classes (dictionary): name -> "module:Class" of the built-ins
+        """
+        self._kind = kind
+        self._entry_point_group = entry_point_group
+        self._targets = {}
+        self._entry_points_loaded = False
+
+        for name, target in classes.items():
+            self.register(name, target)
+
+    def register(self, name, target):
+        """
+        Register a class
+
+        Args:
+            name (str): Name of the class, case insensitive
+            target (str or class): "module:Class" string or the class itself
+        """
+        self._targets[name.lower()] = target
+
+    def names(self):
+        """
+        Return the names of all the available classes, including the ones
+        provided through entry points.
+        """
+        self._load_entry_points()
+        return sorted(self._targets.keys())
+
+    def get(self, name):
+        """
+        Return the class registered with the name, importing it if needed
+
+        Args:
+            name (str): Name of the class, case insensitive
+
+        Returns:
+            The class
+
+        Raises:
+            aft.errors.AFTConfigurationError if no class has been registered
+            with the name
+        """
+        name = name.lower()
+
+        if name not in self._targets:
+            self._load_entry_points()
+
+        if name not in self._targets:
+            raise errors.AFTConfigurationError(
+                "Unknown " + self._kind + " '" + name + "'. Available: " +
+                ", ".join(self.names()))
+
+        target = self._targets[name]
+        if isinstance(target, str):
+            module_name, class_name = target.split(":")
+            module = importlib.import_module(module_name)
+            target = getattr(module, class_name)
+            self._targets[name] = target
+
+        return target
+
+    def _load_entry_points(self):
+        """
+        Register the classes provided through entry points. Built-in classes
+        take precedence.
+        """
+        if self._entry_points_loaded:
+            return
+        self._entry_points_loaded = True
+
+        for name, target in _iter_entry_points(self._entry_point_group):
+            if name.lower() not in self._targets:
+                self.register(name, target)
@@ -0,0 +1,312 @@
+# coding=utf-8
+# Copyright (c) 2013-2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Pipelined flash and test scheduling for the job server.
+
+A job is split into stages (reserve, stage image, enter service mode, flash,
+boot test mode, test, collect logs and release). Every job runs in its own
+process and proceeds through the stages independently of the other jobs, so
+that different jobs can be in different stages at the same time. Stages that
+compete for a shared resource, such as the nfs server or the DFU bus, can be
+given a concurrency limit, either for all devices or per platform.
+"""
+
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+
+import aft.config as config
+import aft.errors as errors
+import aft.devices.common as common
+from aft.tester import Tester
+from aft.logger import Logger as logger
+
+STAGES = (
+    "reserve",
+    "stage",
+    "service_mode",
+    "flash",
+    "test_mode",
+    "test",
+    "logs",
+    "release")
+
+# Seconds between attempts to take a slot of a full stage
+_SLOT_POLLING_INTERVAL = 0.5
+
+
+def parse_stage_limits(limits):
+    """
+    Parse stage concurrency limits
+
+    Args:
+        limits (str):
+            Comma separated stage=limit or stage:platform=limit pairs, e.g.
+            "flash=4,flash:edison=1"
+
+    Returns:
+        Dictionary mapping "stage" or "stage:platform" to the limit (integer)
+
+    Raises:
+        aft.errors.AFTConfigurationError if the limits are malformed
+    """
+    stage_limits = {}
+
+    for item in limits.split(","):
+        item = item.strip()
+        if item == "":
+            continue
+
+        try:
+            key, limit = item.split("=")
+            key = key.strip().lower()
+            limit = int(limit)
+        except ValueError:
+            raise errors.AFTConfigurationError(
+                "Invalid stage limit '" + item + "'")
+
+        if key.split(":")[0] not in STAGES:
+            raise errors.AFTConfigurationError(
+                "Unknown stage '" + key.split(":")[0] + "'")
+
+        if limit < 1:
+            raise errors.AFTConfigurationError(
+                "Stage limit must be at least 1: '" + item + "'")
+
+        stage_limits[key] = limit
+
+    return stage_limits
+
+
+class _StageSlots(object):
+    """
+    Concurrency limit of a stage, shared between processes.
+
+    Each slot is a file in the lock directory, and a process holds a slot by
+    keeping the file flocked. The kernel releases the lock when the process
+    dies, so jobs that are killed in the middle of a stage do not leak their
+    slot.
+    """
+
+    def __init__(self, key, limit):
+        """
+        Constructor
+
+        Args:
+            key (str): "stage" or "stage:platform"
+            limit (integer): Number of slots
+        """
+        directory = os.path.join(config.LOCK_FILE, "aft_stages")
+        common.make_directory(directory)
+        name = key.replace(":", "_").replace(os.sep, "_")
+        self._paths = [os.path.join(directory, name + "." + str(index))
+                       for index in range(limit)]
+
+    def acquire(self):
+        """
+        Wait for a free slot and take it
+
+        Returns:
+            The slot, to be given to release()
+        """
+        while True:
+            for path in self._paths:
+                slot = open(path, "a")
+                try:
+                    fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return slot
+                except IOError:
+                    slot.close()
+            time.sleep(_SLOT_POLLING_INTERVAL)
+
+    @staticmethod
+    def release(slot):
+        """
+        Free a slot taken with acquire()
+        """
+        slot.close()
+
+
+class Pipeline(object):
+    """
+    Executes jobs stage by stage, honoring the per-stage concurrency limits.
+
+    The limits are enforced with slot files locked by the job processes, and
+    are shared by all the pipelines of the host with the same limits.
+    """
+
+    def __init__(self, stage_limits):
+        """
+        Constructor
+
+        Args:
+            stage_limits (dictionary):
+                Stage concurrency limits, as returned by parse_stage_limits()
+        """
+        self._slots = {}
+        for key, limit in stage_limits.items():
+            self._slots[key] = _StageSlots(key, limit)
+
+    @contextmanager
+    def stage(self, name, platform=None, device=None):
+        """
+        Context manager that executes its body as the given stage. Blocks until
+        the stage has capacity for the platform.
+
+        Args:
+            name (str): Stage name
+            platform (str): Platform of the device, or None if not known yet
+            device (aft.Device): The reserved device. If given, the stage is
+                recorded as the phase of the job and the lease of the
+                reservation is renewed.
+        """
+        stage_slots = []
+        for key in [name, name + ":" + str(platform).lower()]:
+            if key in self._slots:
+                stage_slots.append(self._slots[key])
+
+        start = time.time()
+        held = []
+        try:
+            for slots in stage_slots:
+                held.append((slots, slots.acquire()))
+        except:
+            for slots, slot in reversed(held):
+                slots.release(slot)
+            raise
+
+        waited = time.time() - start
+        if waited >= 1:
+            logger.info("Waited " + str(int(waited)) + " seconds for stage " +
+                        name)
+
+        if device:
+            common.renew_lease(device.dev_id, name)
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            for slots, slot in reversed(held):
+                slots.release(slot)
+            logger.info("Stage " + name + " took " +
+                        str(int(time.time() - start)) + " seconds")
+
+    def run_job(self, args, device_manager):
+        """
+        Reserve, flash and test a device, as requested by the job arguments.
+
+        If flashing fails args.flash_retries times, the device is blacklisted
+        and, unless a specific device was requested, another device is tried up
+        to args.machine_retries times.
+
+        Args:
+            args (argparse namespace argument object): Job arguments
+            device_manager (aft.DevicesManager): Device manager
+
+        Returns:
+            Exit code (integer)
+        """
+        # Local import to avoid circular import, as aft.main imports this module
+        import aft.main
+
+        machine_attempt = 0
+
+        while True:
+            machine_attempt += 1
+
+            with self.stage("reserve"):
+                if args.device:
+                    device = device_manager.reserve_specific(
+                        args.device,
+                        model=args.machine)
+                else:
+                    device = device_manager.reserve()
+
+            platform = device.parameters["platform"]
+
+            try:
+                if args.record:
+                    device.record_serial()
+
+                if not args.noflash:
+                    try:
+                        aft.main.flash_device(
+                            args,
+                            device,
+                            lambda file_name: self._write_image(
+                                device, platform, file_name))
+                    except KeyboardInterrupt:
+                        raise
+                    except:
+                        msg = ("Flashing failed " + str(args.flash_retries) +
+                               " times")
+                        print(msg + ", blacklisting " + str(device.name))
+                        logger.info(msg + ", blacklisting " + str(device.name))
+                        common.blacklist_device(device.dev_id, device.name, msg)
+
+                        if args.device or machine_attempt >= args.machine_retries:
+                            raise
+
+                        print("Attempting flashing another machine")
+                        continue
+
+                if not args.notest:
+                    self._test(device, platform)
+
+                return 0
+
+            finally:
+                with self.stage("release", platform, device):
+                    if not args.nopoweroff:
+                        device.detach()
+                    device_manager.release(device)
+
+    def _write_image(self, device, platform, file_name):
+        """
+        Write the image to the device, executing each step as its own stage
+
+        Args:
+            device (aft.Device): The device
+            platform (str): Device platform
+            file_name (str): The image file name
+        """
+        with self.stage("stage", platform, device):
+            device.prepare_image(file_name)
+
+        with self.stage("service_mode", platform, device):
+            device.enter_service_mode()
+
+        with self.stage("flash", platform, device):
+            device.flash(file_name)
+
+    def _test(self, device, platform):
+        """
+        Boot the device into test mode, run the test plan and store the results
+
+        Args:
+            device (aft.Device): The device
+            platform (str): Device platform
+        """
+        tester = Tester(device)
+
+        with self.stage("test_mode", platform, device):
+            device.enter_test_mode()
+
+        print("Testing " + str(device.name) + ".")
+        with self.stage("test", platform, device):
+            tester.execute(save_results=False)
+
+        with self.stage("logs", platform, device):
+            tester.save_results()
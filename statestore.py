@@ -0,0 +1,827 @@
+# coding=utf-8
+# Copyright (c) 2013-2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Device reservations and the device blacklist, stored in a SQLite database
+shared by all the AFT processes of the host.
+
+The database is used in WAL mode, so that reading the state never blocks and
+is never blocked by other processes. Opening an up to date database only
+reads it, so that status queries never take the write lock.
+
+Every change is a single short transaction, so that reserving a device is
+atomic: a device can never be reserved by two processes, and a blacklisted
+device can never be reserved.
+
+Reservations record the process that owns them, with its start time so that
+a new process reusing the pid is not mistaken for the owner. Reservations of
+processes that no longer exist are removed when a reservation is attempted.
+
+Reservations are leases: the owner renews the heartbeat of the reservation as
+the job makes progress. Reservations whose heartbeat is older than the lease
+time belong to hung jobs, and are reclaimed by the supervisor
+(DevicesManager.reclaim_expired_leases).
+
+Blacklist entries count how many times in a row the device has been
+blacklisted, and can expire. Expired entries no longer prevent reserving the
+device, but are kept so that the failure count continues from where it was if
+the device is blacklisted again. A successful flash of the device removes its
+expired entry, which resets the count.
+
+The history of each device (reservations and how long they were held,
+flashing and boot attempts and health checks with their durations) is kept
+for selecting the device most likely to produce results quickly, and for
+estimating how long waiting for a device takes.
+
+Idle devices that the warm pool has left booted are recorded with the mode
+they were booted into. The record is removed when the device is reserved.
+
+When the database is created, the entries of the old text blacklist file
+(config.DEVICE_BLACKLIST) of existing installations are imported to it. The
+file is not read afterwards: the blacklist is only changed with 'aft
+--blacklist' and 'aft --unblacklist'.
+"""
+
+import os
+import time
+import errno
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import aft.errors as errors
+import aft.config as config
+from aft.logger import Logger as logger
+
+# Schema changes, one per schema version. The database is upgraded by
+# executing the statements of the versions newer than its own.
+_MIGRATIONS = [
+    # Version 1: reservations and the blacklist
+    """
+    CREATE TABLE reservations (
+        device_id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        model TEXT NOT NULL,
+        owner_pid INTEGER NOT NULL,
+        started REAL NOT NULL
+    );
+    CREATE INDEX reservations_model ON reservations (model);
+    CREATE TABLE blacklist (
+        device_id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        reason TEXT NOT NULL,
+        time REAL NOT NULL
+    );
+    CREATE INDEX blacklist_name ON blacklist (name);
+    """,
+    # Version 2: blacklist failure count and expiry
+    """
+    ALTER TABLE blacklist ADD COLUMN failures INTEGER NOT NULL DEFAULT 1;
+    ALTER TABLE blacklist ADD COLUMN expires REAL;
+    """,
+    # Version 3: device history
+    """
+    CREATE TABLE history (
+        device_id TEXT NOT NULL,
+        event TEXT NOT NULL,
+        success INTEGER NOT NULL,
+        duration REAL,
+        time REAL NOT NULL
+    );
+    CREATE INDEX history_device ON history (device_id, event, time);
+    """,
+    # Version 4: reservation heartbeats
+    """
+    ALTER TABLE reservations ADD COLUMN heartbeat REAL NOT NULL DEFAULT 0;
+    UPDATE reservations SET heartbeat = started;
+    """,
+    # Version 5: phase of the job holding the reservation
+    """
+    ALTER TABLE reservations ADD COLUMN phase TEXT NOT NULL
+        DEFAULT 'reserved';
+    """,
+    # Version 6: idle devices kept booted by the warm pool
+    """
+    CREATE TABLE warm (
+        device_id TEXT PRIMARY KEY,
+        mode TEXT NOT NULL,
+        time REAL NOT NULL
+    );
+    """,
+    # Version 7: start time of the process owning the reservation
+    """
+    ALTER TABLE reservations ADD COLUMN owner_start INTEGER;
+    """
+]
+
+# Number of the most recent events of each kind kept for each device
+_HISTORY_LENGTH = 20
+
+# Maximum number of times the time to live of a blacklist entry is doubled
+# for the previous failures of the device
+_MAX_BLACKLIST_DOUBLINGS = 6
+
+# Condition selecting the blacklist entries that are in effect at time ?
+_ACTIVE_BLACKLIST = "(expires IS NULL OR expires > ?)"
+
+# Seconds to wait for another process to finish its transaction
+_BUSY_TIMEOUT = 30
+
+_STORE = None
+
+
+def get_store():
+    """
+    Return the state store of the host, as configured in
+    config.STATE_DATABASE
+
+    Returns:
+        StateStore
+    """
+    global _STORE
+
+    if _STORE is None or _STORE.path != config.STATE_DATABASE:
+        _STORE = StateStore(config.STATE_DATABASE)
+
+    return _STORE
+
+
+def get_process_start_time(pid):
+    """
+    Return the start time of a process, which tells the process apart from
+    later processes with the same pid
+
+    Args:
+        pid (integer): The process id
+
+    Returns:
+        The start time in clock ticks after boot (integer), or None if the
+        process does not exist or the time is not available
+    """
+    try:
+        with open("/proc/" + str(pid) + "/stat", "r") as stat_file:
+            # The fields after the command name, which may contain spaces,
+            # start from the third field. The start time is the 22nd field.
+            return int(stat_file.read().rsplit(")", 1)[1].split()[19])
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def is_owner_alive(pid, start_time):
+    """
+    Check if the process that owns a reservation still exists
+
+    Args:
+        pid (integer): The process id
+        start_time (integer): Start time of the process when it made the
+            reservation, as returned by get_process_start_time(), or None if
+            unknown
+
+    Returns:
+        True if the process exists and has not been replaced by another
+        process with the same pid
+    """
+    if not _is_process_alive(pid):
+        return False
+
+    if start_time is None:
+        return True
+
+    current_start_time = get_process_start_time(pid)
+    return current_start_time is None or current_start_time == start_time
+
+
+def _is_process_alive(pid):
+    """
+    Check if a process with the given pid exists
+
+    Args:
+        pid (integer): The process id
+
+    Returns:
+        True if the process exists
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+
+    # Processes that have exited but have not been reaped yet still exist
+    try:
+        with open("/proc/" + str(pid) + "/stat", "r") as stat_file:
+            return stat_file.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (IOError, IndexError):
+        return True
+
+
+class StateStore(object):
+    """
+    Transactional store of the reservations and the blacklist.
+
+    The database connection is opened on first use. Each thread, and each
+    process forked after the connection was opened, opens its own
+    connection, as SQLite connections must not be shared between threads or
+    processes.
+    """
+
+    def __init__(self, path):
+        """
+        Constructor
+
+        Args:
+            path (str): Path to the database file
+        """
+        self.path = path
+        # Connection of the thread, and the pid of the process that opened it
+        self._local = threading.local()
+        # device id -> pid of the process that reserved the device through
+        # this store. Processes forked by the owner, e.g. fan-out workers,
+        # inherit it and renew the lease on behalf of the owner.
+        self._owners = {}
+
+    def _connect(self):
+        """
+        Return the connection of the current thread, opening and, if
+        needed, initializing the database
+
+        Returns:
+            sqlite3.Connection
+
+        Raises:
+            aft.errors.AFTConfigurationError if the database cannot be opened
+        """
+        if (getattr(self._local, "connection", None) is not None and
+                self._local.pid == os.getpid()):
+            return self._local.connection
+
+        directory = os.path.dirname(self.path)
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            connection = sqlite3.connect(
+                self.path,
+                timeout=_BUSY_TIMEOUT,
+                isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+        except (OSError, sqlite3.Error) as err:
+            raise errors.AFTConfigurationError(
+                "Cannot open state database " + self.path + ": " + str(err))
+
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        self._initialize()
+
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Context manager that executes its body as a single write transaction
+        and yields the connection
+        """
+        connection = self._connect()
+        # Take the write lock immediately, so that the state cannot change
+        # between the reads and the writes of the transaction
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _initialize(self):
+        """
+        Create or upgrade the tables, and import the old blacklist file if
+        the database is new
+        """
+        connection = self._connect()
+        if (connection.execute("PRAGMA user_version").fetchone()[0] >=
+                len(_MIGRATIONS)):
+            return
+
+        with self._transaction() as connection:
+            # Another process may have upgraded the database meanwhile
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(_MIGRATIONS):
+                return
+
+            for index in range(version, len(_MIGRATIONS)):
+                for statement in _MIGRATIONS[index].split(";"):
+                    if statement.strip():
+                        connection.execute(statement)
+
+                if index == 0:
+                    self._import_blacklist_file(connection)
+
+            connection.execute("PRAGMA user_version=" + str(len(_MIGRATIONS)))
+
+    def _import_blacklist_file(self, connection):
+        """
+        Import the entries of the text blacklist file
+
+        Args:
+            connection (sqlite3.Connection): Connection in a transaction
+        """
+        try:
+            with open(config.DEVICE_BLACKLIST, "r") as blacklist_file:
+                lines = blacklist_file.readlines()
+        except IOError:
+            return
+
+        for line in lines:
+            values = line.split()
+            if len(values) < 2:
+                continue
+            connection.execute(
+                "INSERT OR REPLACE INTO blacklist " +
+                "(device_id, name, reason, time) VALUES (?, ?, ?, ?)",
+                (values[0], values[1], " ".join(values[2:]), time.time()))
+
+        logger.info("Imported " + str(len(lines)) + " blacklist entries from " +
+                    config.DEVICE_BLACKLIST)
+
+    def reserve(self, candidates, record_event=True):
+        """
+        Reserve the first free, non-blacklisted device of the candidates for
+        the current process
+
+        Args:
+            candidates (list((str, str, str))):
+                (device id, device name, device model) tuples in the order of
+                preference
+            record_event (boolean): Whether the reservation is recorded in the
+                device history. Only reservations for jobs are recorded.
+
+        Returns:
+            The id of the reserved device, or None if all the candidates are
+            reserved or blacklisted
+        """
+        device_ids = self.reserve_group([(1, candidates)], record_event)
+        if device_ids is None:
+            return None
+        return device_ids[0]
+
+    def reserve_group(self, groups, record_event=True):
+        """
+        Reserve free, non-blacklisted devices from each group of candidates
+        for the current process. Either all the requested devices are
+        reserved, or none.
+
+        Args:
+            groups (list((integer, list((str, str, str))))):
+                (count, candidates) tuples, where count devices are reserved
+                from the candidates. Candidates are (device id, device name,
+                device model) tuples in the order of preference.
+            record_event (boolean): Whether the reservations are recorded in
+                the device history
+
+        Returns:
+            List of the ids of the reserved devices, in the order of the
+            groups, or None if some group does not have enough available
+            candidates
+        """
+        ids = []
+        for _, candidates in groups:
+            ids.extend([candidate[0] for candidate in candidates])
+        if len(ids) == 0:
+            return None
+
+        placeholders = ", ".join(["?"] * len(ids))
+
+        with self._transaction() as connection:
+            unavailable = set()
+
+            rows = connection.execute(
+                "SELECT device_id, owner_pid, owner_start FROM reservations " +
+                "WHERE device_id IN (" + placeholders + ")", ids)
+            for device_id, owner_pid, owner_start in rows.fetchall():
+                if is_owner_alive(owner_pid, owner_start):
+                    unavailable.add(device_id)
+                else:
+                    logger.info("Removing stale reservation of device " +
+                                device_id + " by process " + str(owner_pid))
+                    connection.execute(
+                        "DELETE FROM reservations WHERE device_id = ?",
+                        (device_id,))
+
+            rows = connection.execute(
+                "SELECT device_id FROM blacklist " +
+                "WHERE device_id IN (" + placeholders + ") AND " +
+                _ACTIVE_BLACKLIST, ids + [time.time()])
+            unavailable.update([row[0] for row in rows.fetchall()])
+
+            chosen = []
+            for count, candidates in groups:
+                available = [candidate for candidate in candidates
+                             if candidate[0] not in unavailable]
+                if len(available) < count:
+                    return None
+
+                chosen.extend(available[:count])
+                unavailable.update(
+                    [candidate[0] for candidate in available[:count]])
+
+            now = time.time()
+            owner_start = get_process_start_time(os.getpid())
+            for device_id, name, model in chosen:
+                connection.execute(
+                    "INSERT INTO reservations " +
+                    "(device_id, name, model, owner_pid, owner_start, " +
+                    "started, heartbeat) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (device_id, name.lower(), model.lower(), os.getpid(),
+                     owner_start, now, now))
+                self._owners[device_id] = os.getpid()
+                if record_event:
+                    self._insert_event(connection, device_id, "reserve", True)
+
+        return [candidate[0] for candidate in chosen]
+
+    def release(self, device_id, record_job=True):
+        """
+        Release a device reserved by the current process
+
+        Args:
+            device_id (str): The device id
+            record_job (boolean): Whether the time the reservation was held is
+                recorded in the device history, for estimating waiting times
+        """
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT started FROM reservations WHERE device_id = ? AND " +
+                "owner_pid = ?", (device_id, os.getpid())).fetchone()
+            if row is None:
+                return
+
+            connection.execute(
+                "DELETE FROM reservations WHERE device_id = ?", (device_id,))
+            self._owners.pop(device_id, None)
+            if record_job:
+                self._insert_event(connection, device_id, "job", True,
+                                   time.time() - row[0])
+
+    def renew(self, device_id, phase=None):
+        """
+        Renew the lease of a device reserved by the current process, or by
+        the process that forked it
+
+        Args:
+            device_id (str): The device id
+            phase (str): The phase the job has entered, or None if unchanged
+
+        Returns:
+            True if the reservation is still held
+        """
+        owner_pid = self._owners.get(device_id, os.getpid())
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE reservations SET heartbeat = ?, " +
+                "phase = COALESCE(?, phase) WHERE device_id = ? " +
+                "AND owner_pid = ?",
+                (time.time(), phase, device_id, owner_pid))
+            return cursor.rowcount > 0
+
+    def take_over(self, device_id, owner_pid, heartbeat):
+        """
+        Transfer the reservation of a device to the current process, if it
+        has not changed since it was read
+
+        Args:
+            device_id (str): The device id
+            owner_pid (integer): The expected owner of the reservation
+            heartbeat (float): The expected heartbeat of the reservation
+
+        Returns:
+            True if the reservation was transferred
+        """
+        with self._transaction() as connection:
+            now = time.time()
+            cursor = connection.execute(
+                "UPDATE reservations SET owner_pid = ?, owner_start = ?, " +
+                "started = ?, heartbeat = ?, phase = 'reclaim' " +
+                "WHERE device_id = ? AND owner_pid = ? AND heartbeat = ?",
+                (os.getpid(), get_process_start_time(os.getpid()), now, now,
+                 device_id, owner_pid, heartbeat))
+            if cursor.rowcount == 0:
+                return False
+            self._owners[device_id] = os.getpid()
+            return True
+
+    def get_reservations(self, model=None):
+        """
+        Return the current reservations
+
+        Args:
+            model (str): Only return reservations of this model
+
+        Returns:
+            List of dictionaries with the keys "id", "name", "model",
+            "owner_pid", "owner_start", "started", "heartbeat" and "phase"
+        """
+        query = ("SELECT device_id, name, model, owner_pid, started, " +
+                 "heartbeat, phase, owner_start FROM reservations")
+        parameters = ()
+        if model:
+            query += " WHERE model = ?"
+            parameters = (model.lower(),)
+
+        rows = self._connect().execute(query + " ORDER BY name", parameters)
+        return [{"id": row[0], "name": row[1], "model": row[2],
+                 "owner_pid": row[3], "started": row[4], "heartbeat": row[5],
+                 "phase": row[6], "owner_start": row[7]}
+                for row in rows.fetchall()]
+
+    def blacklist(self, device_id, name, reason, ttl=None):
+        """
+        Add a device to the blacklist. If the device has been blacklisted
+        before, its failure count is incremented and the reason replaced.
+
+        Args:
+            device_id (str): The device id
+            name (str): The device name
+            reason (str): Reason for blacklisting
+            ttl (float): Seconds after which the entry expires, doubled for
+                each previous failure, up to _MAX_BLACKLIST_DOUBLINGS times.
+                If None, the entry never expires.
+
+        Returns:
+            The failure count of the device (integer)
+        """
+        now = time.time()
+
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT failures FROM blacklist WHERE device_id = ?",
+                (device_id,)).fetchone()
+            failures = row[0] + 1 if row else 1
+
+            expires = None
+            if ttl:
+                expires = now + ttl * 2 ** min(failures - 1,
+                                               _MAX_BLACKLIST_DOUBLINGS)
+
+            connection.execute(
+                "INSERT OR REPLACE INTO blacklist " +
+                "(device_id, name, reason, time, failures, expires) " +
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (device_id, name, reason, now, failures, expires))
+
+        return failures
+
+    def unblacklist(self, device_id):
+        """
+        Remove a device from the blacklist and reset its failure count
+
+        Args:
+            device_id (str): The device id
+        """
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM blacklist WHERE device_id = ?",
+                               (device_id,))
+
+    def get_blacklist(self, device_ids=None, include_expired=False):
+        """
+        Return the blacklist entries
+
+        Args:
+            device_ids (list(str)): Only return entries of these devices
+            include_expired (boolean): Also return expired entries
+
+        Returns:
+            List of dictionaries with the keys "id", "name", "reason", "time",
+            "failures" and "expires", in the order the devices were
+            blacklisted. "expires" is None for entries that never expire.
+        """
+        query = ("SELECT device_id, name, reason, time, failures, expires " +
+                 "FROM blacklist")
+        conditions = []
+        parameters = []
+        if device_ids is not None:
+            if len(device_ids) == 0:
+                return []
+            conditions.append(
+                "device_id IN (" + ", ".join(["?"] * len(device_ids)) + ")")
+            parameters.extend(device_ids)
+
+        if not include_expired:
+            conditions.append(_ACTIVE_BLACKLIST)
+            parameters.append(time.time())
+
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        rows = self._connect().execute(query + " ORDER BY time", parameters)
+        return [{"id": row[0], "name": row[1], "reason": row[2],
+                 "time": row[3], "failures": row[4], "expires": row[5]}
+                for row in rows.fetchall()]
+
+    def set_warm(self, device_id, mode):
+        """
+        Record that an idle device has been left booted into a mode
+
+        Args:
+            device_id (str): The device id
+            mode (str): Name of the mode
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO warm VALUES (?, ?, ?)",
+                (device_id, mode, time.time()))
+
+    def take_warm(self, device_id):
+        """
+        Remove the warm record of a device, as the device has been reserved
+
+        Args:
+            device_id (str): The device id
+
+        Returns:
+            The name of the mode the device was left booted into, or None if
+            the device was not warm
+        """
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT mode FROM warm WHERE device_id = ?",
+                (device_id,)).fetchone()
+            if row is None:
+                return None
+
+            connection.execute("DELETE FROM warm WHERE device_id = ?",
+                               (device_id,))
+            return row[0]
+
+    def get_warm(self, device_ids):
+        """
+        Return the devices left booted by the warm pool
+
+        Args:
+            device_ids (list(str)): The device ids to check
+
+        Returns:
+            Dictionary mapping the ids of the warm devices to the names of the
+            modes they were booted into
+        """
+        if len(device_ids) == 0:
+            return {}
+
+        rows = self._connect().execute(
+            "SELECT device_id, mode FROM warm WHERE device_id IN (" +
+            ", ".join(["?"] * len(device_ids)) + ")", list(device_ids))
+        return dict(rows.fetchall())
+
+    def count_reservations(self, device_ids, since):
+        """
+        Count the reservations of the devices made for jobs since a time
+
+        Args:
+            device_ids (list(str)): The device ids
+            since (float): The time
+
+        Returns:
+            The number of reservations (integer)
+        """
+        if len(device_ids) == 0:
+            return 0
+
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM history WHERE event = 'reserve' AND " +
+            "time >= ? AND device_id IN (" +
+            ", ".join(["?"] * len(device_ids)) + ")",
+            [since] + list(device_ids)).fetchone()[0]
+
+    def record_event(self, device_id, event, success, duration=None):
+        """
+        Add an event to the history of a device. Failing to record the event
+        is logged, but is not an error.
+
+        Args:
+            device_id (str): The device id
+            event (str): Kind of the event, e.g. "flash", "boot" or "check"
+            success (boolean): Whether the operation succeeded
+            duration (float): Duration of the operation in seconds
+        """
+        try:
+            with self._transaction() as connection:
+                self._insert_event(connection, device_id, event, success,
+                                   duration)
+        except (errors.AFTConfigurationError, sqlite3.Error) as err:
+            logger.warning("Failed to record " + event + " event of device " +
+                           device_id + ": " + str(err))
+
+    def _insert_event(self, connection, device_id, event, success,
+                      duration=None):
+        """
+        Add an event to the history of a device and drop the oldest events
+        of the same kind. A successful flash also removes the expired
+        blacklist entry of the device, so that its failure count starts over.
+
+        Args:
+            connection (sqlite3.Connection): Connection in a transaction
+        """
+        if event == "flash" and success:
+            connection.execute(
+                "DELETE FROM blacklist WHERE device_id = ? AND NOT " +
+                _ACTIVE_BLACKLIST, (device_id, time.time()))
+
+        connection.execute(
+            "INSERT INTO history VALUES (?, ?, ?, ?, ?)",
+            (device_id, event, 1 if success else 0, duration, time.time()))
+        connection.execute(
+            "DELETE FROM history WHERE rowid IN (" +
+            "SELECT rowid FROM history WHERE device_id = ? AND event = ? " +
+            "ORDER BY time DESC LIMIT -1 OFFSET ?)",
+            (device_id, event, _HISTORY_LENGTH))
+
+    def get_health(self, device_ids):
+        """
+        Summarize the recent history of the devices
+
+        Args:
+            device_ids (list(str)): The device ids
+
+        Returns:
+            Dictionary mapping each device id to a dictionary with the keys:
+                "flash_success_rate": Ratio of successful flashing attempts
+                "flash_time": Median duration of successful flashing
+                "boot_time": Median duration of successful boots to test mode
+                "job_time": Median time reservations have been held
+                "last_failure": Time of the last failed operation
+                "last_used": Time of the last reservation
+            Values are None if there is no history for them.
+        """
+        health = {}
+        samples = {}
+        for device_id in device_ids:
+            health[device_id] = {
+                "flash_success_rate": None,
+                "flash_time": None,
+                "boot_time": None,
+                "job_time": None,
+                "last_failure": None,
+                "last_used": None}
+            samples[device_id] = {"flash": [], "boot": [], "job": [],
+                                  "flash_results": []}
+
+        if len(device_ids) == 0:
+            return health
+
+        rows = self._connect().execute(
+            "SELECT device_id, event, success, duration, time FROM history " +
+            "WHERE device_id IN (" + ", ".join(["?"] * len(device_ids)) +
+            ") ORDER BY time", list(device_ids))
+
+        for device_id, event, success, duration, event_time in rows.fetchall():
+            device_health = health[device_id]
+            device_samples = samples[device_id]
+
+            if event == "reserve":
+                device_health["last_used"] = event_time
+                continue
+
+            if event == "job":
+                device_samples["job"].append(duration)
+                continue
+
+            if not success:
+                device_health["last_failure"] = event_time
+
+            if event == "flash":
+                device_samples["flash_results"].append(success)
+            if success and duration is not None and event in ("flash", "boot"):
+                device_samples[event].append(duration)
+
+        for device_id, device_samples in samples.items():
+            results = device_samples["flash_results"]
+            if results:
+                health[device_id]["flash_success_rate"] = \
+                    float(sum(results)) / len(results)
+            health[device_id]["flash_time"] = _median(device_samples["flash"])
+            health[device_id]["boot_time"] = _median(device_samples["boot"])
+            health[device_id]["job_time"] = _median(device_samples["job"])
+
+        return health
+
+
+def _median(values):
+    """
+    Return the median of the values, or None if there are no values
+    """
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
@@ -44,6 +44,8 @@ class TestCase(with_metaclass(abc.ABCMeta, object)):
         """
         Method that is executed when the test case is run.
         Returns True if test case was succesful, False otherwise.
+        With 'aft --devices', the other devices of the group are in
+        device.group.
         """
 
     def _prepare(self):
@@ -14,19 +14,15 @@
 Module responsible of constructing AFT test cases
 """
 
-import aft.testcases.linuxtestcase
-import aft.testcases.basictestcase
-import aft.testcases.qatestcase
-import aft.testcases.unixtestcase
-import aft.testcases.gtestcase
+import aft.plugins as plugins
 
-_TEST_CASES = {
-    "qatestcase" : aft.testcases.qatestcase.QATestCase,
-    "unixtestcase" : aft.testcases.unixtestcase.UnixTestCase,
-    "basictestcase" : aft.testcases.basictestcase.BasicTestCase,
-    "linuxtestcase" : aft.testcases.linuxtestcase.LinuxTestCase,
-    "gtestcase" : aft.testcases.gtestcase.GTestCase,
-}
+_TEST_CASES = plugins.Registry("test case", "aft.testcases", {
+    "qatestcase" : "aft.testcases.qatestcase:QATestCase",
+    "unixtestcase" : "aft.testcases.unixtestcase:UnixTestCase",
+    "basictestcase" : "aft.testcases.basictestcase:BasicTestCase",
+    "linuxtestcase" : "aft.testcases.linuxtestcase:LinuxTestCase",
+    "gtestcase" : "aft.testcases.gtestcase:GTestCase",
+})
 
 def build_test_case(parameters):
     """
@@ -34,4 +30,10 @@ def build_test_case(parameters):
     argument parameters. The type of test is defined by the entry
     'test_case' in the dictionary.
     """
-    return _TEST_CASES[parameters["test_case"]](parameters)
+    return get_test_case_class(parameters)(parameters)
+
+def get_test_case_class(parameters):
+    """
+    Return the test case class of type parameters["test_case"]
+    """
+    return _TEST_CASES.get(parameters["test_case"])
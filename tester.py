@@ -18,6 +18,7 @@ Class implementing a Tester interface.
 
 import os
 import time
+import xml.etree.ElementTree as ElementTree
 try:
     import ConfigParser
 except ImportError:
@@ -25,42 +26,137 @@ except ImportError:
 
 from aft.logger import Logger as logger
 import aft.errors as errors
+import aft.configcache as configcache
+import aft.devices.common as common
 import aft.testcasefactory
 
+_TEST_PLAN_DIRECTORY = "/etc/aft/test_plan/"
+
+# Parsed test plans, keyed by the file name. Values are tuples of the file
+# signature and the list of test case configurations.
+_TEST_PLANS = {}
+
+def get_test_plan_file(test_plan_name):
+    """
+    Return the path of the configuration file for the named test plan
+
+    Raises:
+        aft.errors.AFTConfigurationError if the name is not a plain file name
+            in the test plan directory
+    """
+    test_plan_name = str(test_plan_name)
+    if (test_plan_name in ("", ".") or ".." in test_plan_name or
+            os.sep in test_plan_name or
+            (os.altsep and os.altsep in test_plan_name)):
+        raise errors.AFTConfigurationError(
+            "Invalid test plan name '" + test_plan_name + "'")
+    return os.path.join(_TEST_PLAN_DIRECTORY, test_plan_name + ".cfg")
+
+def read_test_plan(test_plan_file):
+    """
+    Read the test case configurations from a test plan file.
+
+    Parsed test plans are cached, both in memory and by aft.configcache, and
+    re-read only when the file has been modified, so that neither long running
+    processes nor repeated invocations parse the same file for every job.
+
+    Args:
+        test_plan_file (str): Path to the test plan file
+
+    Returns:
+        List of test case configuration dictionaries. Each dictionary also has
+        the test case name stored under the key "name". Empty list if the file
+        does not exist or has no test cases.
+    """
+    signature = configcache.get_files_signature([test_plan_file])
+    if signature[0][1] is None:
+        return []
+
+    cached = _TEST_PLANS.get(test_plan_file)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    test_case_configs = configcache.load(
+        "test_plan",
+        [test_plan_file],
+        lambda: _parse_test_plan(test_plan_file))
+
+    _TEST_PLANS[test_plan_file] = (signature, test_case_configs)
+    return test_case_configs
+
+def _parse_test_plan(test_plan_file):
+    """
+    Parse the test case configurations of a test plan file
+
+    Args:
+        test_plan_file (str): Path to the test plan file
+
+    Returns:
+        List of test case configuration dictionaries, as returned by
+        read_test_plan()
+    """
+    test_plan_config = ConfigParser.SafeConfigParser()
+    test_plan_config.read(test_plan_file)
+
+    test_case_configs = []
+    for test_case_name in test_plan_config.sections():
+        test_case_config = dict(test_plan_config.items(test_case_name))
+        test_case_config["name"] = test_case_name
+        test_case_configs.append(test_case_config)
+
+    return test_case_configs
+
 class Tester(object):
     """
     Class representing a Tester interface.
     """
 
-    def __init__(self, device):
+    def __init__(self, device, results_file_name="results.xml",
+                 test_plan=None):
+        """
+        Constructor
+
+        Args:
+            device (aft.Device): The device the tests are run on
+            results_file_name (str): Name of the results file
+            test_plan (str): Name of the test plan. Defaults to the test plan
+                configured for the device
+        """
         self._device = device
+        self._results_file_name = results_file_name
         self.test_cases = []
         self._results = []
         self._start_time = None
         self._end_time = None
 
-        test_plan_name = device.test_plan
-        test_plan_file = os.path.join("/etc/aft/test_plan/", device.test_plan + ".cfg")
-        test_plan_config = ConfigParser.SafeConfigParser()
-        test_plan_config.read(test_plan_file)
+        test_plan_name = test_plan
+        if test_plan_name is None:
+            test_plan_name = device.test_plan
+        test_plan_file = get_test_plan_file(test_plan_name)
+        test_case_configs = read_test_plan(test_plan_file)
 
-        if len(test_plan_config.sections()) == 0:
+        if len(test_case_configs) == 0:
             raise errors.AFTConfigurationError("Test plan " + str(test_plan_name) +
                                                " (" + str(test_plan_file) + ") doesn't " +
                                                "have any test cases. Does the file exist?")
 
-        for test_case_name in test_plan_config.sections():
-            test_case_config = dict(test_plan_config.items(test_case_name))
-            test_case_config["name"] = test_case_name
-            test_case = aft.testcasefactory.build_test_case(test_case_config)
+        for test_case_config in test_case_configs:
+            # test cases may modify their configuration, so give each its own
+            test_case = aft.testcasefactory.build_test_case(
+                dict(test_case_config))
             self.test_cases.append(test_case)
 
         logger.info("Built test plan with " + str(len(self.test_cases)) + " test cases.")
 
 
-    def execute(self):
+    def execute(self, save_results=True):
         """
         Execute the test plan.
+
+        Args:
+            save_results (boolean):
+                Whether the results are stored once the test plan has been
+                executed. If False, save_results() must be called separately.
         """
         logger.info("Executing the test plan")
         self._start_time = time.time()
@@ -68,11 +164,20 @@ class Tester(object):
 
         for index, test_case in enumerate(self.test_cases, 1):
             logger.info("Executing test case " + str(index) + " of " + str(self.test_cases))
+            common.renew_lease(self._device.dev_id, "test")
             test_case.execute(self._device)
             self._results.append(test_case.result)
 
         self._end_time = time.time()
         logger.info("Test plan end time: " + str(self._end_time))
+
+        if save_results:
+            self.save_results()
+
+    def save_results(self):
+        """
+        Store the results of the executed test plan.
+        """
         self._save_test_results()
 
     def _results_to_xunit(self):
@@ -100,7 +205,7 @@ class Tester(object):
         """
         Returns the file path of the results xml-file.
         """
-        return os.path.join(os.getcwd(), "results.xml")
+        return os.path.join(os.getcwd(), self._results_file_name)
 #pylint: enable=no-self-use
 
     def _save_test_results(self):
@@ -122,3 +227,43 @@ class Tester(object):
         for test_case in self.test_cases:
             arr.append(test_case.xunit_section)
         return "".join(arr)
+
+def merge_results(results_files, merged_file_name):
+    """
+    Merge xunit results of several test plan executions into a single report.
+
+    Args:
+        results_files (list(tuple(str, str))):
+            List of (suite name, results file path) tuples. Each results file
+            contains the testsuite of one execution. The testsuite is renamed
+            to the given suite name. Missing results files are reported as
+            testsuites with a single error.
+        merged_file_name (str): Path of the merged results file
+
+    Returns:
+        None
+    """
+    root = ElementTree.Element("testsuites")
+
+    for suite_name, results_file in results_files:
+        if os.path.isfile(results_file):
+            testsuite = ElementTree.parse(results_file).getroot()
+        else:
+            testsuite = ElementTree.Element(
+                "testsuite",
+                {"errors": "1", "failures": "0", "skips": "0", "tests": "0",
+                 "time": "0"})
+            ElementTree.SubElement(
+                testsuite,
+                "error",
+                {"message": "No test results - flashing or testing failed"})
+
+        testsuite.set("name", suite_name)
+        root.append(testsuite)
+
+    with open(merged_file_name, "w") as merged_file:
+        merged_file.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        merged_file.write(ElementTree.tostring(root).decode("utf-8"))
+        merged_file.write("\n")
+
+    logger.info("Merged results saved to " + str(merged_file_name) + ".")
@@ -16,6 +16,7 @@
 Module for device configuration check functionality.
 """
 import os
+import time
 import copy
 from multiprocessing import Process
 from multiprocessing import Queue as multiprocessing_queue
@@ -258,6 +259,7 @@ def check(args):
     if args.verbose:
         print("Device " + args.device + " acquired, running checks")
 
+    start_time = time.time()
     try:
         image_test_results = _run_tests_on_know_good_image(args, device)
 
@@ -272,6 +274,9 @@ def check(args):
 
     results = (image_test_results[0], image_test_results[1])
 
+    common.record_device_event(device.dev_id, "check", results[0],
+                               time.time() - start_time)
+
     if not results[0]:
         common.blacklist_device(
                 device.dev_id,
@@ -20,7 +20,7 @@ Edisons one by one.
 from time import sleep
 import aft.devicefactory as devicefactory
 import aft.errors as errors
-import aft.config as config
+import aft.statestore as statestore
 
 
 def recover_edisons(device_manager, verbose):
@@ -131,11 +131,9 @@ def _get_blacklisted_edison_names(all_edisons):
     """
 
     blacklisted_edisons = []
-    with open(config.DEVICE_BLACKLIST, "r") as device_blacklist:
-        for line in device_blacklist:
-            split_line = line.split()
-            if split_line[1] in all_edisons:
-                blacklisted_edisons.append(split_line[1])
+    for entry in statestore.get_store().get_blacklist():
+        if entry["name"] in all_edisons:
+            blacklisted_edisons.append(entry["name"])
 
     return blacklisted_edisons
 
@@ -199,17 +197,15 @@ def _get_blacklisted_edison_devices(device_manager, blacklisted_edison_names):
         list(aft.Device): List of blacklisted Edison devices
 
     """
-    configs = device_manager.get_configs()
-
     blacklisted_edisons = []
     for edison in blacklisted_edison_names:
-        for conf in configs:
-            if conf["name"] == edison:
-                cutter = devicefactory.build_cutter(conf["settings"])
-                device = devicefactory.build_device(
-                    conf["settings"],
-                    cutter)
-                blacklisted_edisons.append(device)
+        conf = device_manager.get_config_by_name(edison)
+        if conf:
+            cutter = devicefactory.build_cutter(conf["settings"])
+            device = devicefactory.build_device(
+                conf["settings"],
+                cutter)
+            blacklisted_edisons.append(device)
 
     return blacklisted_edisons
 
@@ -232,14 +228,7 @@ def _update_blacklist(blacklisted_edison_names):
     Returns:
         None
     """
-    lines = []
-    with open(config.DEVICE_BLACKLIST, "r") as device_blacklist:
-        for line in device_blacklist:
-            if line.split()[1] in blacklisted_edison_names:
-                continue
-            lines.append(line)
-
-
-    with open(config.DEVICE_BLACKLIST, "w") as device_blacklist:
-        for line in lines:
-            device_blacklist.write(line)
+    store = statestore.get_store()
+    for entry in store.get_blacklist():
+        if entry["name"] in blacklisted_edison_names:
+            store.unblacklist(entry["id"])
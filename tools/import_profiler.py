@@ -0,0 +1,159 @@
+# coding=utf-8
+# Copyright (c) 2013-2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Measures how long importing each module takes ('aft --import-profile').
+"""
+
+import importlib
+import sys
+import time
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+class ImportProfiler(object):
+    """
+    Replaces the import statement implementation and importlib.import_module,
+    used by aft.plugins to import the backends, with ones that record the
+    time spent importing modules that have not been imported before.
+
+    RECORDS: List of (module name, self time, cumulative time) tuples. Self
+        time excludes the time spent importing other modules.
+    """
+
+    RECORDS = []
+    _ORIGINAL_IMPORT = None
+    _ORIGINAL_IMPORT_MODULE = None
+    _STACK = []
+
+    @staticmethod
+    def start():
+        """
+        Start recording imports. Does nothing if already started.
+        """
+        if ImportProfiler._ORIGINAL_IMPORT is not None:
+            return
+        ImportProfiler._ORIGINAL_IMPORT = builtins.__import__
+        ImportProfiler._ORIGINAL_IMPORT_MODULE = importlib.import_module
+        builtins.__import__ = ImportProfiler._import
+        importlib.import_module = ImportProfiler._import_module
+
+    @staticmethod
+    def stop():
+        """
+        Stop recording imports.
+        """
+        if ImportProfiler._ORIGINAL_IMPORT is None:
+            return
+        builtins.__import__ = ImportProfiler._ORIGINAL_IMPORT
+        importlib.import_module = ImportProfiler._ORIGINAL_IMPORT_MODULE
+        ImportProfiler._ORIGINAL_IMPORT = None
+        ImportProfiler._ORIGINAL_IMPORT_MODULE = None
+
+    @staticmethod
+    def is_started():
+        """
+        Return True if imports are being recorded
+        """
+        return ImportProfiler._ORIGINAL_IMPORT is not None
+
+    @staticmethod
+    def _import(name, *args, **kwargs):
+        original_import = ImportProfiler._ORIGINAL_IMPORT
+
+        # Fast path for modules that have already been imported. Relative
+        # imports are always measured, which is harmless.
+        level = kwargs.get("level", args[3] if len(args) > 3 else 0)
+        if level == 0 and name in sys.modules:
+            return original_import(name, *args, **kwargs)
+
+        display_name = ImportProfiler._get_display_name(name, level, *args)
+        return ImportProfiler._measure(display_name, original_import, name,
+                                       *args, **kwargs)
+
+    @staticmethod
+    def _import_module(name, package=None):
+        original_import_module = ImportProfiler._ORIGINAL_IMPORT_MODULE
+
+        if name.startswith("."):
+            display_name = (package or "") + name
+        else:
+            display_name = name
+            if name in sys.modules:
+                return original_import_module(name, package)
+
+        return ImportProfiler._measure(display_name, original_import_module,
+                                       name, package)
+
+    @staticmethod
+    def _measure(display_name, function, *args, **kwargs):
+        """
+        Call the import function and record the time it took
+        """
+        # Time spent importing nested modules is accumulated to the last
+        # item of the stack
+        ImportProfiler._STACK.append(0.0)
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested = ImportProfiler._STACK.pop()
+            if ImportProfiler._STACK:
+                ImportProfiler._STACK[-1] += elapsed
+            ImportProfiler.RECORDS.append(
+                (display_name, elapsed - nested, elapsed))
+
+    @staticmethod
+    def _get_display_name(name, level, import_globals=None, import_locals=None,
+                          fromlist=None, *args):
+        """
+        Return the absolute name of the imported module for the report
+        """
+        if level == 0 or not import_globals:
+            return name
+
+        package = import_globals.get("__package__") or \
+            import_globals.get("__name__", "")
+        base = package.rsplit(".", level - 1)[0]
+
+        if name:
+            return base + "." + name
+        if fromlist:
+            return base + "." + ",".join(fromlist)
+        return base
+
+    @staticmethod
+    def report(limit=30):
+        """
+        Return a report of the slowest imports
+
+        Args:
+            limit (integer): Maximum number of modules to list
+
+        Returns:
+            The report as a string
+        """
+        records = sorted(ImportProfiler.RECORDS, key=lambda record: record[2],
+                         reverse=True)
+        total = sum([record[1] for record in records])
+
+        lines = ["Import profile (milliseconds):",
+                 "{0:>10} {1:>10}  {2}".format("self", "cumulative", "module")]
+        for name, self_time, cumulative_time in records[:limit]:
+            lines.append("{0:>10.1f} {1:>10.1f}  {2}".format(
+                self_time * 1000, cumulative_time * 1000, name))
+        lines.append("Total: {0:.1f} ms in {1} imports".format(
+            total * 1000, len(records)))
+        return "\n".join(lines)
@@ -0,0 +1,228 @@
+# coding=utf-8
+# Copyright (c) 2013-2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Newline delimited JSON messages over stream sockets, as used by the job
+server and the farm coordinator.
+
+Requests sent over TCP are authenticated with the farm secret
+(aft.config.FARM_SECRET): sign() adds an HMAC of the request and the time it
+was sent, and authenticate() checks it on the receiving side.
+"""
+
+import hashlib
+import hmac
+import json
+import socket
+import time
+
+import aft.config as config
+import aft.errors as errors
+
+# Seconds a signed request stays valid, which limits replaying requests.
+# The clocks of the farm hosts must agree to within this.
+_SIGNATURE_MAX_AGE = 300
+
+
+def send_message(connection, message):
+    """
+    Send a single protocol message
+
+    Args:
+        connection (socket.socket): The connection
+        message (dictionary): The message
+    """
+    connection.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+
+def read_message(connection_file):
+    """
+    Read a single protocol message
+
+    Args:
+        connection_file: File object created from the connection socket
+
+    Returns:
+        The message as a dictionary, or None if the connection was closed
+    """
+    line = connection_file.readline()
+    if not line:
+        return None
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    return json.loads(line)
+
+
+def parse_address(address):
+    """
+    Parse a TCP address
+
+    Args:
+        address (str): Address as "host:port"
+
+    Returns:
+        (host, port) tuple
+
+    Raises:
+        aft.errors.AFTConfigurationError if the address is malformed
+    """
+    host, _, port = address.rpartition(":")
+    try:
+        return (host, int(port))
+    except ValueError:
+        raise errors.AFTConfigurationError(
+            "Invalid address '" + address + "', expected host:port")
+
+
+def listen(address):
+    """
+    Create a TCP server socket listening on the address. Without a host, the
+    socket only accepts connections from localhost.
+
+    Args:
+        address (str): Address as "host:port"
+
+    Returns:
+        The listening socket.socket
+
+    Raises:
+        aft.errors.AFTConfigurationError if no farm secret is configured.
+        Requests are authenticated even on localhost, as any local user can
+        connect to it.
+    """
+    host, port = parse_address(address)
+    if host == "":
+        host = "127.0.0.1"
+
+    if not config.FARM_SECRET:
+        raise errors.AFTConfigurationError(
+            "farm_secret must be configured for listening on " + address)
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(16)
+    return server
+
+
+def sign(message):
+    """
+    Add the signature of the farm secret to a request
+
+    Args:
+        message (dictionary): The request
+
+    Returns:
+        The signed request (dictionary)
+    """
+    signed = dict(message)
+    sent = time.time()
+    signed["auth"] = {"time": sent,
+                      "hmac": _get_signature(message, sent)}
+    return signed
+
+
+def authenticate(message):
+    """
+    Check the signature of a request
+
+    Args:
+        message (dictionary): The signed request
+
+    Returns:
+        The request without the signature (dictionary)
+
+    Raises:
+        aft.errors.AFTConnectionError if no farm secret is configured, or if
+        the signature is missing, invalid or too old
+    """
+    message = dict(message)
+    auth = message.pop("auth", None)
+    if not config.FARM_SECRET:
+        raise errors.AFTConnectionError(
+            "Request authentication failed: no farm secret is configured")
+
+    try:
+        sent = float(auth["time"])
+        valid = hmac.compare_digest(str(auth["hmac"]),
+                                    _get_signature(message, sent))
+    except (TypeError, KeyError, ValueError):
+        valid = False
+
+    if not valid or abs(time.time() - sent) > _SIGNATURE_MAX_AGE:
+        raise errors.AFTConnectionError("Request authentication failed")
+
+    return message
+
+
+def _get_signature(message, sent):
+    """
+    Return the HMAC of a request and the time it was sent
+    """
+    payload = json.dumps(message, sort_keys=True) + "\n" + repr(float(sent))
+    return hmac.new(config.FARM_SECRET.encode("utf-8"),
+                    payload.encode("utf-8"),
+                    hashlib.sha256).hexdigest()
+
+
+def connect(address, timeout=None):
+    """
+    Connect to a TCP server
+
+    Args:
+        address (str): Address as "host:port"
+        timeout (float): Timeout of the socket operations in seconds, or None
+            to block
+
+    Returns:
+        The connected socket.socket
+
+    Raises:
+        aft.errors.AFTConnectionError if the connection fails
+    """
+    try:
+        return socket.create_connection(parse_address(address), timeout)
+    except socket.error as err:
+        raise errors.AFTConnectionError(
+            "Could not connect to " + address + ": " + str(err))
+
+
+def request(address, message, timeout=30):
+    """
+    Send a signed message to a TCP server and return its reply
+
+    Args:
+        address (str): Address as "host:port"
+        message (dictionary): The message
+        timeout (float): Timeout in seconds
+
+    Returns:
+        The reply as a dictionary
+
+    Raises:
+        aft.errors.AFTConnectionError if the connection fails
+    """
+    connection = connect(address, timeout)
+    try:
+        send_message(connection, sign(message))
+        reply = read_message(connection.makefile("rb"))
+    except (socket.error, ValueError) as err:
+        raise errors.AFTConnectionError(
+            "Request to " + address + " failed: " + str(err))
+    finally:
+        connection.close()
+
+    if reply is None:
+        raise errors.AFTConnectionError(
+            address + " closed the connection without replying")
+
+    return reply
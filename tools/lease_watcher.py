@@ -0,0 +1,184 @@
+# coding=utf-8
+# Copyright (c) 2013-2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Indexed view of the dnsmasq leases file.
+
+The leases file is parsed only when it has changed, and processes waiting for
+a device to get a lease are woken up through inotify as soon as dnsmasq
+writes the file.
+"""
+
+import os
+import threading
+import time
+
+from aft.tools.lock_watcher import LockWatcher, IN_MODIFY, IN_CLOSE_WRITE, \
+    IN_MOVED_TO
+
+# Seconds between checks of the leases file while waiting for a lease, in case
+# inotify is not available or the event is missed
+_CHECK_INTERVAL = 1
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def get_lease_watcher(leases_file_path):
+    """
+    Return the lease watcher of a leases file, shared by all the users in
+    this process
+
+    Args:
+        leases_file_path (str): Path to dnsmasq leases file
+
+    Returns:
+        The LeaseWatcher
+    """
+    with _watchers_lock:
+        if leases_file_path not in _watchers:
+            _watchers[leases_file_path] = LeaseWatcher(leases_file_path)
+        return _watchers[leases_file_path]
+
+
+def fork_locks():
+    """
+    Return the locks of the lease watchers of this process, in the order
+    they must be acquired. A process forked while another thread holds one
+    of them must release its copy before using the watchers. No watchers are
+    added while the first lock is held.
+
+    Returns:
+        List of threading.Lock
+    """
+    return ([_watchers_lock] +
+            [watcher._lock for watcher in list(_watchers.values())])
+
+
+class LeaseWatcher(object):
+    """
+    The leases of a dnsmasq leases file, indexed by mac address
+    """
+
+    def __init__(self, leases_file_path):
+        self._path = leases_file_path
+        self._lock = threading.Lock()
+        # (inode, size, modification time) of the parsed file
+        self._file_state = None
+        self._leases = []
+        # lower case mac address -> leases, most recent first
+        self._leases_by_mac = {}
+
+    def get_leases(self):
+        """
+        Return the active leases
+
+        Returns:
+            List of dictionaries in the format returned by
+            aft.devices.common.get_mac_leases_from_dnsmasq
+        """
+        with self._lock:
+            self._refresh()
+            return list(self._leases)
+
+    def get_ip_addresses(self, mac_address):
+        """
+        Return the addresses leased for a mac address, most recent first
+
+        Args:
+            mac_address (str): Device mac address
+
+        Returns:
+            List of ip addresses. Each ip address is a string.
+        """
+        with self._lock:
+            self._refresh()
+            return [lease["ip"] for lease in
+                    self._leases_by_mac.get(mac_address.lower(), [])]
+
+    def _get_lease_entries(self, mac_address):
+        """
+        Return the (ip, expiry) pairs of the leases of a mac address. A device
+        that gets its previous address again still gets a new expiry time.
+        """
+        with self._lock:
+            self._refresh()
+            return [(lease["ip"], lease["expiry"]) for lease in
+                    self._leases_by_mac.get(mac_address.lower(), [])]
+
+    def wait_for_change(self, mac_address, timeout):
+        """
+        Wait until the leases of a mac address change, e.g. because the
+        device got a new or renewed lease after booting
+
+        Args:
+            mac_address (str): Device mac address
+            timeout (float): Timeout in seconds
+
+        Returns:
+            True if the leases changed, False on timeout
+        """
+        # The watch is set up before reading the current leases, so that
+        # changes in between are not missed
+        watcher = LockWatcher([(os.path.dirname(self._path) or ".",
+                                IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO)])
+        try:
+            leases = self._get_lease_entries(mac_address)
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                watcher.wait(min(deadline - time.time(), _CHECK_INTERVAL))
+                if self._get_lease_entries(mac_address) != leases:
+                    return True
+            return False
+        finally:
+            watcher.close()
+
+    def _refresh(self):
+        """
+        Parse the leases file if it has changed since it was last parsed
+        """
+        stat = os.stat(self._path)
+        file_state = (stat.st_ino, stat.st_size,
+                      getattr(stat, "st_mtime_ns", stat.st_mtime))
+        if file_state == self._file_state:
+            return
+
+        with open(self._path) as lease_file:
+            lines = lease_file.readlines()
+
+        # dnsmasq.leases contains rows with the following format:
+        # <lease_expiry_time_as_epoch_format> <mac> <ip> <hostname> <domain>
+        # See:
+        #http://lists.thekelleys.org.uk/pipermail/dnsmasq-discuss/2005q1/000143.html
+        leases = []
+        for line in lines:
+            lease = line.split()
+            if len(lease) < 5:
+                continue
+            leases.append({
+                "mac": lease[1],
+                "ip": lease[2],
+                "hostname": lease[3],
+                "client_id": lease[4],
+                "expiry": int(lease[0]),
+            })
+
+        leases_by_mac = {}
+        # Expiry time 0 means an infinite lease
+        for lease in sorted(leases,
+                            key=lambda lease: lease["expiry"] or float("inf"),
+                            reverse=True):
+            leases_by_mac.setdefault(lease["mac"].lower(), []).append(lease)
+
+        self._file_state = file_state
+        self._leases = leases
+        self._leases_by_mac = leases_by_mac
@@ -0,0 +1,132 @@
+# coding=utf-8
+# Copyright (c) 2013-2016 Intel, Inc.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; version 2 of the License
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+
+"""
+Wake-up notifications for processes waiting for devices to be released.
+
+Uses inotify through ctypes where available. On other systems, or if inotify
+cannot be initialized, waiting simply sleeps for the given timeout.
+"""
+
+import os
+import time
+import select
+import ctypes
+import ctypes.util
+
+from aft.logger import Logger as logger
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_LIBC = None
+
+
+def _get_libc():
+    """
+    Return the C library with the inotify functions, or None if inotify is
+    not available
+    """
+    global _LIBC
+
+    if _LIBC is None:
+        _LIBC = False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                               use_errno=True)
+            if hasattr(libc, "inotify_init1"):
+                _LIBC = libc
+        except OSError:
+            pass
+
+    return _LIBC or None
+
+
+class LockWatcher(object):
+    """
+    Watches directories for changes.
+
+    Events that happen between the construction of the watcher and a call to
+    wait() are not lost: wait() returns immediately if any events are pending.
+    """
+
+    def __init__(self, watches):
+        """
+        Constructor
+
+        Args:
+            watches (list((str, integer))):
+                (directory, inotify event mask) pairs to watch
+        """
+        self._fd = None
+
+        libc = _get_libc()
+        if libc is None:
+            return
+
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            logger.warning("inotify_init1 failed: " +
+                           os.strerror(ctypes.get_errno()))
+            return
+
+        for directory, mask in watches:
+            if libc.inotify_add_watch(fd, directory.encode("utf-8"), mask) < 0:
+                logger.warning("Cannot watch " + directory + ": " +
+                               os.strerror(ctypes.get_errno()))
+                os.close(fd)
+                return
+
+        self._fd = fd
+
+    def wait(self, timeout):
+        """
+        Wait until any of the watched events happen or the timeout expires
+
+        Args:
+            timeout (float): Timeout in seconds
+
+        Returns:
+            True if an event happened, False on timeout or if inotify is not
+            available
+        """
+        if self._fd is None:
+            time.sleep(timeout)
+            return False
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+
+        # Drain the pending events. Waiters re-check the state anyway, so the
+        # events themselves are not needed.
+        try:
+            while os.read(self._fd, 4096):
+                pass
+        except OSError:
+            pass
+
+        return True
+
+    def close(self):
+        """
+        Stop watching
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
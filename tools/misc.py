@@ -15,46 +15,178 @@
 Convenience functions for (unix) command execution
 """
 
+import codecs
+import os
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
 try:
     import subprocess32
 except ImportError:
     import subprocess as subprocess32
 import time
 
-def local_execute(command, timeout = 60, ignore_return_codes = None):
+# Bytes read from the output of a command at a time
+_READ_SIZE = 65536
+
+def local_execute(command, timeout = 60, ignore_return_codes = None,
+                  line_callback = None, log_file = None, max_output = None):
     """
     Execute a command on local machine. Returns combined stdout and stderr if
     return code is 0 or included in the list 'ignore_return_codes'. Otherwise
-    raises a subprocess32 error.
+    raises a subprocess32 error. The process is killed if it does not finish
+    within 'timeout' seconds.
+
+    Args:
+        command (list(str) or str): The command
+        timeout (float): Timeout in seconds
+        ignore_return_codes (list(integer)):
+            Return codes that are not errors
+        line_callback (function): Called with each line of the output as it
+            is produced, without the newline
+        log_file (str): File the output is appended to as it is produced
+        max_output (integer): Number of characters of the output that are
+            kept and returned, counting from its end. None keeps all the
+            output.
+
+    Returns:
+        The output of the command
     """
-    process = subprocess32.Popen(command, universal_newlines=True,
+    process = subprocess32.Popen(command,
                                  stdout = subprocess32.PIPE,
                                  stderr = subprocess32.STDOUT)
+    output = _OutputCollector(line_callback, log_file, max_output)
+    deadline = time.time() + timeout
+
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ)
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
 
-    # Loop until process returns or timeout expires.
-    start = time.time()
-    output = ""
-    return_code = None
-    while time.time() < start + timeout and return_code == None:
-        return_code = process.poll()
-        if return_code == None:
-            try:
-                output += process.communicate(timeout = 1)[0]
-            except subprocess32.TimeoutExpired:
-                pass
+            # The timeout is bounded, so that processes that exit while their
+            # children keep the output open are noticed
+            if selector.select(min(remaining, 1)):
+                data = os.read(process.stdout.fileno(), _READ_SIZE)
+                if not data:
+                    break
+                output.add(data)
+            elif process.poll() is not None:
+                break
+
+        try:
+            return_code = process.wait(
+                timeout = max(deadline - time.time(), 0))
+        except subprocess32.TimeoutExpired:
+            return_code = None
+    finally:
+        selector.close()
+        process.stdout.close()
+        output.close()
 
     if return_code == None:
         # Time ran out but the process didn't end.
-        raise subprocess32.TimeoutExpired(cmd = command, output = output,
+        process.kill()
+        process.wait()
+        raise subprocess32.TimeoutExpired(cmd = command,
+                                          output = output.get_output(),
                                           timeout = timeout)
 
     if ignore_return_codes == None:
         ignore_return_codes = []
     if return_code in ignore_return_codes or return_code == 0:
-        return output
+        return output.get_output()
     else:
         raise subprocess32.CalledProcessError(returncode = return_code,
-                                              cmd = command, output = output)
+                                              cmd = command,
+                                              output = output.get_output())
+
+class _OutputCollector(object):
+    """
+    Decodes the output of a command as it is read, passes it on line by line
+    and keeps its tail
+    """
+
+    def __init__(self, line_callback, log_file, max_output):
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._line_callback = line_callback
+        self._log_file = open(log_file, "a") if log_file else None
+        self._max_output = max_output
+        self._chunks = []
+        self._length = 0
+        # Incomplete last line, for line_callback
+        self._line = ""
+        # Whether the previous chunk ended with a carriage return
+        self._carriage_return = False
+
+    def add(self, data):
+        """
+        Add output read from the command
+
+        Args:
+            data (bytes): The output
+        """
+        text = self._decoder.decode(data)
+        if self._carriage_return:
+            text = "\r" + text
+        # Translate newlines like universal newlines mode does. A trailing
+        # carriage return might be the start of a \r\n pair.
+        self._carriage_return = text.endswith("\r")
+        if self._carriage_return:
+            text = text[:-1]
+        self._add_text(text.replace("\r\n", "\n").replace("\r", "\n"))
+
+    def close(self):
+        """
+        Handle the remaining output after the command has finished
+        """
+        text = self._decoder.decode(b"", True)
+        if self._carriage_return:
+            text += "\n"
+            self._carriage_return = False
+        self._add_text(text)
+
+        if self._line_callback and self._line:
+            self._line_callback(self._line)
+        self._line = ""
+
+        if self._log_file:
+            self._log_file.close()
+            self._log_file = None
+
+    def get_output(self):
+        """
+        Return the output, or its tail if max_output was given
+        """
+        output = "".join(self._chunks)
+        if self._max_output is not None:
+            output = output[max(len(output) - self._max_output, 0):]
+        self._chunks = [output]
+        self._length = len(output)
+        return output
+
+    def _add_text(self, text):
+        if not text:
+            return
+
+        if self._log_file:
+            self._log_file.write(text)
+
+        if self._line_callback:
+            lines = (self._line + text).split("\n")
+            self._line = lines.pop()
+            for line in lines:
+                self._line_callback(line)
+
+        self._chunks.append(text)
+        self._length += len(text)
+        # Trimming is amortized by letting the output grow to twice the limit
+        if (self._max_output is not None and
+                self._length > 2 * self._max_output + _READ_SIZE):
+            self.get_output()
 
 def subprocess_killer(process):
     """
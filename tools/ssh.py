@@ -18,12 +18,226 @@ Tools for remote controlling a device over ssh.
 
 from aft.logger import Logger as logger
 import aft.tools.misc as tools
+import atexit
+import errno
 import os
+import socket
+import tempfile
+import threading
+import time
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
 try:
     import subprocess32
 except ImportError:
     import subprocess as subprocess32
 
+# Port of the ssh server of the devices
+_SSH_PORT = 22
+# Seconds a device may take to accept a tcp connection to its ssh port
+_PROBE_TIMEOUT = 2
+# Seconds an idle session with a device is kept open
+_SESSION_IDLE_TIMEOUT = 600
+# A session is closed if the device has not answered for
+# _SERVER_ALIVE_INTERVAL * _SERVER_ALIVE_COUNT seconds
+_SERVER_ALIVE_INTERVAL = 5
+_SERVER_ALIVE_COUNT = 3
+
+
+class _SessionManager(object):
+    """
+    Persistent ssh sessions with the devices, one per device ip and user.
+
+    A session is an ssh ControlMaster process that has connected and
+    authenticated to the device. Commands and file transfers are multiplexed
+    over it, which saves the handshake of every command. Sessions belong to
+    the process that opened them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._directory = None
+        # (user, remote_ip) -> lock of the session, for the open sessions and
+        # the sessions being opened
+        self._sessions = {}
+        self._open = set()
+
+    def get_options(self, remote_ip, user, connect_timeout):
+        """
+        Return the ssh options for multiplexing over the session with the
+        device, opening the session if needed
+
+        Args:
+            remote_ip (str): Device ip address
+            user (str): User on the device
+            connect_timeout (integer): Timeout of the connection in seconds
+
+        Returns:
+            List of ssh command line arguments
+
+        Raises:
+            subprocess32.CalledProcessError if the device cannot be connected
+        """
+        key = (user, str(remote_ip))
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked processes do not share the sessions of their parent
+                self._pid = os.getpid()
+                self._directory = tempfile.mkdtemp(prefix="aft-ssh-")
+                self._sessions = {}
+                self._open = set()
+            control_path = os.path.join(self._directory, "@".join(key))
+            session_lock = self._sessions.setdefault(key, threading.Lock())
+
+        with session_lock:
+            if key not in self._open:
+                self._start_master(remote_ip, user, connect_timeout,
+                                   control_path)
+                with self._lock:
+                    self._open.add(key)
+
+        return ["-o", "ControlMaster=no", "-o", "ControlPath=" + control_path]
+
+    def close(self, remote_ip, user=None):
+        """
+        Close the sessions with the device, e.g. because it is rebooted
+
+        Args:
+            remote_ip (str): Device ip address
+            user (str): User of the session to close, or None to close the
+                sessions of all the users
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            keys = [key for key in self._open if key[1] == str(remote_ip) and
+                    (user is None or key[0] == user)]
+            for key in keys:
+                self._open.discard(key)
+
+        for key in keys:
+            try:
+                subprocess32.call(
+                    ["ssh", "-O", "exit",
+                     "-o", "ControlPath=" +
+                     os.path.join(self._directory, "@".join(key)),
+                     "@".join(key)],
+                    stdout=subprocess32.DEVNULL,
+                    stderr=subprocess32.DEVNULL,
+                    timeout=10)
+            except subprocess32.TimeoutExpired:
+                logger.warning("Closing the ssh session with " +
+                               str(remote_ip) + " timed out")
+
+    def close_all(self):
+        """
+        Close all the sessions of this process
+        """
+        with self._lock:
+            remote_ips = set(key[1] for key in self._open)
+        for remote_ip in remote_ips:
+            self.close(remote_ip)
+
+        if self._pid == os.getpid():
+            try:
+                os.rmdir(self._directory)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _start_master(remote_ip, user, connect_timeout, control_path):
+        """
+        Connect to the device and leave the master process of the session
+        running in the background
+
+        Raises:
+            subprocess32.CalledProcessError if the device cannot be connected
+        """
+        master_args = (
+            ["ssh"] + _get_ssh_options(connect_timeout) +
+            ["-M", "-N", "-f",
+             "-o", "ControlPath=" + control_path,
+             "-o", "ControlPersist=" + str(_SESSION_IDLE_TIMEOUT),
+             "-o", "ServerAliveInterval=" + str(_SERVER_ALIVE_INTERVAL),
+             "-o", "ServerAliveCountMax=" + str(_SERVER_ALIVE_COUNT),
+             user + "@" + str(remote_ip)])
+
+        try:
+            return_code = subprocess32.call(
+                master_args,
+                stdout=subprocess32.DEVNULL,
+                stderr=subprocess32.DEVNULL,
+                timeout=connect_timeout + 10)
+        except subprocess32.TimeoutExpired:
+            # Like ssh itself, fail with 255 on connection errors
+            return_code = 255
+
+        if return_code != 0:
+            raise subprocess32.CalledProcessError(
+                returncode=return_code, cmd=master_args)
+
+
+_sessions = _SessionManager()
+atexit.register(_sessions.close_all)
+
+
+def close_session(remote_ip):
+    """
+    Close the ssh sessions with a device. Must be called when the device is
+    rebooted or powered off, so that no commands are sent over a dead session.
+
+    Args:
+        remote_ip (str): Device ip address
+    """
+    _sessions.close(remote_ip)
+
+def fork_locks():
+    """
+    Return the locks of the ssh sessions of this process. A process forked
+    while another thread holds one of them must release its copy before
+    using ssh.
+
+    Returns:
+        List of threading.Lock
+    """
+    return [_sessions._lock]
+
+def close_all():
+    """
+    Close all the ssh sessions of this process and remove their directory.
+    Must be called at the end of multiprocessing child processes, which exit
+    without running the atexit handlers.
+    """
+    _sessions.close_all()
+
+def _get_scp_options(remote_ip, user):
+    """
+    Return the scp options for copying files to and from the device, over the
+    session with the device if it can be opened. Otherwise scp connects on
+    its own and reports the connection error.
+    """
+    options = _get_ssh_options(15)
+    try:
+        options += _sessions.get_options(remote_ip, user, 15)
+    except subprocess32.CalledProcessError:
+        pass
+    return options
+
+def _get_ssh_options(connect_timeout):
+    """
+    Return the ssh options used for connecting to the devices
+    """
+    return ["-i", "".join([os.path.expanduser("~"),
+                           "/.ssh/id_rsa_testing_harness"]),
+            "-o", "UserKnownHostsFile=/dev/null",
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "BatchMode=yes",
+            "-o", "LogLevel=ERROR",
+            "-o", "ConnectTimeout=" + str(connect_timeout)]
+
 def _get_proxy_settings():
     """
     Fetches proxy settings from the environment.
@@ -37,10 +251,60 @@ def _get_proxy_settings():
             proxy_env_command += "export " + var + '="' + val + '"; '
     return proxy_env_command
 
+def probe_ssh_ports(remote_ips, timeout = _PROBE_TIMEOUT):
+    """
+    Return the addresses that accept tcp connections to the ssh port. The
+    addresses are probed in parallel, which is much faster than trying to
+    open ssh connections to addresses that are not in use.
+
+    Args:
+        remote_ips (list(str)): The ip addresses
+        timeout (float): Timeout of the connections in seconds
+
+    Returns:
+        List of the addresses that accepted the connection, in the original
+        order
+    """
+    selector = selectors.DefaultSelector()
+    responsive = set()
+    try:
+        for remote_ip in remote_ips:
+            family = socket.AF_INET6 if ":" in remote_ip else socket.AF_INET
+            probe = socket.socket(family, socket.SOCK_STREAM)
+            probe.setblocking(False)
+            error = probe.connect_ex((remote_ip, _SSH_PORT))
+            if error == 0:
+                responsive.add(remote_ip)
+                probe.close()
+            elif error in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                selector.register(probe, selectors.EVENT_WRITE, remote_ip)
+            else:
+                probe.close()
+
+        deadline = time.time() + timeout
+        while selector.get_map() and time.time() < deadline:
+            for key, _ in selector.select(deadline - time.time()):
+                if key.fileobj.getsockopt(
+                        socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    responsive.add(key.data)
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+
+    return [remote_ip for remote_ip in remote_ips if remote_ip in responsive]
+
 def test_ssh_connectivity(remote_ip, timeout = 10):
     """
     Test whether remote_ip is accessible over ssh.
     """
+    if not probe_ssh_ports([remote_ip], min(timeout, _PROBE_TIMEOUT)):
+        logger.warning("Could not establish ssh-connection to " + remote_ip +
+                       ". SSH port is not responding.")
+        return False
+
     try:
         remote_execute(remote_ip, ["echo", "$?"], connect_timeout = timeout)
         return True
@@ -53,8 +317,8 @@ def push(remote_ip, source, destination, timeout = 60, ignore_return_codes = Non
     """
     Transmit a file from local 'source' to remote 'destination' over SCP
     """
-    scp_args = ["scp", source,
-                user + "@" + str(remote_ip) + ":" + destination]
+    scp_args = (["scp"] + _get_scp_options(remote_ip, user) +
+                [source, user + "@" + str(remote_ip) + ":" + destination])
     return tools.local_execute(scp_args, timeout, ignore_return_codes)
 
 def pull(
@@ -86,42 +350,233 @@ def pull(
         subprocess32.CalledProcessError:
             If process returns non-zero, non-ignored return code
     """
-    scp_args = [
-        "scp",
-        "-o",
-        "UserKnownHostsFile=/dev/null",
-        "-o",
-        "StrictHostKeyChecking=no",
+    scp_args = ["scp"] + _get_scp_options(remote_ip, user) + [
         user + "@" + str(remote_ip) + ":" + source,
         destination]
     return tools.local_execute(scp_args, timeout, ignore_return_codes)
 
 def remote_execute(remote_ip, command, timeout = 60, ignore_return_codes = None,
-                   user = "root", connect_timeout = 15):
+                   user = "root", connect_timeout = 15, max_output = None):
     """
     Execute a Bash command over ssh on a remote device with IP 'remote_ip'.
     Returns combines stdout and stderr if there are no errors. On error raises
-    subprocess32 errors.
+    subprocess32 errors. If 'max_output' is given, only that many characters
+    from the end of the output are kept.
     """
 
-    ssh_args = ["ssh",
-                "-i", "".join([os.path.expanduser("~"), "/.ssh/id_rsa_testing_harness"]),
-                "-o", "UserKnownHostsFile=/dev/null",
-                "-o", "StrictHostKeyChecking=no",
-                "-o", "BatchMode=yes",
-                "-o", "LogLevel=ERROR",
-                "-o", "ConnectTimeout=" + str(connect_timeout),
-                user + "@" + str(remote_ip),
-                _get_proxy_settings(),]
+    ssh_args = (["ssh"] + _get_ssh_options(connect_timeout) +
+                _sessions.get_options(remote_ip, user, connect_timeout) +
+                [user + "@" + str(remote_ip), _get_proxy_settings()])
 
     logger.info("Executing " + " ".join(command), filename="ssh.log")
 
     ret = ""
     try:
-        ret = tools.local_execute(ssh_args + command, timeout, ignore_return_codes)
+        ret = tools.local_execute(ssh_args + command, timeout,
+                                  ignore_return_codes,
+                                  max_output = max_output)
     except subprocess32.CalledProcessError as err:
         logger.error("Command raised exception: " + str(err), filename="ssh.log")
         logger.error("Output: " + str(err.output), filename="ssh.log")
+        if err.returncode == 255:
+            # The connection failed, the session needs to be opened again
+            _sessions.close(remote_ip, user)
         raise err
 
     return ret
+
+class RemoteBatch(object):
+    """
+    Commands run on a device as a single shell script, over one ssh
+    connection instead of one connection per command.
+
+    The commands are run in order, and the batch stops at the first command
+    that fails, with the same error remote_execute would raise for it. Each
+    command is run in its own shell under the timeout command of the device,
+    which stops the command when its timeout expires. Both the coreutils and
+    the busybox ('timeout -t') variants are supported. On devices without a
+    timeout command, the commands are run without it, and a command that
+    hangs is only stopped when the whole batch times out after the sum of the
+    timeouts:
+
+        batch = ssh.RemoteBatch(device_ip)
+        batch.add(["mkdir", directory], ignore_return_codes=[1])
+        batch.add(["sync"])
+        results = batch.execute()
+    """
+
+    # Prefix of the lines the script prints around each command
+    _MARKER = "#aft-batch#"
+    # Return code of the timeout command when the command timed out
+    _TIMEOUT_RETURN_CODE = 124
+    # Defines aft_run, which runs "$2..." with the timeout of $1 seconds using
+    # the timeout command the device has, or without a timeout if it has none
+    _TIMEOUT_PROBE = "\n".join([
+        "if timeout 1 true 2>/dev/null; then",
+        "    aft_run() { timeout \"$@\"; }",
+        "elif timeout -t 1 true 2>/dev/null; then",
+        "    aft_run() { timeout -t \"$@\"; }",
+        "else",
+        "    aft_run() { shift; \"$@\"; }",
+        "fi"])
+    # Seconds the whole batch may take in addition to the command timeouts
+    _TIMEOUT_MARGIN = 30
+
+    def __init__(self, remote_ip, user = "root"):
+        self.remote_ip = remote_ip
+        self.user = user
+        self._steps = []
+
+    def add(self, command, timeout = 60, ignore_return_codes = None):
+        """
+        Add a command to the batch
+
+        Args:
+            command (list(str)): The command, as given to remote_execute
+            timeout (integer): Timeout of the command in seconds
+            ignore_return_codes (list(integer)):
+                Return codes of the command that are not errors
+        """
+        self._steps.append({
+            "command": command,
+            "timeout": timeout,
+            "ignore_return_codes": ignore_return_codes or []})
+
+    def execute(self, connect_timeout = 15):
+        """
+        Run the commands of the batch
+
+        Args:
+            connect_timeout (integer): Timeout of the ssh connection in seconds
+
+        Returns:
+            List of dictionaries, one for each command that was run, with the
+            keys "command", "return_code", "output" and "duration" (seconds as
+            measured on the device, or None if unknown)
+
+        Raises:
+            subprocess32.CalledProcessError:
+                If a command returns non-zero, non-ignored return code, or if
+                the connection fails
+            subprocess32.TimeoutExpired:
+                If a command does not finish within its timeout
+        """
+        if len(self._steps) == 0:
+            return []
+
+        # The commands time out on the device. The margin leaves time for the
+        # connection and for reporting the command that timed out.
+        total_timeout = (sum(step["timeout"] for step in self._steps) +
+                         self._TIMEOUT_MARGIN)
+        try:
+            output = remote_execute(
+                self.remote_ip, [self._get_script()], timeout = total_timeout,
+                ignore_return_codes = list(range(1, 256)), user = self.user,
+                connect_timeout = connect_timeout)
+        except subprocess32.TimeoutExpired as err:
+            results = self._parse_output(err.output or "")
+            step = self._steps[len(results) - 1] if results else self._steps[0]
+            output = results[-1]["output"] if results else ""
+            raise subprocess32.TimeoutExpired(
+                cmd = step["command"], timeout = step["timeout"],
+                output = output)
+
+        results = self._parse_output(output)
+        for step, result in zip(self._steps, results):
+            if result["return_code"] is None:
+                # The script ended in the middle of the command, typically
+                # because the connection was lost
+                _sessions.close(self.remote_ip, self.user)
+                raise subprocess32.CalledProcessError(
+                    returncode = 255, cmd = step["command"],
+                    output = result["output"])
+
+            if (result["return_code"] == self._TIMEOUT_RETURN_CODE or
+                    (result["duration"] is not None and
+                     result["duration"] > step["timeout"])):
+                raise subprocess32.TimeoutExpired(
+                    cmd = step["command"], timeout = step["timeout"],
+                    output = result["output"])
+
+            if (result["return_code"] != 0 and result["return_code"] not in
+                    step["ignore_return_codes"]):
+                raise subprocess32.CalledProcessError(
+                    returncode = result["return_code"], cmd = step["command"],
+                    output = result["output"])
+
+        if len(results) < len(self._steps):
+            _sessions.close(self.remote_ip, self.user)
+            raise subprocess32.CalledProcessError(
+                returncode = 255, cmd = self._steps[len(results)]["command"],
+                output = output)
+
+        return results
+
+    def _get_script(self):
+        """
+        Return the shell script that runs the commands
+        """
+        lines = [self._TIMEOUT_PROBE]
+        for index, step in enumerate(self._steps):
+            accepted = "|".join(
+                str(code) for code in [0] + step["ignore_return_codes"]
+                if code != self._TIMEOUT_RETURN_CODE)
+            command = " ".join(step["command"])
+            lines.extend([
+                "echo '" + self._MARKER + " start' " +
+                "$(cut -d ' ' -f 1 /proc/uptime)",
+                "aft_run " + str(step["timeout"]) + " sh -c '" +
+                command.replace("'", "'\\''") + "' 2>&1",
+                "return_code=$?",
+                "echo '" + self._MARKER + " end' $return_code " +
+                "$(cut -d ' ' -f 1 /proc/uptime)",
+                "case $return_code in " + accepted + ") ;; " +
+                "*) exit $return_code;; esac"])
+        return "\n".join(lines)
+
+    def _parse_output(self, output):
+        """
+        Split the output of the script into the results of the commands
+
+        Returns:
+            List of result dictionaries for the commands that were started.
+            The return code of a command that did not finish is None.
+        """
+        results = []
+        start_time = None
+        for line in output.splitlines():
+            position = line.find(self._MARKER + " ")
+            if position > 0:
+                # The command output did not end with a newline
+                if results:
+                    results[-1]["output"] += line[:position]
+                line = line[position:]
+
+            # Marker lines are "<marker> start [uptime]" and
+            # "<marker> end <return code> [uptime]"
+            fields = line.split()
+            if position >= 0 and fields[1] == "start":
+                step = self._steps[len(results)]
+                start_time = _parse_uptime(fields[2:])
+                results.append({
+                    "command": step["command"],
+                    "return_code": None,
+                    "output": "",
+                    "duration": None})
+            elif position >= 0 and fields[1] == "end" and results:
+                end_time = _parse_uptime(fields[3:])
+                results[-1]["return_code"] = int(fields[2])
+                if start_time is not None and end_time is not None:
+                    results[-1]["duration"] = end_time - start_time
+            elif results:
+                results[-1]["output"] += line + "\n"
+        return results
+
+def _parse_uptime(fields):
+    """
+    Parse the uptime printed by the batch script, None if it is missing
+    """
+    try:
+        return float(fields[0])
+    except (IndexError, ValueError):
+        return None